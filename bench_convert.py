@@ -0,0 +1,99 @@
+import os
+import time
+import torch
+from absl import flags
+from absl import app
+from ml_collections import config_flags
+from modules import sdxl_model_utils, model_utils, convert_utils, bench_utils, log_utils
+
+flags.DEFINE_string("checkpoint", None, "SDXL safetensors checkpoint to convert. Defaults to `pretrained_model_name_or_path` of the config, or empty SDXL models if both are empty.")
+flags.DEFINE_bool("load_tensors", False, "Load the tensors of the checkpoint and compare values. Otherwise only the header is read and meta tensors are converted.")
+flags.DEFINE_integer("repeats", 5, "Number of timed repeats of each conversion.")
+
+UNET_PREFIX = "model.diffusion_model."
+TE2_PREFIX = "conditioner.embedders.1.model."
+VAE_PREFIX = "first_stage_model."
+
+
+def make_sdxl_state_dict(path, load_tensors):
+    if path is None:
+        unet, text_model1, text_model2, vae = sdxl_model_utils.build_sdxl_models()
+        logit_scale = torch.empty((), device="meta")
+        return sdxl_model_utils.make_stable_diffusion_state_dict(
+            text_model1.state_dict(), text_model2.state_dict(), unet.state_dict(), vae.state_dict(), logit_scale,
+        )
+    if load_tensors:
+        from safetensors.torch import load_file
+        return load_file(path)
+    return sdxl_model_utils.make_meta_state_dict(path)
+
+
+def make_cases(state_dict):
+    r"""
+    Conversions of both directions: the SDXL side is sliced from `state_dict` and the Diffusers side is converted by the original functions.
+    """
+    unet_sd = {k[len(UNET_PREFIX):]: v for k, v in state_dict.items() if k.startswith(UNET_PREFIX)}
+    te2_sd = {k: v for k, v in state_dict.items() if k.startswith(TE2_PREFIX)}
+    vae_sd = {k: v for k, v in state_dict.items() if k.startswith(VAE_PREFIX)}
+    vae_config = model_utils.create_vae_diffusers_config()
+
+    du_unet_sd = sdxl_model_utils.convert_sdxl_unet_state_dict_to_diffusers.__wrapped__(unet_sd)
+    hf_te2_sd, logit_scale = sdxl_model_utils.convert_sdxl_text_encoder_2_checkpoint.__wrapped__(te2_sd, 77)
+    hf_vae_sd = model_utils.convert_ldm_vae_checkpoint.__wrapped__(vae_sd, vae_config)
+    return [
+        ("U-Net sdxl->diffusers", sdxl_model_utils.convert_sdxl_unet_state_dict_to_diffusers, (unet_sd,)),
+        ("U-Net diffusers->sdxl", sdxl_model_utils.convert_diffusers_unet_state_dict_to_sdxl, (du_unet_sd,)),
+        ("TE2 sdxl->hf", sdxl_model_utils.convert_sdxl_text_encoder_2_checkpoint, (te2_sd, 77)),
+        ("TE2 hf->sdxl", sdxl_model_utils.convert_text_encoder_2_state_dict_to_sdxl, (hf_te2_sd, logit_scale)),
+        ("VAE ldm->diffusers", model_utils.convert_ldm_vae_checkpoint, (vae_sd, vae_config)),
+        ("VAE diffusers->ldm", model_utils.convert_vae_state_dict, (hf_vae_sd,)),
+    ]
+
+
+def time_fn(fn, args, repeats):
+    timer = bench_utils.Timer()
+    for _ in range(repeats):
+        with timer:
+            fn(*args)
+    return timer.summary()["mean"]
+
+
+def bench_convert(argv):
+    FLAGS = flags.FLAGS
+    config = FLAGS.config
+    logger = log_utils.get_logger("bench")
+
+    path = FLAGS.checkpoint or config.get("pretrained_model_name_or_path") or None
+    if path is not None and not (path.endswith(".safetensors") and os.path.isfile(path)):
+        logger.print(log_utils.yellow(f"no safetensors checkpoint at {path}, use empty SDXL models"))
+        path = None
+    logger.print(f"checkpoint: {log_utils.yellow(path or 'empty SDXL models')} | load tensors: {log_utils.yellow(FLAGS.load_tensors and path is not None)}")
+    state_dict = make_sdxl_state_dict(path, FLAGS.load_tensors)
+
+    results = []
+    for name, fn, args in make_cases(state_dict):
+        convert_utils.clear_plans()
+        t0 = time.perf_counter()
+        convert_utils.get_plan(fn.__wrapped__, args)
+        plan_time = time.perf_counter() - t0
+        # the planned conversion must return the same keys, shapes, dtypes and tensors as the original one
+        convert_utils.check_plan(fn, *args)
+        original_time = time_fn(fn.__wrapped__, args, FLAGS.repeats)
+        planned_time = time_fn(fn, args, FLAGS.repeats)
+        results.append((name, len(args[0]), plan_time, original_time, planned_time))
+        logger.print(f"  {name}: {log_utils.green('identical output')}", no_prefix=True)
+
+    logger.print(log_utils.green(f"==================== RESULTS ===================="))
+    logger.print(f"{'conversion':<24}{'keys':>7}{'plan (ms)':>11}{'original (ms)':>15}{'planned (ms)':>14}{'speedup':>9}", no_prefix=True)
+    for name, num_keys, plan_time, original_time, planned_time in results:
+        speedup = f"{original_time / planned_time:.2f}x" if planned_time > 0 else "-"
+        logger.print(
+            f"{name:<24}{num_keys:>7}{plan_time * 1000:>11.1f}{original_time * 1000:>15.2f}{planned_time * 1000:>14.2f}{speedup:>9}",
+            no_prefix=True,
+        )
+
+
+if __name__ == "__main__":
+    config_flags.DEFINE_config_file("config", None, "Training configuration.", lock_config=False)
+    flags.mark_flags_as_required(["config"])
+    app.run(bench_convert)
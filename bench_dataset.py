@@ -0,0 +1,141 @@
+import torch
+import time
+from absl import flags
+from absl import app
+from ml_collections import config_flags
+from torch.utils.data import DataLoader
+from modules import sdxl_train_utils, sdxl_dataset_utils, bench_utils, log_utils
+
+flags.DEFINE_integer("num_batches", 200, "Number of batches to iterate for each setting.")
+flags.DEFINE_integer("warmup_batches", 10, "Number of batches to skip before timing, e.g. for worker startup.")
+flags.DEFINE_list("workers", ["0", "2", "4", "8"], "DataLoader worker counts to sweep.")
+flags.DEFINE_list("keep_in_memory", ["false", "true"], "Values of `keep_cached_latents_in_memory` to sweep.")
+flags.DEFINE_list("cache_formats", ["npz", "image"], "Data formats to sweep: `npz` loads cached latents, `image` loads and transforms image files.")
+flags.DEFINE_bool("stub_tokenizer", False, "Use offline stub tokenizers instead of CLIP tokenizers.")
+
+
+def run_dataloader(dataset, num_workers, num_batches, warmup_batches):
+    dataloader = DataLoader(
+        dataset,
+        batch_size=1,  # fix to 1 because collate_fn returns a dict
+        num_workers=num_workers,
+        shuffle=True,
+        collate_fn=sdxl_train_utils.collate_fn,
+        persistent_workers=num_workers > 0,  # keep latents cached in worker memory across epochs
+    )
+    timer = bench_utils.Timer()
+    num_samples = 0
+    worker_rss = {}
+    iterator = iter(dataloader)
+    t_start = time.perf_counter()
+    i = 0
+    while i < warmup_batches + num_batches:
+        t0 = time.perf_counter()
+        try:
+            batch = next(iterator)
+        except StopIteration:  # start a new epoch
+            iterator = iter(dataloader)
+            continue
+        timer.durations.append(time.perf_counter() - t0)
+        i += 1
+        if i == warmup_batches:
+            t_start = time.perf_counter()
+        elif i > warmup_batches:
+            num_samples += len(batch["image_keys"])
+        if i % 10 == 0:
+            for pid in bench_utils.get_dataloader_worker_pids(iterator):
+                worker_rss[pid] = max(worker_rss.get(pid, 0), bench_utils.get_rss(pid))
+    elapsed = time.perf_counter() - t_start
+    main_rss = bench_utils.get_rss()
+    del iterator, dataloader
+
+    result = timer.summary(skip=warmup_batches)
+    result.update(
+        samples_per_sec=num_samples / elapsed if elapsed > 0 else 0.,
+        main_rss=main_rss,
+        worker_rss=max(worker_rss.values()) if worker_rss else 0,
+    )
+    return result
+
+
+def bench_dataset(argv):
+    FLAGS = flags.FLAGS
+    config = FLAGS.config
+    logger = log_utils.get_logger("bench")
+
+    latents_dtype = torch.float32
+    if config.mixed_precision == "fp16":
+        latents_dtype = torch.float16
+    elif config.mixed_precision == "bf16":
+        latents_dtype = torch.bfloat16
+
+    if FLAGS.stub_tokenizer:
+        tokenizer1, tokenizer2 = bench_utils.load_stub_tokenizers()
+    else:
+        try:
+            tokenizer1, tokenizer2 = sdxl_train_utils.load_tokenizers(config.tokenizer_cache_dir, config.max_token_length)
+        except OSError as e:
+            logger.print(log_utils.red(f"failed to load tokenizers, use stub tokenizers instead: {e}"))
+            tokenizer1, tokenizer2 = bench_utils.load_stub_tokenizers()
+
+    logger.print(f"prepare dataset...")
+    dataset = sdxl_dataset_utils.Dataset(
+        config=config,
+        tokenizer1=tokenizer1,
+        tokenizer2=tokenizer2,
+        latents_dtype=latents_dtype,
+        is_main_process=True,
+    )
+    assert len(dataset) > 0, "dataset is empty / データセットが空です"
+    image_infos = list(dataset.image_data.values())
+    npz_paths = {img_info.key: img_info.npz_path for img_info in image_infos}
+
+    results = []
+    for cache_format in FLAGS.cache_formats:
+        if cache_format == "npz":
+            if any(npz_path is None for npz_path in npz_paths.values()):
+                logger.print(log_utils.yellow(f"skip `npz`: some latents are not cached, run `cache_latents.py` first"))
+                continue
+            for img_info in image_infos:
+                img_info.npz_path = npz_paths[img_info.key]
+        elif cache_format == "image":
+            if any(img_info.image_path is None for img_info in image_infos):
+                logger.print(log_utils.yellow(f"skip `image`: some image files are missing"))
+                continue
+            for img_info in image_infos:
+                img_info.npz_path = None
+        else:
+            raise ValueError(f"unknown cache format: {cache_format}")
+
+        for keep_in_memory in FLAGS.keep_in_memory:
+            keep_in_memory = keep_in_memory.lower() in ("true", "1", "yes")
+            if cache_format == "image" and keep_in_memory:
+                continue  # images are never kept in memory
+            for num_workers in FLAGS.workers:
+                num_workers = int(num_workers)
+                for img_info in image_infos:
+                    img_info.latents = None
+                    img_info.latents_flipped = None
+                dataset.keep_cached_latents_in_memory = keep_in_memory
+                logger.print(f"bench format: {log_utils.yellow(cache_format)} | keep in memory: {log_utils.yellow(keep_in_memory)} | workers: {log_utils.yellow(num_workers)}")
+                result = run_dataloader(dataset, num_workers, FLAGS.num_batches, FLAGS.warmup_batches)
+                result.update(cache_format=cache_format, keep_in_memory=keep_in_memory, num_workers=num_workers)
+                results.append(result)
+
+    for img_info in image_infos:
+        img_info.npz_path = npz_paths[img_info.key]
+
+    logger.print(log_utils.green(f"==================== RESULTS ===================="))
+    logger.print(f"{'format':<8}{'memory':<8}{'workers':<9}{'samples/s':>11}{'p50 (ms)':>10}{'p99 (ms)':>10}{'main rss':>11}{'worker rss':>12}", no_prefix=True)
+    for r in results:
+        logger.print(
+            f"{r['cache_format']:<8}{str(r['keep_in_memory']):<8}{r['num_workers']:<9}{r['samples_per_sec']:>11.1f}{r['p50'] * 1e3:>10.1f}{r['p99'] * 1e3:>10.1f}"
+            f"{bench_utils.format_bytes(r['main_rss']):>11}{bench_utils.format_bytes(r['worker_rss']):>12}",
+            no_prefix=True,
+        )
+
+
+if __name__ == "__main__":
+    config_flags.DEFINE_config_file("config", None, "Training configuration.", lock_config=False)
+    flags.mark_flags_as_required(["config"])
+    app.run(bench_dataset)
@@ -0,0 +1,194 @@
+import gc
+import time
+import torch
+from absl import flags
+from absl import app
+from ml_collections import config_flags
+from accelerate import Accelerator
+from modules import sdxl_train_utils, bench_utils, profile_utils, log_utils
+
+flags.DEFINE_integer("steps", 20, "Number of timed training steps for each attention backend.")
+flags.DEFINE_integer("warmup_steps", 3, "Number of training steps to run before timing.")
+flags.DEFINE_integer("batch_size", 1, "Batch size of the synthetic batches.")
+flags.DEFINE_integer("width", 256, "Width of the synthetic images in pixels.")
+flags.DEFINE_integer("height", 256, "Height of the synthetic images in pixels.")
+flags.DEFINE_integer("model_channels", 32, "Base channels of the reduced U-Net. The original SDXL U-Net uses 320.")
+flags.DEFINE_list("transformer_depth", ["0", "1", "1"], "Transformer depth of each U-Net level. The original SDXL U-Net uses 1,2,10.")
+flags.DEFINE_list("backends", ["_attention", "mem_eff", "sdpa"], "Attention backends to benchmark.")
+flags.DEFINE_bool("cpu", True, "Run on CPU even if a GPU is available.")
+flags.DEFINE_enum("mixed_precision", "no", ["no", "fp16", "bf16"], "Mixed precision of autocast. Use `bf16` on CPU.")
+flags.DEFINE_bool("gradient_checkpointing", False, "Enable gradient checkpointing of the U-Net.")
+flags.DEFINE_list("memory_lean", ["false"], "Run with memory-lean feed-forward and GroupNorm disabled and/or enabled, e.g. `false,true`.")
+flags.DEFINE_integer("ff_chunk_size", 256, "Tokens per feed-forward chunk when memory-lean is enabled.")
+flags.DEFINE_integer("group_norm_chunks", 4, "Chunks of GroupNorm groups when memory-lean is enabled.")
+flags.DEFINE_list("torch_compile", ["false"], "Run with torch.compile disabled and/or enabled, e.g. `false,true`.")
+flags.DEFINE_enum("compile_shape_mode", "dynamic", ["dynamic", "prewarm"], "`dynamic` marks height and width dynamic, `prewarm` compiles a static graph per bucket.")
+flags.DEFINE_string("compile_backend", "inductor", "Backend of torch.compile.")
+flags.DEFINE_list("buckets", [], "Bucket sizes to cycle through, e.g. `256x256,320x192`. Defaults to `width`x`height`.")
+flags.DEFINE_integer("seed", 42, "Random seed of the models and batches.")
+
+BACKENDS = ("_attention", "mem_eff", "sdpa")
+
+
+def bench_backend(config, accelerator, backend, unet_kwargs, memory_lean_kwargs, compile_kwargs, text_encoder1, text_encoder2, tokenizer1, tokenizer2, batches, num_warmup_steps):
+    torch.manual_seed(config.seed)
+    unet = bench_utils.make_tiny_unet(
+        context_dim=text_encoder1.config.hidden_size + text_encoder2.config.hidden_size,
+        pooled_dim=text_encoder2.config.projection_dim,
+        **unet_kwargs,
+    )
+    sdxl_train_utils.replace_unet_modules(unet, backend == "mem_eff", False, backend == "sdpa")
+    unet.set_memory_lean(**memory_lean_kwargs)
+    if config.gradient_checkpointing:
+        unet.enable_gradient_checkpointing()
+    if compile_kwargs:
+        unet.set_torch_compile(True, **compile_kwargs)
+    unet.requires_grad_(True)
+    unet.train()
+    unet = accelerator.prepare(unet)
+    (unet,) = sdxl_train_utils.transform_models_if_DDP([unet])
+    training_models = [unet]
+
+    optimizer = sdxl_train_utils.get_optimizer(config, [{"params": list(unet.parameters()), "lr": config.learning_rate}])
+    lr_scheduler = sdxl_train_utils.get_scheduler_fix(config, optimizer, len(batches))
+    optimizer, lr_scheduler = accelerator.prepare(optimizer, lr_scheduler)
+    noise_scheduler = sdxl_train_utils.prepare_noise_scheduler(config, accelerator.device)
+
+    def step(batch):
+        loss = sdxl_train_utils.train_step(
+            config,
+            accelerator,
+            batch,
+            noise_scheduler=noise_scheduler,
+            unet=unet,
+            text_encoder1=text_encoder1,
+            text_encoder2=text_encoder2,
+            tokenizer1=tokenizer1,
+            tokenizer2=tokenizer2,
+            vae=None,
+            optimizer=optimizer,
+            lr_scheduler=lr_scheduler,
+            training_models=training_models,
+            weight_dtype=torch.float32,
+            vae_dtype=torch.float32,
+        )
+        return loss.detach().item()
+
+    # the first step of every shape includes compilation
+    compile_monitor = profile_utils.CompileWarmupMonitor(enable=True, report_after_n_steps=None)
+    for batch in batches[:num_warmup_steps]:
+        with compile_monitor.track(tuple(batch["latents"].shape)):
+            step(batch)
+
+    timer = bench_utils.Timer()
+    with bench_utils.PeakMemoryMonitor(accelerator.device) as memory_monitor:
+        for batch in batches[num_warmup_steps:]:
+            with timer, compile_monitor.track(tuple(batch["latents"].shape)):
+                loss = step(batch)
+    summary = timer.summary()
+    unet_module = accelerator.unwrap_model(unet)
+    unet_module.set_torch_compile(False)
+
+    return dict(
+        backend=backend,
+        memory_lean=bool(memory_lean_kwargs),
+        compiled=bool(compile_kwargs),
+        compile_time=compile_monitor.summary()["compile_time"],
+        steps_per_sec=summary["count"] / timer.total if timer.total > 0 else 0.,
+        sec_per_step=summary["mean"],
+        p99=summary["p99"],
+        peak_memory=memory_monitor.peak_increase if accelerator.device.type == "cpu" else memory_monitor.peak,
+        loss=loss,
+    )
+
+
+def bench_train(argv):
+    FLAGS = flags.FLAGS
+    config = FLAGS.config
+    logger = log_utils.get_logger("bench")
+
+    for backend in FLAGS.backends:
+        assert backend in BACKENDS, f"unknown attention backend: {backend}, must be one of {BACKENDS} / 不明なattentionのバックエンドです: {backend}"
+
+    # the synthetic step always runs in fp32 and only trains the U-Net
+    config.seed = FLAGS.seed
+    config.full_fp16 = False
+    config.full_bf16 = False
+    config.train_text_encoder = False
+    config.gradient_accumulation_steps = 1
+    config.lr_warmup_steps = 0
+    config.gradient_checkpointing = FLAGS.gradient_checkpointing
+    accelerator = Accelerator(cpu=FLAGS.cpu, mixed_precision=FLAGS.mixed_precision, gradient_accumulation_steps=1)
+    logger.print(f"device: {log_utils.yellow(accelerator.device)} | threads: {log_utils.yellow(torch.get_num_threads())}")
+
+    torch.manual_seed(config.seed)
+    tokenizer1, tokenizer2 = bench_utils.load_stub_tokenizers()
+    text_encoder1, text_encoder2 = bench_utils.make_tiny_text_encoders()
+    for text_encoder in (text_encoder1, text_encoder2):
+        text_encoder.to(accelerator.device)
+        text_encoder.requires_grad_(False)
+        text_encoder.eval()
+
+    generator = torch.Generator().manual_seed(config.seed)
+    buckets = [tuple(int(v) for v in bucket.split("x")) for bucket in FLAGS.buckets] or [(FLAGS.width, FLAGS.height)]
+    num_warmup_steps = max(FLAGS.warmup_steps, len(buckets))  # warm up every bucket
+    num_steps = num_warmup_steps + FLAGS.steps
+    batches = [
+        bench_utils.make_synthetic_batch(FLAGS.batch_size, *buckets[i % len(buckets)], tokenizer1, tokenizer2, config.max_token_length, generator=generator)
+        for i in range(num_steps)
+    ]
+
+    unet_kwargs = dict(model_channels=FLAGS.model_channels, transformer_depth=tuple(int(d) for d in FLAGS.transformer_depth))
+    bucket_names = ",".join(f"{w}x{h}" for w, h in buckets)
+    results = []
+    for backend in FLAGS.backends:
+        for memory_lean in FLAGS.memory_lean:
+            memory_lean = memory_lean.lower() in ("true", "1", "yes")
+            memory_lean_kwargs = dict(ff_chunk_size=FLAGS.ff_chunk_size, group_norm_chunks=FLAGS.group_norm_chunks) if memory_lean else {}
+            for torch_compile in FLAGS.torch_compile:
+                torch_compile = torch_compile.lower() in ("true", "1", "yes")
+                compile_kwargs = dict(dynamic_spatial=FLAGS.compile_shape_mode == "dynamic", backend=FLAGS.compile_backend) if torch_compile else {}
+                logger.print(
+                    f"bench attention backend: {log_utils.yellow(backend)} | memory lean: {log_utils.yellow(memory_lean)} | compile: {log_utils.yellow(torch_compile)}"
+                    f" | batch size: {FLAGS.batch_size} | buckets: {bucket_names}"
+                )
+                if torch_compile:
+                    import torch._dynamo
+                    torch._dynamo.reset()  # compile from scratch to measure the compile time
+                    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * len(buckets))
+                t0 = time.perf_counter()
+                result = bench_backend(
+                    config, accelerator, backend, unet_kwargs, memory_lean_kwargs, compile_kwargs, text_encoder1, text_encoder2, tokenizer1, tokenizer2, batches,
+                    num_warmup_steps,
+                )
+                accelerator.free_memory()  # release the references to the prepared U-Net and optimizer
+                gc.collect()
+                logger.print(f"  done in {time.perf_counter() - t0:.1f}s", no_prefix=True)
+                results.append(result)
+
+    memory_name = "peak rss+" if accelerator.device.type == "cpu" else "peak mem"
+    logger.print(log_utils.green(f"==================== RESULTS ===================="))
+    logger.print(
+        f"{'backend':<12}{'lean':<7}{'compile':<9}{'steps/s':>9}{'s/step':>9}{'p99 (s)':>9}{memory_name:>12}{'saved':>8}{'warmup (s)':>12}{'speedup':>9}{'loss':>10}",
+        no_prefix=True,
+    )
+    memory_baselines = {r["backend"]: r["peak_memory"] for r in results if not r["memory_lean"] and not r["compiled"]}
+    eager_baselines = {(r["backend"], r["memory_lean"]): r["sec_per_step"] for r in results if not r["compiled"]}
+    for r in results:
+        memory_baseline = memory_baselines.get(r["backend"])
+        saved = f"{1 - r['peak_memory'] / memory_baseline:.1%}" if r["memory_lean"] and memory_baseline else "-"
+        eager_baseline = eager_baselines.get((r["backend"], r["memory_lean"]))
+        speedup = f"{eager_baseline / r['sec_per_step']:.2f}x" if r["compiled"] and eager_baseline and r["sec_per_step"] > 0 else "-"
+        # compile time is the extra time of the first step of every bucket over the steady state
+        warmup = f"{r['compile_time']:.1f}" if r["compiled"] else "-"
+        logger.print(
+            f"{r['backend']:<12}{str(r['memory_lean']):<7}{str(r['compiled']):<9}{r['steps_per_sec']:>9.2f}{r['sec_per_step']:>9.3f}{r['p99']:>9.3f}"
+            f"{bench_utils.format_bytes(r['peak_memory']):>12}{saved:>8}{warmup:>12}{speedup:>9}{r['loss']:>10.4f}",
+            no_prefix=True,
+        )
+
+
+if __name__ == "__main__":
+    config_flags.DEFINE_config_file("config", None, "Training configuration.", lock_config=False)
+    flags.mark_flags_as_required(["config"])
+    app.run(bench_train)
@@ -0,0 +1,116 @@
+import gc
+import torch
+from absl import flags
+from absl import app
+from ml_collections import config_flags
+from modules import sdxl_dataset_utils, model_utils, vae_utils, bench_utils, log_utils
+
+flags.DEFINE_string("vae", None, "VAE to benchmark. Defaults to `vae` of the config, or a randomly initialized reduced VAE if both are empty.")
+flags.DEFINE_multi_string("images", [], "Image files to encode. Random images are used if empty.")
+flags.DEFINE_integer("batch_size", 2, "Batch size of the encoded and decoded batch.")
+flags.DEFINE_integer("width", 1024, "Width of the images in pixels.")
+flags.DEFINE_integer("height", 1024, "Height of the images in pixels.")
+flags.DEFINE_list("batch_slice_sizes", ["0", "1"], "Batch slice sizes to sweep. 0 disables batch slicing.")
+flags.DEFINE_list("tile_sizes", ["0", "512"], "Tile sizes in pixels to sweep. 0 disables tiling.")
+flags.DEFINE_integer("tile_overlap", 64, "Overlap of the tiles in pixels.")
+flags.DEFINE_integer("repeats", 3, "Number of timed repeats of each setting.")
+flags.DEFINE_bool("cpu", False, "Run on CPU even if a GPU is available.")
+flags.DEFINE_integer("seed", 42, "Random seed of the images and the latent sampling.")
+
+
+def make_images(image_paths, batch_size, width, height, generator):
+    if image_paths:
+        images = [sdxl_dataset_utils.process_image(sdxl_dataset_utils.load_image(path), target_size=(width, height)) for path in image_paths]
+        return torch.stack([images[i % len(images)] for i in range(batch_size)], dim=0)
+    # smooth random images: upsampled noise is closer to natural images than white noise
+    noise = torch.rand(batch_size, 3, height // 32, width // 32, generator=generator) * 2 - 1
+    return torch.nn.functional.interpolate(noise, size=(height, width), mode="bicubic", align_corners=False).clamp(-1, 1)
+
+
+def bench_setting(fn, device, repeats):
+    timer = bench_utils.Timer()
+    with bench_utils.PeakMemoryMonitor(device) as memory_monitor:
+        for _ in range(repeats):
+            with timer:
+                output = fn()
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+    return output, timer.summary()["mean"], memory_monitor.peak_increase if device.type == "cpu" else memory_monitor.peak
+
+
+def bench_vae(argv):
+    FLAGS = flags.FLAGS
+    config = FLAGS.config
+    logger = log_utils.get_logger("bench")
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not FLAGS.cpu else "cpu")
+    vae_dtype = torch.float32 if config.no_half_vae or device.type == "cpu" else torch.float16
+    vae_path = FLAGS.vae or config.vae
+    if vae_path:
+        vae = model_utils.load_vae(vae_path, vae_dtype)
+    else:
+        logger.print(log_utils.yellow(f"no VAE specified, use a randomly initialized reduced VAE"))
+        torch.manual_seed(FLAGS.seed)
+        vae = bench_utils.make_tiny_vae().to(vae_dtype)
+    vae.to(device)
+    vae.requires_grad_(False)
+    vae.eval()
+    logger.print(f"device: {log_utils.yellow(device)} | dtype: {log_utils.yellow(vae_dtype)} | resolution: {FLAGS.width}x{FLAGS.height} | batch size: {FLAGS.batch_size}")
+
+    generator = torch.Generator().manual_seed(FLAGS.seed)
+    images = make_images(FLAGS.images, FLAGS.batch_size, FLAGS.width, FLAGS.height, generator).to(device, dtype=vae_dtype)
+
+    def sample(dist):
+        # sample with the same noise for all settings so that only the moments differ
+        return dist.mean + dist.std * torch.randn(dist.mean.shape, generator=torch.Generator().manual_seed(FLAGS.seed)).to(dist.mean)
+
+    results = []
+    reference_latents, reference_images = None, None
+    settings = [(int(b), int(t)) for t in FLAGS.tile_sizes for b in FLAGS.batch_slice_sizes]
+    settings.sort(key=lambda s: s != (0, 0))  # the un-tiled path goes first as the reference
+    if settings[0] != (0, 0):
+        settings.insert(0, (0, 0))
+    for batch_slice_size, tile_size in settings:
+        tiling_kwargs = dict(batch_slice_size=batch_slice_size or None, tile_size=tile_size or None, tile_overlap=FLAGS.tile_overlap)
+        logger.print(f"bench batch slice size: {log_utils.yellow(batch_slice_size or '-')} | tile size: {log_utils.yellow(tile_size or '-')}")
+        with torch.no_grad():
+            latents, encode_time, encode_memory = bench_setting(lambda: sample(vae_utils.encode(vae, images, **tiling_kwargs)), device, FLAGS.repeats)
+            # decode the reference latents so that the decode difference does not include the encode difference
+            decode_input = latents if reference_latents is None else reference_latents
+            decoded, decode_time, decode_memory = bench_setting(lambda: vae_utils.decode(vae, decode_input, **tiling_kwargs), device, FLAGS.repeats)
+        if reference_latents is None:
+            reference_latents, reference_images = latents, decoded
+        results.append(dict(
+            batch_slice_size=batch_slice_size,
+            tile_size=tile_size,
+            encode_time=encode_time,
+            encode_memory=encode_memory,
+            decode_time=decode_time,
+            decode_memory=decode_memory,
+            encode_diff=vae_utils.diff_report(reference_latents, latents, value_range=(reference_latents.max() - reference_latents.min()).item()),
+            decode_diff=vae_utils.diff_report(reference_images, decoded, value_range=2.0),
+        ))
+        del latents, decoded
+        gc.collect()
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    memory_name = "rss+" if device.type == "cpu" else "mem"
+    logger.print(log_utils.green(f"==================== RESULTS ===================="))
+    logger.print(
+        f"{'slice':<7}{'tile':<7}{'enc (s)':>9}{'enc ' + memory_name:>12}{'enc max':>10}{'enc psnr':>10}{'dec (s)':>9}{'dec ' + memory_name:>12}{'dec max':>10}{'dec psnr':>10}",
+        no_prefix=True,
+    )
+    for r in results:
+        logger.print(
+            f"{r['batch_slice_size'] or '-':<7}{r['tile_size'] or '-':<7}"
+            f"{r['encode_time']:>9.3f}{bench_utils.format_bytes(r['encode_memory']):>12}{r['encode_diff']['max_abs']:>10.4f}{r['encode_diff']['psnr']:>10.1f}"
+            f"{r['decode_time']:>9.3f}{bench_utils.format_bytes(r['decode_memory']):>12}{r['decode_diff']['max_abs']:>10.4f}{r['decode_diff']['psnr']:>10.1f}",
+            no_prefix=True,
+        )
+
+
+if __name__ == "__main__":
+    config_flags.DEFINE_config_file("config", None, "Training configuration.", lock_config=False)
+    flags.mark_flags_as_required(["config"])
+    app.run(bench_vae)
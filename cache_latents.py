@@ -70,6 +70,7 @@ def cache_latents(
             cache_to_disk=config.cache_latents_to_disk,
             check_validity=config.check_cache_validity,
             async_cache=config.async_cache,
+            vae_tiling_kwargs=config.vae_tiling_kwargs,
         )
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
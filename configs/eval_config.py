@@ -12,12 +12,35 @@ def get_config():
     config.pretrained_model_name_or_path = None  # [必填]
     config.vae = None
     config.no_half_vae = False
+    config.shared_load_kwargs = cfg(
+        enable=False,  # load the checkpoint once per node and share it across local processes, only for safetensors checkpoints
+        shm_dir=None,  # e.g. '/dev/shm', stage the checkpoint in shared memory instead of the page cache
+    )
+    config.vae_tiling_kwargs = cfg(
+        batch_slice_size=None,  # e.g. 1, encode/decode one image at a time
+        tile_size=None,  # e.g. 512 pixels
+        tile_overlap=64,
+    )
     config.tokenizer_cache_dir = None
     config.max_token_length = 225
     config.mem_eff_attn = False
     config.xformers = False
     config.diffusers_xformers = False
     config.sdpa = False
+    config.fused_projections = False
+    config.memory_lean_kwargs = cfg(
+        ff_chunk_size=None,  # e.g. 4096 tokens
+        group_norm_chunks=None,  # e.g. 4
+        min_resolution=None,  # e.g. 1536, only inputs of at least 1536x1536 pixels run memory-lean
+    )
+    config.torch_compile_kwargs = cfg(
+        enable=False,
+        backend='inductor',
+        mode=None,  # e.g. 'max-autotune-no-cudagraphs'
+        fullgraph=False,
+        shape_mode='dynamic',
+        cache_dir=None,  # e.g. 'compile_cache', reuse compiled artifacts across restarts
+    )
     config.clip_skip = 1
 
     # OS Parameters
@@ -46,5 +69,19 @@ def get_config():
         original_scale_factor=1.0,
         save_latents=False,
     )
+    config.sample_batch_kwargs = cfg(
+        enable=False,  # denoise the benchmark params with the same resolution, steps and scale in one batch
+        max_batch_size=8,  # images per batch
+        max_batch_pixels=4 * 1024 * 1024,  # e.g. 4 images of 1024x1024 pixels per batch
+    )
+    config.sample_sink_kwargs = cfg(
+        num_workers=2,  # threads which encode, write and upload the samples in background
+        image_format='png',  # 'png' or 'webp'
+        quality=95,  # quality of webp
+    )
+    config.sample_embedding_cache_kwargs = cfg(
+        enable=False,  # reuse the text embeddings of the benchmark prompts across sampling rounds
+        max_entries=1024,  # prompts kept in the cache
+    )
 
     return config
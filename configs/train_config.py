@@ -19,6 +19,11 @@ def get_config():
     config.vae = None
 
     config.no_half_vae = False
+    config.shared_load_kwargs = cfg(
+        enable=False,  # load the checkpoint once per node and share it across local processes, only for safetensors checkpoints
+        shm_dir=None,  # e.g. '/dev/shm', stage the checkpoint in shared memory instead of the page cache
+        keep_staged=False,  # keep the copy in `shm_dir` after loading to reuse it on restart, it occupies memory until deleted
+    )
     config.tokenizer_cache_dir = 'tokenizers'
     config.records_cache_dir = 'records'
 
@@ -27,6 +32,11 @@ def get_config():
     config.bucket_reso_step = 32
     config.resolution = 1024
     config.vae_batch_size = 1
+    config.vae_tiling_kwargs = cfg(
+        batch_slice_size=None,  # e.g. 1, encode/decode one image at a time
+        tile_size=None,  # e.g. 512 pixels
+        tile_overlap=64,
+    )
     config.max_dataset_n_workers = 1
     config.max_dataloader_n_workers = 4
     config.persistent_data_loader_workers = False
@@ -46,6 +56,25 @@ def get_config():
         gamma=0.9,
         stride=1000,
     )
+    config.logging_kwargs = cfg(
+        console_every_n_steps=1,
+        tracker_every_n_steps=1,
+        console_mode='step',
+        tracker_mode='step',
+        async_log=True,
+    )
+    config.profiler_kwargs = cfg(
+        enable=False,
+        use_cuda_events=True,
+        report_every_n_steps=100,
+        trace_steps=None,  # e.g. '10-20,100-110'
+        trace_path=None,
+    )
+    config.data_monitor_kwargs = cfg(
+        enable=False,
+        report_every_n_batches=100,
+        data_bound_threshold=0.1,
+    )
     config.save_precision = 'fp16'
     config.save_model = True
     config.save_train_state = True
@@ -54,10 +83,37 @@ def get_config():
     config.save_on_train_end = True
     config.save_on_keyboard_interrupt = True
     config.save_on_exception = True
+    config.async_save_kwargs = cfg(
+        enable=False,
+        max_in_flight=1,
+        pin_memory=True,
+    )
+    config.sharded_save_kwargs = cfg(
+        enable=False,
+    )
+    config.delta_save_kwargs = cfg(
+        enable=False,
+        mode='exact',  # 'exact', 'lowrank' or 'quantize'
+        rank=64,
+    )
+    config.retention_kwargs = cfg(
+        enable=False,
+        keep_last_n=3,
+        keep_every_n_steps=None,
+        keep_best_n=0,
+        metric='loss_ema/step',
+        metric_mode='min',
+        verify=True,
+    )
 
     # Training Parameters
     config.num_train_epochs = 100
     config.batch_size = 1
+    config.token_budget_kwargs = cfg(
+        enable=False,
+        max_tokens=None,  # latent pixels per batch, defaults to `batch_size` images at `resolution`
+        max_batch_size=None,
+    )
     config.learning_rate = 1e-5
     config.block_lr = None
     config.lr_scheduler = 'constant_with_warmup'
@@ -71,6 +127,13 @@ def get_config():
     config.learning_rate_te1 = None
     config.learning_rate_te2 = None
     config.gradient_checkpointing = False
+    config.gradient_checkpointing_kwargs = cfg(
+        blocks=None,  # block indices like `block_lr`, e.g. '1-9,13-21'
+        module_types=None,  # e.g. ['ResnetBlock2D', 'BasicTransformerBlock']
+        memory_budget=None,  # activation memory of the U-Net in GB
+        budget_resolution=None,
+        budget_batch_size=None,
+    )
     config.gradient_accumulation_steps = 1
     config.optimizer_type = 'AdaFactor'
     config.optimizer_kwargs = cfg(
@@ -87,6 +150,22 @@ def get_config():
     config.xformers = True
     config.diffusers_xformers = False
     config.sdpa = False
+    config.fused_projections = False
+    config.memory_lean_kwargs = cfg(
+        ff_chunk_size=None,  # e.g. 4096 tokens
+        group_norm_chunks=None,  # e.g. 4
+        min_resolution=None,  # e.g. 1536, only inputs of at least 1536x1536 pixels run memory-lean
+    )
+    config.torch_compile_kwargs = cfg(
+        enable=False,
+        backend='inductor',
+        mode=None,  # e.g. 'max-autotune-no-cudagraphs'
+        fullgraph=False,
+        shape_mode='dynamic',  # 'dynamic': one graph with dynamic height and width, 'prewarm': one static graph per bucket compiled before training
+        cache_dir=None,  # e.g. 'compile_cache', reuse compiled artifacts across restarts
+        report_after_n_steps=100,
+        eager_step_time=None,  # seconds per step without compiling, e.g. measured by bench_train.py, to report the speedup
+    )
     config.clip_skip = 1
     config.noise_offset = 0.0357
     config.multires_noise_iterations = 0
@@ -124,6 +203,24 @@ def get_config():
         original_scale_factor=1.0,
         save_latents=False,
     )
+    config.sample_batch_kwargs = cfg(
+        enable=False,  # denoise the benchmark params with the same resolution, steps and scale in one batch
+        max_batch_size=8,  # images per batch
+        max_batch_pixels=4 * 1024 * 1024,  # e.g. 4 images of 1024x1024 pixels per batch
+    )
+    config.sample_sink_kwargs = cfg(
+        num_workers=2,  # threads which encode, write and upload the samples in background
+        image_format='png',  # 'png' or 'webp'
+        quality=95,  # quality of webp
+    )
+    config.sample_embedding_cache_kwargs = cfg(
+        enable=False,  # reuse the text embeddings of the benchmark prompts across sampling rounds
+        max_entries=1024,  # prompts kept in the cache
+    )
+    config.sample_pipeline_kwargs = cfg(
+        vae_placement='offload',  # where the VAE stays between samplings: 'resident' on the device, 'offload' to cpu, or 'pinned' host memory
+        empty_cache=True,  # empty the CUDA cache after every sampling
+    )
 
     # Custom Training Parameters
     config.num_repeats_getter = None
@@ -0,0 +1,7 @@
+python bench_dataset.py --config=configs/train_config.py --workers=0,2,4,8 # 数据集基准测试
+python bench_dataset.py --config=configs/train_config.py --stub_tokenizer # 离线数据集基准测试
+python bench_train.py --config=configs/train_config.py # 合成数据 CPU 训练基准测试
+python bench_train.py --config=configs/train_config.py --mixed_precision=bf16 --gradient_checkpointing --memory_lean=false,true --width=512 --height=512 # 低显存执行 CPU 基准测试
+python bench_train.py --config=configs/train_config.py --torch_compile=false,true --buckets=256x256,320x192,192x320 # 编译 CPU 基准测试
+python bench_vae.py --config=configs/train_config.py --cpu --width=512 --height=512 --tile_sizes=0,256 # VAE 切片与分块基准测试
+python bench_convert.py --config=configs/train_config.py # 模型键名转换基准测试
@@ -0,0 +1,39 @@
+import os
+import torch
+from absl import flags
+from absl import app
+from modules import sdxl_model_utils, sdxl_train_utils, log_utils
+
+flags.DEFINE_string("checkpoint", None, "Path of an SDXL safetensors checkpoint, or of a delta checkpoint.")
+flags.DEFINE_string("output_dir", None, "Directory of the exported Diffusers model.")
+flags.DEFINE_enum("save_precision", None, ["float", "fp16", "bf16"], "Precision of the exported weights. Defaults to the precision of the checkpoint.")
+flags.DEFINE_string("tokenizer_cache_dir", "tokenizers", "Directory of the tokenizers cached by `load_tokenizers`. Tokenizers are left out if not cached.")
+flags.DEFINE_bool("use_mmap", False, "Read the checkpoint through a memory map.")
+
+SAVE_DTYPES = {"float": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def export_diffusers_checkpoint(argv):
+    FLAGS = flags.FLAGS
+    logger = log_utils.get_logger("export")
+    assert FLAGS.checkpoint.endswith(".safetensors") and os.path.isfile(FLAGS.checkpoint), \
+        f"not a safetensors checkpoint: {FLAGS.checkpoint} / safetensorsのチェックポイントではありません"
+    assert not os.path.exists(FLAGS.output_dir) or not os.listdir(FLAGS.output_dir), \
+        f"output directory is not empty: {FLAGS.output_dir} / 出力ディレクトリが空ではありません"
+
+    tokenizer_paths = [os.path.join(FLAGS.tokenizer_cache_dir, path.replace("/", "_")) for path in (sdxl_train_utils.TOKENIZER1_PATH, sdxl_train_utils.TOKENIZER2_PATH)]
+    logger.print(f"exporting `{log_utils.yellow(FLAGS.checkpoint)}`...")
+    key_counts = sdxl_model_utils.export_diffusers_checkpoint(
+        FLAGS.checkpoint,
+        FLAGS.output_dir,
+        save_dtype=SAVE_DTYPES.get(FLAGS.save_precision),
+        tokenizer_paths=tokenizer_paths,
+        use_mmap=FLAGS.use_mmap,
+    )
+    logger.print("  " + " | ".join(f"{name}: {count} keys" for name, count in key_counts.items()), no_prefix=True)
+    logger.print(log_utils.green(f"Diffusers model saved to: `{FLAGS.output_dir}`"))
+
+
+if __name__ == "__main__":
+    flags.mark_flags_as_required(["checkpoint", "output_dir"])
+    app.run(export_diffusers_checkpoint)
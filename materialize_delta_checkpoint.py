@@ -0,0 +1,27 @@
+import os
+from absl import flags
+from absl import app
+from modules import sdxl_model_utils, log_utils
+
+flags.DEFINE_string("delta", None, "Path of a delta checkpoint saved with `delta_save_kwargs.enable`.")
+flags.DEFINE_string("output", None, "Path of the full safetensors file. Defaults to the delta path without `.delta`.")
+flags.DEFINE_string("base", None, "Path of the base model. Defaults to the base model recorded in the delta checkpoint.")
+
+
+def materialize_delta_checkpoint(argv):
+    FLAGS = flags.FLAGS
+    logger = log_utils.get_logger("materialize")
+    assert sdxl_model_utils.is_delta_checkpoint(FLAGS.delta), f"not a delta checkpoint: {FLAGS.delta} / 差分チェックポイントではありません"
+    output = FLAGS.output or FLAGS.delta.replace(".delta.safetensors", ".safetensors")
+    assert output != FLAGS.delta and not os.path.exists(output), f"output already exists: {output} / 出力ファイルが既に存在します"
+
+    metadata = sdxl_model_utils.read_safetensors_metadata(FLAGS.delta)
+    logger.print(f"materializing `{log_utils.yellow(FLAGS.delta)}`...")
+    logger.print(f"  base: {FLAGS.base or metadata.get('base')} | mode: {metadata.get('mode')} | epoch: {metadata.get('epoch')} | global step: {metadata.get('global_step')}", no_prefix=True)
+    key_count = sdxl_model_utils.materialize_delta_checkpoint(FLAGS.delta, output, base_path=FLAGS.base)
+    logger.print(log_utils.green(f"full model with {key_count} keys saved to: `{output}`"))
+
+
+if __name__ == "__main__":
+    flags.mark_flags_as_required(["delta"])
+    app.run(materialize_delta_checkpoint)
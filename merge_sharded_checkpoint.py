@@ -0,0 +1,27 @@
+import os
+from absl import flags
+from absl import app
+from modules import checkpoint_utils, log_utils
+
+flags.DEFINE_string("input_dir", None, "Directory of a sharded model checkpoint saved with `sharded_save_kwargs.enable`.")
+flags.DEFINE_string("output", None, "Path of the merged safetensors file. Defaults to `input_dir` with the `.safetensors` extension.")
+
+
+def merge_sharded_checkpoint(argv):
+    FLAGS = flags.FLAGS
+    logger = log_utils.get_logger("merge")
+    input_dir = FLAGS.input_dir.rstrip("/\\")
+    assert checkpoint_utils.is_sharded_checkpoint(input_dir), \
+        f"not a complete sharded checkpoint, `{checkpoint_utils.MODEL_INDEX_NAME}` is missing: {input_dir} / シャードされたチェックポイントではありません"
+    output = FLAGS.output or input_dir + ".safetensors"
+    assert not os.path.exists(output), f"output already exists: {output} / 出力ファイルが既に存在します"
+
+    logger.print(f"merging `{log_utils.yellow(input_dir)}`...")
+    key_count, metadata = checkpoint_utils.merge_sharded_checkpoint(input_dir, output)
+    logger.print(f"  epoch: {metadata.get('epoch')} | global step: {metadata.get('global_step')} | shards: {metadata.get('num_shards')} | keys: {key_count}", no_prefix=True)
+    logger.print(log_utils.green(f"merged model saved to: `{output}`"))
+
+
+if __name__ == "__main__":
+    flags.mark_flags_as_required(["input_dir"])
+    app.run(merge_sharded_checkpoint)
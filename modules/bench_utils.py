@@ -0,0 +1,229 @@
+import os
+import re
+import time
+import zlib
+import torch
+from types import SimpleNamespace
+from typing import List
+from .profile_utils import percentile
+from . import log_utils
+
+logger = log_utils.get_logger("bench")
+
+
+class StubTokenizer:
+    r"""
+    Offline stand-in of `CLIPTokenizer` for benchmarks. Words are hashed into the vocabulary deterministically.
+    """
+
+    def __init__(self, model_max_length=77, vocab_size=49408, bos_token_id=49406, eos_token_id=49407, pad_token_id=49407):
+        self.model_max_length = model_max_length
+        self.vocab_size = vocab_size
+        self.bos_token_id = bos_token_id
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+
+    def tokenize(self, text):
+        return re.findall(r"\w+|[^\w\s]", text.lower())
+
+    def __call__(self, text, padding="max_length", truncation=True, max_length=None, return_tensors="pt"):
+        max_length = max_length or self.model_max_length
+        ids = [zlib.crc32(token.encode()) % (self.vocab_size - 2) for token in self.tokenize(text)]
+        if truncation:
+            ids = ids[:max_length - 2]
+        ids = [self.bos_token_id] + ids + [self.eos_token_id]
+        if padding == "max_length":
+            ids += [self.pad_token_id] * (max_length - len(ids))
+        return SimpleNamespace(input_ids=torch.tensor([ids], dtype=torch.long))
+
+
+def load_stub_tokenizers():
+    r"""
+    Stub tokenizers which mimic `sdxl_train_utils.load_tokenizers`: the second tokenizer pads with 0 like open clip.
+    """
+    return StubTokenizer(), StubTokenizer(pad_token_id=0)
+
+
+def get_rss(pid=None) -> int:
+    r"""
+    Resident set size in bytes of process `pid` (the current process by default).
+    """
+    pid = pid or os.getpid()
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def get_dataloader_worker_pids(iterator) -> List[int]:
+    workers = getattr(iterator, "_workers", None) or []
+    return [w.pid for w in workers if w.pid is not None]
+
+
+class Timer:
+    r"""
+    Collect durations of repeated events and summarize them.
+    """
+
+    def __init__(self):
+        self.durations = []
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.durations.append(time.perf_counter() - self._start)
+        return False
+
+    @property
+    def total(self):
+        return sum(self.durations)
+
+    def summary(self, skip=0) -> dict:
+        durations = self.durations[skip:] or self.durations
+        return dict(
+            count=len(durations),
+            mean=sum(durations) / len(durations) if durations else 0.,
+            p50=percentile(durations, 50),
+            p99=percentile(durations, 99),
+        )
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n) < 1024:
+            return f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}TB"
+
+
+class PeakMemoryMonitor:
+    r"""
+    Track peak memory of a code block: allocated CUDA memory on GPU, or sampled RSS growth of the process on CPU.
+    """
+
+    def __init__(self, device, interval=0.005):
+        self.device = torch.device(device)
+        self.interval = interval
+        self.peak = 0
+        self._baseline = 0
+        self._stop = None
+        self._thread = None
+
+    def __enter__(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._baseline = torch.cuda.memory_allocated(self.device)
+        else:
+            import threading
+            self._baseline = get_rss()
+            self.peak = self._baseline
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, get_rss())
+
+    def __exit__(self, *exc):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            self.peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, get_rss())
+        return False
+
+    @property
+    def peak_increase(self):
+        return max(0, self.peak - self._baseline)
+
+
+def make_tiny_text_encoders(hidden_size1=32, hidden_size2=64, projection_dim=64, num_hidden_layers=12, max_position_embeddings=77):
+    r"""
+    Randomly initialized CLIP text encoders with the SDXL layout but tiny widths.
+    Text encoder 1 needs at least 12 layers because its 11th hidden state is used.
+    """
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection
+
+    def make_config(hidden_size, **kwargs):
+        return CLIPTextConfig(
+            vocab_size=49408,
+            hidden_size=hidden_size,
+            intermediate_size=hidden_size * 4,
+            num_hidden_layers=num_hidden_layers,
+            num_attention_heads=max(1, hidden_size // 16),
+            max_position_embeddings=max_position_embeddings,
+            **kwargs,
+        )
+
+    text_encoder1 = CLIPTextModel(make_config(hidden_size1, hidden_act="quick_gelu"))
+    text_encoder2 = CLIPTextModelWithProjection(make_config(hidden_size2, hidden_act="gelu", projection_dim=projection_dim))
+    return text_encoder1, text_encoder2
+
+
+def make_tiny_unet(model_channels=32, transformer_depth=(0, 1, 1), context_dim=96, pooled_dim=64, num_head_channels=32):
+    r"""
+    Randomly initialized SDXL U-Net with reduced channels and transformer depth.
+    `context_dim` must match the sum of the hidden sizes of the text encoders, and `pooled_dim` the projection dim of text encoder 2.
+    """
+    from .sdxl_original_unet import SdxlUNet2DConditionModel
+    return SdxlUNet2DConditionModel(
+        model_channels=model_channels,
+        transformer_depth=transformer_depth,
+        context_dim=context_dim,
+        adm_in_channels=pooled_dim + 6 * 256,  # pooled text embedding + size embeddings of original size, crop and target size
+        num_head_channels=num_head_channels,
+    )
+
+
+def make_synthetic_batch(batch_size, width, height, tokenizer1, tokenizer2, max_token_length=None, generator=None):
+    r"""
+    A batch in the format returned by `sdxl_dataset_utils.Dataset.__getitem__`, with random latents and captions.
+    """
+    from .sdxl_dataset_utils import get_input_ids
+    latents = torch.randn(batch_size, 4, height // 8, width // 8, generator=generator)
+    words = ["1girl", "solo", "smile", "looking at viewer", "white background", "long hair", "school uniform", "outdoors"]
+    captions = [", ".join(words[(i + j) % len(words)] for j in range(5)) for i in range(batch_size)]
+    max_length = max_token_length or tokenizer1.model_max_length
+    return dict(
+        image_keys=[f"synthetic_{i}" for i in range(batch_size)],
+        images=None,
+        latents=latents,
+        captions=captions,
+        target_size_hw=torch.LongTensor([[height, width]] * batch_size),
+        original_size_hw=torch.LongTensor([[height, width]] * batch_size),
+        crop_top_lefts=torch.LongTensor([[0, 0]] * batch_size),
+        flipped=[False] * batch_size,
+        input_ids_1=torch.stack([get_input_ids(caption, tokenizer1, max_length) for caption in captions], dim=0),
+        input_ids_2=torch.stack([get_input_ids(caption, tokenizer2, max_length) for caption in captions], dim=0),
+    )
+
+
+def make_tiny_vae(block_out_channels=(32, 32, 64, 64), layers_per_block=1):
+    r"""
+    Randomly initialized `AutoencoderKL` with the SDXL layout (8x downscale, 4 latent channels and mid-block attention) but reduced channels.
+    """
+    from diffusers.models import AutoencoderKL
+    return AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D",) * len(block_out_channels),
+        up_block_types=("UpDecoderBlock2D",) * len(block_out_channels),
+        block_out_channels=tuple(block_out_channels),
+        latent_channels=4,
+        layers_per_block=layers_per_block,
+        norm_num_groups=min(32, min(block_out_channels)),
+    )
@@ -0,0 +1,718 @@
+import os
+import copy
+import json
+import time
+import shutil
+import hashlib
+import random
+import threading
+import traceback
+import numpy as np
+import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+from . import log_utils
+
+logger = log_utils.get_logger("ckpt")
+
+MODEL_INDEX_NAME = "model.safetensors.index.json"
+TRAIN_STATE_INDEX_NAME = "train_state.index.json"
+TRAIN_STATE_METADATA_NAME = "train_state.json"  # progress of a train state saved by `accelerator.save_state`
+
+DELTA_FORMAT = "sdxl_delta"
+DELTA_MODES = ("exact", "lowrank", "quantize")
+LORA_UP_SUFFIX = "::lora_up"
+LORA_DOWN_SUFFIX = "::lora_down"
+DELTA_Q_SUFFIX = "::delta_q"
+DELTA_SCALE_SUFFIX = "::delta_scale"
+
+
+class StateDictSnapshot:
+    r"""
+    Host copies of named state dicts. The host buffers are kept and reused by later snapshots of the same shapes.
+    Device tensors are copied into pinned buffers asynchronously; call `synchronize` before reading the copies.
+    """
+
+    def __init__(self, pin_memory=True):
+        self.pin_memory = pin_memory
+        self.buffers: Dict[str, Dict[str, torch.Tensor]] = {}
+        self.event = None
+
+    def _get_buffer(self, name, key, like: torch.Tensor) -> torch.Tensor:
+        buffers = self.buffers.setdefault(name, {})
+        buffer = buffers.get(key)
+        if buffer is None or buffer.shape != like.shape or buffer.dtype != like.dtype:
+            buffer = torch.empty(like.shape, dtype=like.dtype, pin_memory=self.pin_memory)
+            buffers[key] = buffer
+        return buffer
+
+    def copy_(self, name, state_dict, dtype: Optional[torch.dtype] = None) -> Dict[str, torch.Tensor]:
+        r"""
+        Copy `state_dict` into the host buffers of `name`, casting to `dtype` on the device first to halve the transfer of fp32 weights.
+        Returns a state dict of the host buffers.
+        """
+        host_state_dict = {}
+        for key, value in state_dict.items():
+            value = value.detach()
+            if dtype is not None:
+                value = value.to(dtype)
+            buffer = self._get_buffer(name, key, value)
+            buffer.copy_(value, non_blocking=self.pin_memory and value.is_cuda)
+            host_state_dict[key] = buffer
+        return host_state_dict
+
+    def record(self):
+        if torch.cuda.is_available():
+            self.event = torch.cuda.Event()
+            self.event.record()
+
+    def synchronize(self):
+        if self.event is not None:
+            self.event.synchronize()
+            self.event = None
+
+    @property
+    def nbytes(self):
+        return sum(buffer.numel() * buffer.element_size() for buffers in self.buffers.values() for buffer in buffers.values())
+
+
+class AsyncCheckpointSaver:
+    r"""
+    Save checkpoints from background threads. The state is snapshotted into host memory first, so training continues
+    while the checkpoint is converted and written. At most `max_in_flight` saves are pending at a time, and each pending save holds a host copy of the state.
+    """
+
+    def __init__(self, max_in_flight=1, pin_memory=True):
+        self.max_in_flight = max(1, max_in_flight)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._in_flight = deque()  # (thread, snapshot, path)
+        self._free_snapshots = []
+        self._errors = []
+        self._lock = threading.Lock()
+
+    @property
+    def num_in_flight(self):
+        return len(self._in_flight)
+
+    def _join_oldest(self):
+        thread, snapshot, _ = self._in_flight.popleft()
+        thread.join()
+        self._free_snapshots.append(snapshot)
+
+    def poll(self):
+        r"""
+        Release the snapshots of the finished saves and report their errors.
+        """
+        while self._in_flight and not self._in_flight[0][0].is_alive():
+            self._join_oldest()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        for path, e in errors:
+            logger.print(log_utils.red(f"failed to save `{path}` in background: {e}"))
+
+    def submit(self, path, state_dicts: Dict[str, dict], write_fn: Callable, dtype: Optional[torch.dtype] = None):
+        r"""
+        Snapshot the named `state_dicts` and call `write_fn(path, host_state_dicts)` in a background thread.
+        Blocks only for the snapshot, or for the oldest pending save if `max_in_flight` saves are pending.
+        """
+        self.poll()
+        if len(self._in_flight) >= self.max_in_flight:
+            t0 = time.perf_counter()
+            while len(self._in_flight) >= self.max_in_flight:
+                self._join_oldest()
+            logger.print(log_utils.yellow(f"waited {time.perf_counter() - t0:.1f}s for pending saves, consider saving less often or raising `max_in_flight`"))
+
+        t0 = time.perf_counter()
+        snapshot = self._free_snapshots.pop() if self._free_snapshots else StateDictSnapshot(self.pin_memory)
+        host_state_dicts = {name: snapshot.copy_(name, state_dict, dtype) for name, state_dict in state_dicts.items()}
+        snapshot.record()
+        thread = threading.Thread(target=self._worker, args=(path, snapshot, host_state_dicts, write_fn), name="checkpoint_saver")
+        thread.start()
+        self._in_flight.append((thread, snapshot, path))
+        logger.print(f"snapshot of {log_utils.yellow(path)} taken in {time.perf_counter() - t0:.2f}s, writing in background...")
+
+    def _worker(self, path, snapshot, host_state_dicts, write_fn):
+        try:
+            t0 = time.perf_counter()
+            snapshot.synchronize()
+            write_fn(path, host_state_dicts)
+            logger.print(f"saved to: `{log_utils.yellow(path)}` in {time.perf_counter() - t0:.1f}s")
+        except Exception as e:
+            traceback.print_exc()
+            with self._lock:
+                self._errors.append((path, e))
+
+    def wait(self):
+        r"""
+        Block until all pending saves are written.
+        """
+        if self._in_flight:
+            logger.print(f"waiting for {len(self._in_flight)} pending saves...")
+        while self._in_flight:
+            self._join_oldest()
+        self.poll()
+
+    def close(self):
+        self.wait()
+        self._free_snapshots.clear()  # release the pinned host memory
+
+
+def get_shard_name(prefix, rank, num_shards, ext):
+    return f"{prefix}-{rank:05d}-of-{num_shards:05d}{ext}"
+
+
+def get_shard_unit(key):
+    r"""
+    Group of `key` that is always written to the same shard: the key up to its first numeric fragment, e.g. a U-Net block,
+    a text encoder (`conditioner.embedders.0`) or an optimizer state of a parameter.
+    """
+    fragments = key.split(".")
+    for i, fragment in enumerate(fragments):
+        if fragment.isdigit():
+            return ".".join(fragments[:i + 1])
+    return key
+
+
+def partition_keys(sizes: Dict[str, int], num_shards) -> List[List[str]]:
+    r"""
+    Split the keys into `num_shards` groups of balanced total size, keeping the keys of a shard unit together.
+    The partition only depends on `sizes`, so every rank computes the same one.
+    """
+    units, unit_sizes = {}, {}
+    for key, size in sizes.items():
+        unit = get_shard_unit(key)
+        units.setdefault(unit, []).append(key)
+        unit_sizes[unit] = unit_sizes.get(unit, 0) + size
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+    for unit in sorted(units, key=lambda u: (-unit_sizes[u], u)):  # largest first onto the least loaded shard
+        i = min(range(num_shards), key=lambda i: (loads[i], i))
+        shards[i].extend(units[unit])
+        loads[i] += unit_sizes[unit]
+    return shards
+
+
+def _tensor_nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(_tensor_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_tensor_nbytes(v) for v in value)
+    return 0
+
+
+def _write_json(path, obj):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def write_train_state_metadata(save_dir, metadata: dict):
+    _write_json(os.path.join(save_dir, TRAIN_STATE_METADATA_NAME), metadata)
+
+
+def read_train_state_metadata(save_dir) -> Optional[dict]:
+    r"""
+    Progress of a train state saved by `accelerator.save_state`, or None for train states saved without it.
+    """
+    path = os.path.join(save_dir, TRAIN_STATE_METADATA_NAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def read_index(save_dir, index_name) -> dict:
+    with open(os.path.join(save_dir, index_name), "r") as f:
+        return json.load(f)
+
+
+def is_sharded_checkpoint(path, index_name=MODEL_INDEX_NAME):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, index_name))
+
+
+def save_state_dict_shard(save_dir, state_dict, rank, num_shards, prefix="model", dtype: Optional[torch.dtype] = None) -> Dict[str, str]:
+    r"""
+    Write the shard of `rank` of `state_dict` to `save_dir` as safetensors, cast to `dtype` if given.
+    Returns the weight map of all shards, i.e. the shard file name of every key.
+    """
+    from safetensors.torch import save_file
+
+    shards = partition_keys({key: value.numel() for key, value in state_dict.items()}, num_shards)
+    shard_names = [get_shard_name(prefix, i, num_shards, ".safetensors") for i in range(num_shards)]
+    shard_sd = {}
+    for key in shards[rank]:
+        value = state_dict[key].detach()
+        if dtype is not None:
+            value = value.to(dtype)
+        shard_sd[key] = value.to("cpu").contiguous()
+
+    os.makedirs(save_dir, exist_ok=True)
+    shard_path = os.path.join(save_dir, shard_names[rank])
+    save_file(shard_sd, shard_path + ".tmp")
+    os.replace(shard_path + ".tmp", shard_path)
+    return {key: shard_names[i] for i, keys in enumerate(shards) for key in keys}
+
+
+def load_sharded_state_dict(save_dir, index_name=MODEL_INDEX_NAME, max_workers=None, device="cpu"):
+    r"""
+    Read all shards of a sharded checkpoint in parallel threads. Returns the merged state dict and the metadata of the index.
+    """
+    from safetensors.torch import load_file
+
+    index = read_index(save_dir, index_name)
+    shard_names = sorted(set(index["weight_map"].values()))
+    with ThreadPoolExecutor(max_workers=max_workers or min(8, len(shard_names))) as executor:
+        shard_sds = list(executor.map(lambda name: load_file(os.path.join(save_dir, name), device=device), shard_names))
+    state_dict = {}
+    for shard_sd in shard_sds:
+        state_dict.update(shard_sd)
+    missing_keys = set(index["weight_map"]) - set(state_dict)
+    assert not missing_keys, f"missing keys in shards of {save_dir}: {sorted(missing_keys)[:5]} / シャードにキーがありません"
+    return state_dict, index.get("metadata", {})
+
+
+def merge_sharded_checkpoint(save_dir, output_path, index_name=MODEL_INDEX_NAME):
+    r"""
+    Merge a sharded model checkpoint into the single safetensors file which `sdxl_model_utils.save_stable_diffusion_checkpoint` writes.
+    """
+    from safetensors.torch import save_file
+
+    state_dict, metadata = load_sharded_state_dict(save_dir, index_name)
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    save_file(state_dict, output_path + ".tmp")
+    os.replace(output_path + ".tmp", output_path)
+    return len(state_dict), metadata
+
+
+def save_sharded_model(save_dir, state_dict, rank, num_shards, barrier: Callable, dtype=None, metadata=None):
+    r"""
+    Every rank writes its shard of `state_dict`, then rank 0 writes the index. A checkpoint without the index is incomplete.
+    """
+    weight_map = save_state_dict_shard(save_dir, state_dict, rank, num_shards, prefix="model", dtype=dtype)
+    barrier()
+    if rank == 0:
+        _write_json(os.path.join(save_dir, MODEL_INDEX_NAME), {"metadata": dict(metadata or {}, num_shards=num_shards), "weight_map": weight_map})
+
+
+def get_rng_states() -> dict:
+    states = dict(python=random.getstate(), numpy=np.random.get_state(), torch=torch.get_rng_state())
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state()
+    return states
+
+
+def set_rng_states(states: dict):
+    random.setstate(states["python"])
+    np.random.set_state(states["numpy"])
+    torch.set_rng_state(states["torch"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state(states["cuda"])
+
+
+def save_sharded_train_state(save_dir, rank, num_shards, barrier: Callable, models: Dict[str, torch.nn.Module], optimizer, lr_scheduler, scaler=None, metadata=None):
+    r"""
+    Save the train state in shards written by all ranks in parallel: the weights of `models`, the optimizer state partitioned by parameter,
+    and the random states of every rank. Rank 0 additionally writes the scheduler, the optimizer param groups and the index.
+    The optimizer state must be replicated across ranks, e.g. by DDP.
+    """
+    model_sd = {f"{name}.{key}": value for name, model in models.items() for key, value in model.state_dict().items()}
+    _write_train_state(
+        save_dir,
+        rank,
+        num_shards,
+        barrier,
+        model_names=list(models),
+        model_sd=model_sd,
+        optimizer_sd=optimizer.state_dict(),
+        lr_scheduler_sd=lr_scheduler.state_dict(),
+        scaler_sd=scaler.state_dict() if scaler is not None else None,
+        random_states=get_rng_states(),
+        metadata=metadata,
+    )
+
+
+def snapshot_train_state(models: Dict[str, torch.nn.Module], optimizer, lr_scheduler, scaler=None):
+    r"""
+    Split a train state for `AsyncCheckpointSaver.submit`: the tensors of the weights and of the optimizer state as named state dicts,
+    which are copied by the saver, and the other states, which are copied here. Write it with `write_train_state_snapshot`.
+    """
+    optimizer_sd = optimizer.state_dict()
+    state_dicts = {f"model.{name}": model.state_dict() for name, model in models.items()}
+    state_dicts["optimizer"] = {f"{i}.{k}": v for i, state in optimizer_sd["state"].items() for k, v in state.items() if isinstance(v, torch.Tensor)}
+    others = copy.deepcopy(dict(
+        model_names=list(models),
+        optimizer_state={i: {k: v for k, v in state.items() if not isinstance(v, torch.Tensor)} for i, state in optimizer_sd["state"].items()},
+        param_groups=optimizer_sd["param_groups"],
+        lr_scheduler_sd=lr_scheduler.state_dict(),
+        scaler_sd=scaler.state_dict() if scaler is not None else None,
+        random_states=get_rng_states(),
+    ))
+    return state_dicts, others
+
+
+def write_train_state_snapshot(save_dir, host_state_dicts: Dict[str, dict], others: dict, metadata=None):
+    r"""
+    Write a train state split by `snapshot_train_state` as a single shard, which is loaded by `load_sharded_train_state`.
+    """
+    model_sd = {f"{name}.{key}": value for name in others["model_names"] for key, value in host_state_dicts[f"model.{name}"].items()}
+    optimizer_state = copy.copy(others["optimizer_state"])
+    for key, value in host_state_dicts["optimizer"].items():
+        i, k = key.split(".", 1)
+        optimizer_state[int(i)] = dict(optimizer_state[int(i)], **{k: value})
+    _write_train_state(
+        save_dir,
+        0,
+        1,
+        lambda: None,
+        model_names=others["model_names"],
+        model_sd=model_sd,
+        optimizer_sd={"state": optimizer_state, "param_groups": others["param_groups"]},
+        lr_scheduler_sd=others["lr_scheduler_sd"],
+        scaler_sd=others["scaler_sd"],
+        random_states=others["random_states"],
+        metadata=metadata,
+    )
+
+
+def _write_train_state(save_dir, rank, num_shards, barrier: Callable, model_names, model_sd, optimizer_sd, lr_scheduler_sd, scaler_sd, random_states, metadata):
+    os.makedirs(save_dir, exist_ok=True)
+    weight_map = save_state_dict_shard(save_dir, model_sd, rank, num_shards, prefix="model")
+
+    optimizer_shards = partition_keys({str(i): _tensor_nbytes(state) for i, state in optimizer_sd["state"].items()}, num_shards)
+    optimizer_names = [get_shard_name("optimizer", i, num_shards, ".pt") for i in range(num_shards)]
+    optimizer_state = {int(i): optimizer_sd["state"][int(i)] for i in optimizer_shards[rank]}
+    torch.save({"state": optimizer_state}, os.path.join(save_dir, optimizer_names[rank]))
+
+    random_states_name = get_shard_name("random_states", rank, num_shards, ".pt")
+    torch.save(random_states, os.path.join(save_dir, random_states_name))
+
+    if rank == 0:
+        torch.save(
+            {
+                "param_groups": optimizer_sd["param_groups"],
+                "lr_scheduler": lr_scheduler_sd,
+                "scaler": scaler_sd,
+            },
+            os.path.join(save_dir, "train_state.pt"),
+        )
+    barrier()
+    if rank == 0:
+        _write_json(
+            os.path.join(save_dir, TRAIN_STATE_INDEX_NAME),
+            {
+                "metadata": dict(metadata or {}, num_shards=num_shards, models=list(model_names)),
+                "weight_map": weight_map,
+                "optimizer_files": optimizer_names,
+            },
+        )
+
+
+def load_sharded_train_state(save_dir, rank, models: Dict[str, torch.nn.Module], optimizer, lr_scheduler, scaler=None, max_workers=None) -> dict:
+    r"""
+    Load a train state saved by `save_sharded_train_state`. Every rank reads all shards in parallel threads.
+    Returns the metadata of the index.
+    """
+    index = read_index(save_dir, TRAIN_STATE_INDEX_NAME)
+    metadata = index["metadata"]
+    model_sd, _ = load_sharded_state_dict(save_dir, TRAIN_STATE_INDEX_NAME, max_workers=max_workers)
+    for name, model in models.items():
+        if name not in metadata["models"]:
+            logger.print(log_utils.yellow(f"`{name}` is not in the train state, keep its current weights"))
+            continue
+        prefix = name + "."
+        model.load_state_dict({key[len(prefix):]: value for key, value in model_sd.items() if key.startswith(prefix)}, strict=True)
+    del model_sd
+
+    optimizer_files = index["optimizer_files"]
+    with ThreadPoolExecutor(max_workers=max_workers or min(8, len(optimizer_files))) as executor:
+        optimizer_shards = list(executor.map(lambda name: torch.load(os.path.join(save_dir, name), map_location="cpu"), optimizer_files))
+    train_state = torch.load(os.path.join(save_dir, "train_state.pt"), map_location="cpu")
+    optimizer_state = {}
+    for shard in optimizer_shards:
+        optimizer_state.update(shard["state"])
+    optimizer.load_state_dict({"state": optimizer_state, "param_groups": train_state["param_groups"]})
+    lr_scheduler.load_state_dict(train_state["lr_scheduler"])
+    if scaler is not None and train_state["scaler"] is not None:
+        scaler.load_state_dict(train_state["scaler"])
+
+    random_states_path = os.path.join(save_dir, get_shard_name("random_states", rank, metadata["num_shards"], ".pt"))
+    if os.path.isfile(random_states_path):
+        set_rng_states(torch.load(random_states_path))
+    return metadata
+
+
+def get_file_fingerprint(path) -> str:
+    r"""
+    Cheap fingerprint of a safetensors file: the hash of its size and header, which covers the names, shapes and offsets of all tensors.
+    """
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = f.read(header_size)
+    return hashlib.sha1(str(os.path.getsize(path)).encode() + header).hexdigest()
+
+
+def tensor_hash(tensor: torch.Tensor) -> str:
+    tensor = tensor.detach().to("cpu").contiguous()
+    return hashlib.sha1(str((tuple(tensor.shape), tensor.dtype)).encode() + tensor.reshape(-1).view(torch.uint8).numpy().tobytes()).hexdigest()
+
+
+def _as_2d(tensor):
+    return tensor.reshape(tensor.shape[0], -1)
+
+
+def apply_delta(base: torch.Tensor, delta_tensors: Dict[str, torch.Tensor], key, dtype: Optional[torch.dtype] = None) -> torch.Tensor:
+    r"""
+    Tensor `key` of a delta checkpoint: stored as is, or `base` plus a low-rank or quantized diff. Cast to `dtype` if given.
+    """
+    if key in delta_tensors:
+        value = delta_tensors[key]
+    elif key + LORA_UP_SUFFIX in delta_tensors:
+        diff = delta_tensors[key + LORA_UP_SUFFIX].float() @ delta_tensors[key + LORA_DOWN_SUFFIX].float()
+        value = base.float() + diff.reshape(base.shape)
+    elif key + DELTA_Q_SUFFIX in delta_tensors:
+        diff = delta_tensors[key + DELTA_Q_SUFFIX].float() * delta_tensors[key + DELTA_SCALE_SUFFIX].float()[:, None]
+        value = base.float() + diff.reshape(base.shape)
+    else:
+        value = base
+    return value.to(dtype) if dtype is not None else value
+
+
+def get_delta_source_keys(delta_keys) -> set:
+    r"""
+    Keys of the checkpoint which have an entry in a delta checkpoint with `delta_keys`.
+    """
+    return {key.split("::", 1)[0] for key in delta_keys}
+
+
+class DeltaCheckpointWriter:
+    r"""
+    Write checkpoints as deltas against the base model `base_path`, a safetensors SDXL checkpoint.
+    Tensors equal to the base after the cast to the save dtype are skipped by hash, e.g. the VAE and the frozen text encoders.
+    The changed tensors are stored as is (`exact`), or as diffs against the base: truncated SVD factors of rank `rank` (`lowrank`)
+    or int8 with per-row scales (`quantize`). Both diff modes are lossy and only apply to tensors with at least 2 dimensions.
+    Tensors under `static_prefixes` never change during training, so their comparison with the base is done only once.
+    """
+
+    def __init__(self, base_path, mode="exact", rank=64, static_prefixes=()):
+        assert mode in DELTA_MODES, f"unknown delta mode: {mode}, must be one of {DELTA_MODES} / 不明な差分モードです: {mode}"
+        self.base_path = os.path.abspath(base_path)
+        self.base_fingerprint = get_file_fingerprint(self.base_path)
+        self.mode = mode
+        self.rank = rank
+        self.static_prefixes = tuple(static_prefixes)
+        self._base_hashes = None
+        self._base_hashes_dtype = None
+        self._static_unchanged = set()
+        self._lock = threading.Lock()
+
+    def _get_base_hashes(self, dtype):
+        with self._lock:
+            if self._base_hashes is None or self._base_hashes_dtype != dtype:
+                from safetensors import safe_open
+                logger.print("hashing base model tensors for delta checkpoints...")
+                hashes = {}
+                with safe_open(self.base_path, framework="pt", device="cpu") as f:
+                    for key in f.keys():
+                        tensor = f.get_tensor(key)
+                        hashes[key] = tensor_hash(tensor.to(dtype) if dtype is not None else tensor)
+                self._base_hashes, self._base_hashes_dtype = hashes, dtype
+            return self._base_hashes
+
+    def _make_diff(self, key, value, base) -> Dict[str, torch.Tensor]:
+        diff = _as_2d(value.float() - base.to(value.device).float())
+        if self.mode == "lowrank":
+            rank = min(self.rank, *diff.shape)
+            if rank * sum(diff.shape) >= diff.numel():  # factors are not smaller than the tensor
+                return None
+            u, s, v = torch.svd_lowrank(diff, q=rank, niter=2)
+            return {key + LORA_UP_SUFFIX: (u * s).contiguous(), key + LORA_DOWN_SUFFIX: v.T.contiguous()}
+        if self.mode == "quantize":
+            scale = diff.abs().amax(dim=1).clamp(min=1e-12) / 127
+            q = (diff / scale[:, None]).round().clamp(-127, 127).to(torch.int8)
+            return {key + DELTA_Q_SUFFIX: q, key + DELTA_SCALE_SUFFIX: scale}
+        return None
+
+    def save(self, fp, state_dict: Dict[str, torch.Tensor], save_dtype: Optional[torch.dtype] = None, metadata: Optional[dict] = None):
+        r"""
+        Write the delta of the checkpoint `state_dict` to `fp` atomically. Returns the numbers of stored and skipped tensors.
+        """
+        from safetensors import safe_open
+        from safetensors.torch import save_file
+
+        base_hashes = self._get_base_hashes(save_dtype)
+        delta_sd = {}
+        num_skipped = 0
+        with safe_open(self.base_path, framework="pt", device="cpu") as base:
+            for key, value in state_dict.items():
+                if key in self._static_unchanged:
+                    num_skipped += 1
+                    continue
+                value = value.detach()
+                if save_dtype is not None:
+                    value = value.to(save_dtype)
+                if key in base_hashes and tensor_hash(value) == base_hashes[key]:
+                    if key.startswith(self.static_prefixes):
+                        self._static_unchanged.add(key)
+                    num_skipped += 1
+                    continue
+                diff = None
+                if self.mode != "exact" and key in base_hashes and value.is_floating_point() and value.dim() >= 2:
+                    base_value = base.get_tensor(key)
+                    if base_value.shape == value.shape:
+                        diff = self._make_diff(key, value, base_value)
+                if diff is not None:
+                    for k, v in diff.items():
+                        if save_dtype is not None and k.endswith((LORA_UP_SUFFIX, LORA_DOWN_SUFFIX)):
+                            v = v.to(save_dtype)  # int8 diffs keep their fp32 scales
+                        delta_sd[k] = v.to("cpu")
+                else:
+                    delta_sd[key] = value.to("cpu").contiguous()
+
+        dropped_keys = sorted(base_hashes.keys() - state_dict.keys())
+        delta_metadata = {
+            "format": DELTA_FORMAT,
+            "mode": self.mode,
+            "base": self.base_path,
+            "base_fingerprint": self.base_fingerprint,
+            "dtype": str(save_dtype).replace("torch.", "") if save_dtype is not None else "",
+            "dropped_keys": json.dumps(dropped_keys),
+        }
+        delta_metadata.update({k: str(v) for k, v in (metadata or {}).items()})
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        save_file(delta_sd, fp + ".tmp", metadata=delta_metadata)
+        os.replace(fp + ".tmp", fp)
+        return len(state_dict) - num_skipped, num_skipped
+
+
+def verify_safetensors(path):
+    r"""
+    Check that the header of a safetensors file is complete and the file size matches the tensor data it declares.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        if 8 + header_size > size:
+            raise ValueError(f"truncated header: {path}")
+        header = json.loads(f.read(header_size))
+    data_size = max((info["data_offsets"][1] for key, info in header.items() if key != "__metadata__"), default=0)
+    if 8 + header_size + data_size != size:
+        raise ValueError(f"file size {size} does not match the header, expected {8 + header_size + data_size}: {path}")
+
+
+def verify_checkpoint(path):
+    r"""
+    Check a saved checkpoint: a safetensors file, or a directory, e.g. a train state or a sharded checkpoint, whose safetensors files are checked
+    and whose index files must only refer to existing shards. Raises if the checkpoint is incomplete.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"checkpoint not found: {path}")
+    if not os.path.isdir(path):
+        if path.endswith(".safetensors"):
+            verify_safetensors(path)
+        elif os.path.getsize(path) == 0:
+            raise ValueError(f"empty file: {path}")
+        return
+    filenames = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+    if not filenames:
+        raise ValueError(f"empty directory: {path}")
+    for filename in filenames:
+        if filename.endswith(".tmp"):
+            raise ValueError(f"unfinished file: {filename}")
+        if filename.endswith(".safetensors"):
+            verify_safetensors(filename)
+        elif filename.endswith(".index.json"):
+            with open(filename, "r") as f:
+                index = json.load(f)
+            for name in set(index.get("weight_map", {}).values()) | set(index.get("optimizer_files", [])):
+                if not os.path.isfile(os.path.join(os.path.dirname(filename), name)):
+                    raise FileNotFoundError(f"shard `{name}` of `{filename}` not found")
+
+
+class CheckpointRetentionManager:
+    r"""
+    Verify saved checkpoints and prune superseded ones from a background thread, so that saving never blocks on cleanup.
+    Checkpoints are grouped by kind, e.g. models and train states. A verified checkpoint is kept if it is one of the last `keep_last_n`,
+    its step is a multiple of `keep_every_n_steps`, or it is one of the `keep_best_n` best by its metric (lower is better for `metric_mode='min'`).
+    With `keep_last_n=None` nothing is deleted. Checkpoints which fail the verification are reported and neither kept nor deleted.
+    Only the checkpoints registered in this run are managed.
+    """
+
+    def __init__(self, keep_last_n=None, keep_every_n_steps=None, keep_best_n=0, metric_mode='min', verify=True):
+        assert metric_mode in ('min', 'max'), f"metric_mode must be `min` or `max`, got {metric_mode}"
+        self.keep_last_n = keep_last_n
+        self.keep_every_n_steps = keep_every_n_steps
+        self.keep_best_n = keep_best_n
+        self.metric_mode = metric_mode
+        self.verify = verify
+        self._records: Dict[str, List[dict]] = {}
+
+        import queue
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, name="checkpoint_retention", daemon=True)
+        self._thread.start()
+
+    def register(self, kind, path, step, metric: Optional[float] = None):
+        r"""
+        Add a checkpoint which has been completely written. Thread-safe.
+        """
+        self._queue.put((kind, path, step, metric))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                kind, path, step, metric = item
+                if self.verify:
+                    try:
+                        verify_checkpoint(path)
+                    except Exception as e:
+                        logger.print(log_utils.red(f"checkpoint verification failed, it will not be counted for retention: {e}"))
+                        continue
+                self._records.setdefault(kind, []).append(dict(path=path, step=step, metric=metric))
+                self._prune(kind)
+            except Exception as e:
+                logger.print(log_utils.red(f"exception when managing checkpoints: {e}"))
+            finally:
+                self._queue.task_done()
+
+    def get_kept_paths(self, records) -> set:
+        if self.keep_last_n is None:
+            return {r["path"] for r in records}
+        records = sorted(records, key=lambda r: r["step"])
+        keep = {r["path"] for r in records[-self.keep_last_n:]} if self.keep_last_n > 0 else set()
+        if self.keep_every_n_steps:
+            keep |= {r["path"] for r in records if r["step"] % self.keep_every_n_steps == 0}
+        if self.keep_best_n:
+            scored = [r for r in records if r["metric"] is not None]
+            scored.sort(key=lambda r: r["metric"], reverse=self.metric_mode == 'max')
+            keep |= {r["path"] for r in scored[:self.keep_best_n]}
+        return keep
+
+    def _prune(self, kind):
+        records = self._records[kind]
+        keep = self.get_kept_paths(records)
+        for record in [r for r in records if r["path"] not in keep]:
+            path = record["path"]
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+            records.remove(record)
+            logger.print(f"removed superseded {kind} checkpoint: `{log_utils.yellow(path)}`")
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
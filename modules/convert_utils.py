@@ -0,0 +1,211 @@
+import functools
+import torch
+from torch.overrides import TorchFunctionMode
+from typing import Callable, Dict
+from . import log_utils
+
+logger = log_utils.get_logger("convert")
+
+_PLANS: Dict[tuple, "ConversionPlan"] = {}
+_UNPLANNABLE = object()
+
+
+class _CatRecorder(TorchFunctionMode):
+    r"""
+    Record the inputs of `torch.cat`, the only op of the conversions whose output is not a view of its inputs.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.cats = {}
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        output = func(*args, **kwargs)
+        if func is torch.cat:
+            tensors = args[0] if args else kwargs["tensors"]
+            dim = args[1] if len(args) > 1 else kwargs.get("dim", 0)
+            self.cats[id(output)] = (list(tensors), dim, output)  # keep the output alive so that its id is not reused
+        return output
+
+
+def _signature(fn, args) -> tuple:
+    r"""
+    Cache key of a conversion: the function and the keys, shapes and dtypes of the state dicts, or the values of the other arguments.
+    """
+    signature = [fn.__module__, fn.__qualname__]
+    for arg in args:
+        if isinstance(arg, dict) and all(isinstance(v, torch.Tensor) for v in arg.values()):
+            signature.append(tuple((k, tuple(v.shape), v.dtype) for k, v in arg.items()))
+        elif isinstance(arg, torch.Tensor):
+            signature.append((tuple(arg.shape), arg.dtype))
+        elif isinstance(arg, dict):
+            signature.append(repr(sorted(arg.items())))
+        else:
+            signature.append(repr(arg))
+    return tuple(signature)
+
+
+def _to_meta(arg, sources, path):
+    if isinstance(arg, torch.Tensor):
+        meta = torch.empty(arg.shape, dtype=arg.dtype, device="meta")
+        sources[id(meta)] = (path, None, meta)
+        return meta
+    if isinstance(arg, dict) and all(isinstance(v, torch.Tensor) for v in arg.values()):
+        metas = {}
+        for k, v in arg.items():
+            meta = torch.empty(v.shape, dtype=v.dtype, device="meta")
+            sources[id(meta)] = (path, k, meta)
+            metas[k] = meta
+        return metas
+    return arg
+
+
+class ConversionPlan:
+    r"""
+    Static plan of a state dict conversion, compiled by running the conversion once on meta tensors.
+    Every output tensor is a source tensor, a view of one (size, stride and storage offset), a concatenation of such tensors, or a constant,
+    so that applying the plan is a single pass over the keys without any string rewriting.
+    """
+
+    def __init__(self, fn, args):
+        sources = {}
+        meta_args = [_to_meta(arg, sources, i) for i, arg in enumerate(args)]
+        recorder = _CatRecorder()
+        with recorder:
+            output = fn(*meta_args)
+        self.cats = recorder.cats
+        self.sources = sources
+        self.spec = self._trace_output(output)
+        del self.cats, self.sources  # only needed while tracing
+
+    def _trace(self, tensor):
+        if id(tensor) in self.sources:
+            path, key, _ = self.sources[id(tensor)]
+            return ("source", path, key, None)
+        base = tensor._base
+        if base is not None and id(base) in self.sources:
+            path, key, _ = self.sources[id(base)]
+            return ("source", path, key, (tuple(tensor.size()), tensor.stride(), tensor.storage_offset()))
+        if id(tensor) in self.cats:
+            tensors, dim, _ = self.cats[id(tensor)]
+            return ("cat", [self._trace(t) for t in tensors], dim)
+        if tensor.device.type != "meta":
+            return ("constant", tensor)
+        raise ValueError(f"output tensor of shape {tuple(tensor.shape)} can not be traced back to the inputs")
+
+    def _trace_output(self, output):
+        if output is None:
+            return None
+        if isinstance(output, torch.Tensor):
+            return ("tensor", self._trace(output))
+        if isinstance(output, dict):
+            return ("dict", [(k, self._trace(v)) for k, v in output.items()])
+        if isinstance(output, tuple):
+            return ("tuple", [self._trace_output(o) for o in output])
+        raise ValueError(f"unsupported output type of a conversion: {type(output)}")
+
+    @staticmethod
+    def _resolve(op, args):
+        kind = op[0]
+        if kind == "source":
+            _, path, key, view = op
+            tensor = args[path] if key is None else args[path][key]
+            if view is None:
+                return tensor
+            if not tensor.is_contiguous():  # views were planned on contiguous tensors
+                tensor = tensor.contiguous()
+            size, stride, offset = view
+            return tensor.as_strided(size, stride, tensor.storage_offset() + offset)
+        if kind == "cat":
+            _, ops, dim = op
+            return torch.cat([ConversionPlan._resolve(o, args) for o in ops], dim)
+        return op[1].clone()  # constant
+
+    def _apply_output(self, spec, args):
+        if spec is None:
+            return None
+        kind, value = spec
+        if kind == "tensor":
+            return self._resolve(value, args)
+        if kind == "dict":
+            return {k: self._resolve(op, args) for k, op in value}
+        return tuple(self._apply_output(s, args) for s in value)
+
+    def apply(self, *args):
+        return self._apply_output(self.spec, args)
+
+
+def get_plan(fn, args):
+    signature = _signature(fn, args)
+    plan = _PLANS.get(signature)
+    if plan is None:
+        try:
+            plan = ConversionPlan(fn, args)
+        except Exception as e:  # e.g. the conversion depends on tensor values
+            logger.print(log_utils.yellow(f"can not plan `{fn.__qualname__}`, convert without a plan: {e}"))
+            plan = _UNPLANNABLE
+        _PLANS[signature] = plan
+    return plan
+
+
+def clear_plans():
+    _PLANS.clear()
+
+
+def planned(fn: Callable):
+    r"""
+    Cache the conversion `fn` as a `ConversionPlan` per architecture, i.e. per keys and shapes of the input state dicts.
+    The first call of an architecture compiles the plan on meta tensors, later calls only apply it. The original function is `fn.__wrapped__`.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args):
+        plan = get_plan(fn, args)
+        if plan is _UNPLANNABLE:
+            return fn(*args)
+        return plan.apply(*args)
+    return wrapper
+
+
+def _compare(reference, output, path, input_ids):
+    if reference is None or output is None:
+        if reference is not output:
+            raise AssertionError(f"{path}: {reference!r} != {output!r}")
+        return
+    if isinstance(reference, dict):
+        if list(reference.keys()) != list(output.keys()):
+            missing, unexpected = reference.keys() - output.keys(), output.keys() - reference.keys()
+            raise AssertionError(f"{path}: keys differ, missing: {sorted(missing)[:5]}, unexpected: {sorted(unexpected)[:5]}, or in another order")
+        for k in reference:
+            _compare(reference[k], output[k], f"{path}[{k!r}]", input_ids)
+        return
+    if isinstance(reference, tuple):
+        for i, (r, o) in enumerate(zip(reference, output)):
+            _compare(r, o, f"{path}[{i}]", input_ids)
+        return
+    if reference.shape != output.shape or reference.dtype != output.dtype:
+        raise AssertionError(f"{path}: {tuple(reference.shape)} {reference.dtype} != {tuple(output.shape)} {output.dtype}")
+    if reference.device.type == "meta" or output.device.type == "meta":
+        # meta tensors have no values: the same view of the same input tensor is the same output
+        reference_base = reference if reference._base is None else reference._base
+        output_base = output if output._base is None else output._base
+        if id(reference_base) in input_ids and (reference_base is not output_base or reference.stride() != output.stride()
+                                               or reference.storage_offset() != output.storage_offset()):
+            raise AssertionError(f"{path}: not the same view of the same input tensor")
+    elif not torch.equal(reference, output):
+        raise AssertionError(f"{path}: values differ")
+
+
+def check_plan(fn, *args):
+    r"""
+    Check that the planned conversion `fn` returns the same output as the original function for `args`: the same keys in the same order,
+    shapes and dtypes, and equal values, or the same views of the same source tensors for meta tensors. Raises `AssertionError` if not.
+    """
+    original = getattr(fn, "__wrapped__", fn)
+    input_ids = set()
+    for arg in args:
+        if isinstance(arg, torch.Tensor):
+            input_ids.add(id(arg))
+        elif isinstance(arg, dict):
+            input_ids.update(id(v) for v in arg.values() if isinstance(v, torch.Tensor))
+    _compare(original(*args), fn(*args), original.__qualname__, input_ids)
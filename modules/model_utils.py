@@ -15,7 +15,7 @@ import diffusers
 from transformers import CLIPTextModel, CLIPTokenizer, CLIPTextConfig
 from diffusers import AutoencoderKL, DDIMScheduler, StableDiffusionPipeline  # , UNet2DConditionModel
 from safetensors.torch import load_file, save_file
-from . import log_utils
+from . import convert_utils, log_utils
 
 logger = log_utils.get_logger("model")
 
@@ -399,6 +399,7 @@ def convert_ldm_unet_checkpoint(v2, checkpoint, config):
     return new_checkpoint
 
 
+@convert_utils.planned
 def convert_ldm_vae_checkpoint(checkpoint, config):
     # extract state dict for VAE
     vae_state_dict = {}
@@ -878,6 +879,7 @@ def reshape_weight_for_sd(w):
     return w.reshape(*w.shape, 1, 1)
 
 
+@convert_utils.planned
 def convert_vae_state_dict(vae_state_dict):
     vae_conversion_map = [
         # (stable-diffusion, HF Diffusers)
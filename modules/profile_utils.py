@@ -0,0 +1,394 @@
+import os
+import time
+import json
+import math
+import contextlib
+import torch
+from typing import List, Tuple
+from . import log_utils
+
+logger = log_utils.get_logger("profile")
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def parse_step_ranges(step_ranges) -> List[Tuple[int, int]]:
+    r"""
+    Parse step ranges from `"10-20,100-110"`, `[10, 20]` or `[[10, 20], [100, 110]]` into a list of closed intervals.
+    """
+    if not step_ranges:
+        return []
+    if isinstance(step_ranges, str):
+        ranges = []
+        for part in step_ranges.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            start, _, end = part.partition("-")
+            ranges.append((int(start), int(end or start)))
+        return ranges
+    if len(step_ranges) == 2 and all(isinstance(s, int) for s in step_ranges):
+        return [tuple(step_ranges)]
+    return [(int(start), int(end)) for start, end in step_ranges]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+class _Phase:
+    __slots__ = ("profiler", "name", "cuda", "start")
+
+    def __init__(self, profiler, name, cuda):
+        self.profiler = profiler
+        self.name = name
+        self.cuda = cuda
+        self.start = None
+
+    def __enter__(self):
+        if self.cuda:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.cuda:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self.profiler._pending.append((self.name, self.profiler._step, self.start, end))
+        else:
+            end = time.perf_counter()
+            self.profiler._add(self.name, self.profiler._step, (self.start - self.profiler._host_origin) * 1e3, (end - self.start) * 1e3, cuda=False)
+        return False
+
+
+class PhaseProfiler:
+    r"""
+    Lightweight timer of the phases of a training step.
+    Device phases are timed by CUDA events when available and host phases by `time.perf_counter`.
+    """
+
+    def __init__(
+        self,
+        enable=False,
+        use_cuda_events=True,
+        report_every_n_steps=100,
+        percentiles=(50, 90, 99),
+        trace_steps=None,
+        trace_path=None,
+    ):
+        self.enable = enable
+        self.use_cuda_events = bool(use_cuda_events and torch.cuda.is_available())
+        self.report_every_n_steps = report_every_n_steps
+        self.percentiles = tuple(percentiles)
+        self.trace_ranges = parse_step_ranges(trace_steps)
+        self.trace_path = trace_path
+
+        self._step = 0
+        self._last_report_step = 0
+        self._durations = {}  # phase name -> list of durations in ms since the last report
+        self._pending = []  # unresolved cuda events
+        self._trace_events = []
+        self._trace_exported = False
+        self._host_origin = time.perf_counter()
+        self._cuda_origin = None
+        if self.enable and self.use_cuda_events:
+            self._cuda_origin = torch.cuda.Event(enable_timing=True)
+            self._cuda_origin.record()
+
+    def phase(self, name, cuda=True):
+        r"""
+        Context manager which times a phase. Set `cuda=False` for phases which only wait on the host, e.g. dataloader.
+        """
+        if not self.enable:
+            return _NULL_CONTEXT
+        return _Phase(self, name, cuda and self.use_cuda_events)
+
+    def iter(self, iterable, name="dataloader"):
+        r"""
+        Wrap an iterable so that waiting for its next item is timed as a host phase.
+        """
+        if not self.enable:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name, cuda=False):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def is_tracing(self, step=None):
+        step = self._step if step is None else step
+        return any(start <= step <= end for start, end in self.trace_ranges)
+
+    def _add(self, name, step, start_ms, duration_ms, cuda):
+        self._durations.setdefault(name, []).append(duration_ms)
+        if self.trace_ranges and self.is_tracing(step):
+            self._trace_events.append({
+                "name": name,
+                "cat": "cuda" if cuda else "host",
+                "ph": "X",
+                "ts": start_ms * 1e3,
+                "dur": duration_ms * 1e3,
+                "pid": 0,
+                "tid": 1 if cuda else 0,
+                "args": {"step": step},
+            })
+
+    def _resolve(self):
+        if not self._pending:
+            return
+        self._pending[-1][3].synchronize()
+        for name, step, start, end in self._pending:
+            self._add(name, step, self._cuda_origin.elapsed_time(start), start.elapsed_time(end), cuda=True)
+        self._pending.clear()
+
+    def step(self, step: int):
+        r"""
+        Mark the end of a loop iteration. `step` is the current global step, which is used for reports and traces.
+        """
+        if not self.enable:
+            return
+        self._step = step
+        if len(self._pending) >= 1024:  # bound the number of unresolved events
+            self._resolve()
+        if self.report_every_n_steps and step - self._last_report_step >= self.report_every_n_steps:
+            self._resolve()
+            self.report()
+            self._last_report_step = step
+        if self.trace_ranges and not self._trace_exported and step > max(end for _, end in self.trace_ranges):
+            self._resolve()
+            self.export_trace()
+
+    def summary(self) -> dict:
+        self._resolve()
+        summary = {}
+        for name, durations in self._durations.items():
+            stats = {"count": len(durations), "mean": sum(durations) / len(durations), "total": sum(durations)}
+            for q in self.percentiles:
+                stats[f"p{q}"] = percentile(durations, q)
+            summary[name] = stats
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        if not summary:
+            return
+        total = sum(stats["total"] for stats in summary.values())
+        logger.print(f"phase timings (ms) over steps {self._last_report_step}-{self._step}:")
+        for name, stats in sorted(summary.items(), key=lambda item: -item[1]["total"]):
+            pcts = " | ".join(f"p{q}: {stats['p%d' % q]:.2f}" for q in self.percentiles)
+            share = stats["total"] / total if total else 0
+            logger.print(f"  {name:<16} mean: {stats['mean']:.2f} | {pcts} | share: {log_utils.yellow(share, format_spec='.1%')}", no_prefix=True)
+        self._durations.clear()
+
+    def export_trace(self, path=None):
+        r"""
+        Export the traced steps as a Chrome trace JSON, which can be opened in `chrome://tracing` or Perfetto.
+        """
+        path = path or self.trace_path
+        self._trace_exported = True
+        if not path or not self._trace_events:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self._trace_events, "displayTimeUnit": "ms"}, f)
+        logger.print(f"chrome trace exported to: `{log_utils.yellow(path)}`")
+        self._trace_events = []
+
+    def close(self):
+        if not self.enable:
+            return
+        self._resolve()
+        if self._durations:
+            self.report()
+        if self.trace_ranges and not self._trace_exported:
+            self.export_trace()
+
+
+class DataloaderMonitor:
+    r"""
+    Monitor whether training is data-bound or compute-bound.
+    Combines the time the training loop waits on the dataloader with the per-stage time recorded by dataset workers.
+    """
+
+    def __init__(
+        self,
+        enable=False,
+        num_workers=0,
+        report_every_n_batches=100,
+        data_bound_threshold=0.1,
+    ):
+        self.enable = enable
+        self.num_workers = num_workers
+        self.report_every_n_batches = report_every_n_batches
+        self.data_bound_threshold = data_bound_threshold
+        self._num_batches = 0
+        self._reset()
+
+    def _reset(self):
+        self._waits = []
+        self._computes = []
+        self._queue_latencies = []
+        self._stage_times = {}
+
+    def iter(self, iterable):
+        r"""
+        Wrap the dataloader of the training loop. The `worker_stats` entry of each batch is consumed here.
+        """
+        if not self.enable:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            t1 = time.perf_counter()
+            self._waits.append(t1 - t0)
+            worker_stats = batch.pop("worker_stats", None) if isinstance(batch, dict) else None
+            if worker_stats is not None:
+                self._queue_latencies.append(max(0., time.time() - worker_stats["ready_time"]))
+                for stage, t in worker_stats["stage_times"].items():
+                    self._stage_times.setdefault(stage, []).append(t)
+            yield batch
+            self._computes.append(time.perf_counter() - t1)
+            self._num_batches += 1
+            if self.report_every_n_batches and self._num_batches % self.report_every_n_batches == 0:
+                self.report()
+
+    def verdict(self) -> dict:
+        if not self._computes:
+            return {}
+        n = len(self._computes)
+        wait = sum(self._waits[:n]) / n
+        compute = sum(self._computes) / n
+        worker = sum(self._stage_times["total"]) / len(self._stage_times["total"]) if "total" in self._stage_times else None
+        queue_latency = sum(self._queue_latencies) / len(self._queue_latencies) if self._queue_latencies else None
+        wait_ratio = wait / (wait + compute) if wait + compute > 0 else 0.
+        verdict = dict(
+            wait=wait,
+            compute=compute,
+            wait_ratio=wait_ratio,
+            data_bound=wait_ratio > self.data_bound_threshold,
+            worker=worker,
+            queue_latency=queue_latency,
+            # Little's law: batches in the queue = arrival rate x time in the queue
+            queue_depth=queue_latency / (wait + compute) if queue_latency is not None and wait + compute > 0 else None,
+            stages={stage: sum(ts) / len(ts) for stage, ts in self._stage_times.items() if stage != "total"},
+        )
+        if worker is not None and compute > 0:
+            # each worker has to produce a batch in `num_workers` compute steps, with 25% headroom
+            recommended = math.ceil(worker / compute * 1.25)
+            verdict["recommended_workers"] = max(1, min(recommended, (os.cpu_count() or 2) - 1))
+        return verdict
+
+    def report(self):
+        verdict = self.verdict()
+        if not verdict:
+            return
+        if verdict["data_bound"]:
+            state = log_utils.red("data-bound")
+        else:
+            state = log_utils.green("compute-bound")
+        logger.print(f"dataloader: {state} | wait: {verdict['wait'] * 1e3:.1f}ms ({verdict['wait_ratio']:.1%}) | compute: {verdict['compute'] * 1e3:.1f}ms")
+        if verdict["worker"] is not None:
+            stages = " | ".join(f"{stage}: {t * 1e3:.1f}ms" for stage, t in verdict["stages"].items())
+            logger.print(f"  worker: {verdict['worker'] * 1e3:.1f}ms per batch ({stages})", no_prefix=True)
+        if verdict["queue_latency"] is not None:
+            logger.print(f"  batch ready latency: {verdict['queue_latency'] * 1e3:.1f}ms | queue depth: ~{verdict['queue_depth']:.1f}", no_prefix=True)
+        if "recommended_workers" in verdict:
+            recommended = verdict["recommended_workers"]
+            if verdict["data_bound"] and recommended > self.num_workers:
+                logger.print(f"  recommended `max_dataloader_n_workers`: {log_utils.yellow(recommended)} (current: {self.num_workers})", no_prefix=True)
+            elif not verdict["data_bound"] and recommended < self.num_workers:
+                logger.print(f"  `max_dataloader_n_workers` can be reduced to {log_utils.yellow(recommended)} (current: {self.num_workers})", no_prefix=True)
+        self._reset()
+
+
+class CompileWarmupMonitor:
+    r"""
+    Report the warmup cost of `torch.compile`. The first step of every new input shape includes compilation, the following steps run the compiled graph.
+    Compile time is estimated as the first step time minus the steady-state step time of the same shape.
+    """
+
+    def __init__(self, enable=False, report_after_n_steps=100, eager_step_time=None):
+        self.enable = enable
+        self.report_after_n_steps = report_after_n_steps
+        self.eager_step_time = eager_step_time
+        self._first = {}
+        self._steady = {}
+        self._num_steps = 0
+        self._reported = False
+
+    @contextlib.contextmanager
+    def track(self, key):
+        r"""
+        Time a step with input shape `key`, e.g. the latent shape. Steps after the report are not timed, so they are not synchronized.
+        """
+        if not self.enable or self._reported:
+            yield
+            return
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        yield
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        duration = time.perf_counter() - t0
+        if key not in self._first:
+            self._first[key] = duration
+        else:
+            self._steady.setdefault(key, []).append(duration)
+        self._num_steps += 1
+        if not self._reported and self.report_after_n_steps and self._num_steps >= self.report_after_n_steps:
+            self.report()
+            self._reported = True
+
+    def add_compile_time(self, key, duration):
+        r"""
+        Record a shape compiled ahead of training, e.g. by pre-warming.
+        """
+        self._first[key] = duration
+
+    def summary(self) -> dict:
+        steady = [t for ts in self._steady.values() for t in ts]
+        steady_mean = sum(steady) / len(steady) if steady else None
+        compile_time = 0.
+        for key, first in self._first.items():
+            ts = self._steady.get(key)
+            reference = sum(ts) / len(ts) if ts else steady_mean
+            compile_time += max(0., first - reference) if reference is not None else first
+        summary = dict(num_shapes=len(self._first), compile_time=compile_time, steady_step_time=steady_mean)
+        if self.eager_step_time and steady_mean:
+            summary["speedup"] = self.eager_step_time / steady_mean
+            saved = self.eager_step_time - steady_mean
+            summary["break_even_steps"] = math.ceil(compile_time / saved) if saved > 0 else None
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        if not summary["num_shapes"]:
+            return
+        steady = f"{summary['steady_step_time'] * 1e3:.1f}ms" if summary["steady_step_time"] is not None else "-"
+        logger.print(
+            f"torch.compile: {summary['num_shapes']} shapes | compile time: {log_utils.yellow(summary['compile_time'], format_spec='.1f')}s | steady-state step: {steady}"
+        )
+        if "speedup" in summary:
+            break_even = summary["break_even_steps"] if summary["break_even_steps"] is not None else "never"
+            logger.print(f"  speedup over eager: {log_utils.yellow(summary['speedup'], format_spec='.2f')}x | break-even after {break_even} steps", no_prefix=True)
+        else:
+            logger.print("  compile time only, no eager step time to compare with: set `torch_compile_kwargs.eager_step_time` to report the speedup", no_prefix=True)
@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import torch
 import math
 import random
@@ -12,7 +13,7 @@ from PIL import Image, ExifTags
 from typing import List, Tuple, Optional, Union
 from torchvision import transforms
 from concurrent.futures import ThreadPoolExecutor, wait
-from . import log_utils
+from . import log_utils, vae_utils
 
 SDXL_BUCKET_RESOS = [
     (512, 1856), (512, 1920), (512, 1984), (512, 2048),
@@ -103,6 +104,7 @@ class Dataset(torch.utils.data.Dataset):
         self.metadata_files = [Path(metadata_file).absolute() for metadata_file in config.metadata_files]
         self.records_dir = Path(config.records_cache_dir).absolute() if config.records_cache_dir else None
         self.batch_size = config.batch_size
+        self.token_budget_kwargs = config.token_budget_kwargs
         self.tokenizer1 = tokenizer1
         self.tokenizer2 = tokenizer2
 
@@ -120,6 +122,7 @@ class Dataset(torch.utils.data.Dataset):
 
         self.check_cache_validity = config.check_cache_validity
         self.keep_cached_latents_in_memory = config.keep_cached_latents_in_memory
+        self.record_worker_stats = config.data_monitor_kwargs.enable and is_main_process and not cache_only
 
         self.max_workers = min(config.max_dataset_n_workers, os.cpu_count() - 1)
         self.is_main_process = is_main_process
@@ -130,6 +133,7 @@ class Dataset(torch.utils.data.Dataset):
         self.image_data = {}
         self.buckets = {}
         self.batches = []
+        self.mean_batch_size = self.batch_size
 
         self.logger = log_utils.get_logger("dataset" if not self.cache_only else "cache", disable=not is_main_process)
 
@@ -407,13 +411,71 @@ class Dataset(torch.utils.data.Dataset):
             for j, img_info in enumerate(bucket):
                 self.logger.print(f"  [{j}]: {img_info.key} | {img_info.image_size} -> {img_info.bucket_size}")
 
+    def get_max_tokens(self) -> int:
+        r"""
+        Latent pixels per batch of token-budget batching, by default `batch_size` images at `resolution`.
+        """
+        if self.token_budget_kwargs.max_tokens:
+            return self.token_budget_kwargs.max_tokens
+        width, height = (self.resolution, self.resolution) if isinstance(self.resolution, int) else self.resolution
+        return self.batch_size * (width // 8) * (height // 8)
+
+    def get_bucket_batch_size(self, bucket_reso) -> int:
+        r"""
+        Batch size of a bucket. With token-budget batching, it scales inversely with the latent area of the bucket.
+        """
+        if not self.token_budget_kwargs.enable:
+            return self.batch_size
+        batch_size = max(1, self.get_max_tokens() // ((bucket_reso[0] // 8) * (bucket_reso[1] // 8)))
+        if self.token_budget_kwargs.max_batch_size:
+            batch_size = min(batch_size, self.token_budget_kwargs.max_batch_size)
+        return batch_size
+
     def make_batches(self):
         self.batches = []
-        for bucket in self.logger.tqdm(self.buckets.values(), desc=f"making batches", disable=not self.is_main_process):
-            for i in range(0, len(bucket), self.batch_size):
-                self.batches.append(bucket[i:i+self.batch_size])
+        for bucket_reso, bucket in self.logger.tqdm(self.buckets.items(), desc=f"making batches", disable=not self.is_main_process):
+            batch_size = self.get_bucket_batch_size(bucket_reso)
+            if self.token_budget_kwargs.enable:
+                # split the bucket into batches of near-equal sizes instead of leaving a ragged last batch
+                num_batches = math.ceil(len(bucket) / batch_size)
+                bounds = [round(i * len(bucket) / num_batches) for i in range(num_batches + 1)]
+                self.batches.extend(bucket[bounds[i]:bounds[i + 1]] for i in range(num_batches))
+            else:
+                for i in range(0, len(bucket), batch_size):
+                    self.batches.append(bucket[i:i+batch_size])
+        self.mean_batch_size = sum(len(batch) for batch in self.batches) / len(self.batches) if self.batches else self.batch_size
+        if self.token_budget_kwargs.enable:
+            self.report_batching()
+
+    def batching_stats(self) -> dict:
+        r"""
+        Padding waste of the batches: the share of the batch capacity which is not filled with samples.
+        The capacity is the token budget with token-budget batching, or `batch_size` images of the bucket otherwise.
+        """
+        capacity, used = 0, 0
+        for batch in self.batches:
+            width, height = batch[0].bucket_size
+            tokens = (width // 8) * (height // 8)
+            capacity += self.get_max_tokens() if self.token_budget_kwargs.enable else self.batch_size * tokens
+            used += len(batch) * tokens
+        batch_sizes = [len(batch) for batch in self.batches]
+        return dict(
+            num_batches=len(self.batches),
+            num_samples=sum(batch_sizes),
+            mean_batch_size=self.mean_batch_size,
+            min_batch_size=min(batch_sizes, default=0),
+            max_batch_size=max(batch_sizes, default=0),
+            padding_waste=1 - used / capacity if capacity > 0 else 0.,
+        )
 
-    def cache_latents(self, vae, accelerator, vae_batch_size=1, cache_to_disk=False, check_validity=False, empty_cache=False, async_cache=False):
+    def report_batching(self):
+        stats = self.batching_stats()
+        self.logger.print(
+            f"batches: {stats['num_batches']} | samples: {stats['num_samples']} | batch size: {stats['min_batch_size']}-{stats['max_batch_size']} (mean {stats['mean_batch_size']:.2f})"
+            f" | padding waste: {log_utils.yellow(stats['padding_waste'], format_spec='.1%')}"
+        )
+
+    def cache_latents(self, vae, accelerator, vae_batch_size=1, cache_to_disk=False, check_validity=False, empty_cache=False, async_cache=False, vae_tiling_kwargs=None):
         if self.cache_only and not cache_to_disk:
             cache_to_disk = True
             self.logger.print(log_utils.yellow("cache_only is enabled. cache_to_disk is forced to be True."))
@@ -494,7 +556,10 @@ class Dataset(torch.utils.data.Dataset):
 
         pbar = self.logger.tqdm(total=len(batches), desc=f"caching latents", disable=not self.is_main_process)
         for batch in batches:
-            cache_batch_latents(batch, vae, cache_to_disk=cache_to_disk, flip_aug=self.flip_aug, cache_only=self.cache_only, empty_cache=empty_cache, async_cache=async_cache)
+            cache_batch_latents(
+                batch, vae, cache_to_disk=cache_to_disk, flip_aug=self.flip_aug, cache_only=self.cache_only, empty_cache=empty_cache, async_cache=async_cache,
+                vae_tiling_kwargs=vae_tiling_kwargs,
+            )
             pbar.update(1)
         pbar.close()
 
@@ -526,9 +591,14 @@ class Dataset(torch.utils.data.Dataset):
             input_ids_1=[],
             input_ids_2=[],
         )
+        if self.record_worker_stats:
+            stage_times = dict(latents=0., caption=0., tokenize=0.)
+            t_start = time.perf_counter()
 
         for img_info in batch:
             img_info: ImageInfo
+            if self.record_worker_stats:
+                t0 = time.perf_counter()
             flipped = self.flip_aug and random.random() > 0.5
             if img_info.latents is not None:  # directly load latents from memory
                 # logu.debug(f"Find latents: {image_info.key}")
@@ -560,6 +630,9 @@ class Dataset(torch.utils.data.Dataset):
             else:
                 # TODO: Implement non-latent-cache training
                 raise NotImplementedError("No latents found for image: {}".format(img_info.image_path))
+            if self.record_worker_stats:
+                t1 = time.perf_counter()
+                stage_times['latents'] += t1 - t0
 
             # if image is None and img_info.image_path is not None:
             #     image = load_image(img_info.image_path)
@@ -586,9 +659,14 @@ class Dataset(torch.utils.data.Dataset):
             else:
                 log_utils.warn(f"no caption or tags found for image: {img_info.key}")
                 caption = ''
+            if self.record_worker_stats:
+                t2 = time.perf_counter()
+                stage_times['caption'] += t2 - t1
 
             input_ids_1 = self.get_input_ids(caption, self.tokenizer1)
             input_ids_2 = self.get_input_ids(caption, self.tokenizer2)
+            if self.record_worker_stats:
+                stage_times['tokenize'] += time.perf_counter() - t2
 
             sample["image_keys"].append(img_info.key)
             sample["images"].append(image)
@@ -615,6 +693,14 @@ class Dataset(torch.utils.data.Dataset):
         #         image_info.latents_flipped = None
         #         del latents
 
+        if self.token_budget_kwargs.enable:
+            # batch sizes vary with the bucket: weight the batch mean loss by its size so that every sample contributes equally
+            sample["loss_scale"] = len(batch) / self.mean_batch_size
+
+        if self.record_worker_stats:
+            stage_times['total'] = time.perf_counter() - t_start
+            sample["worker_stats"] = dict(stage_times=stage_times, ready_time=time.time())
+
         return sample
 
 
@@ -964,7 +1050,7 @@ async def save_latents_to_disk_async(npz_path, latents_tensor, original_size, cr
         raise RuntimeError(f"Failed to save latents to {npz_path}")
 
 
-def cache_batch_latents(image_infos: List[ImageInfo], vae, cache_to_disk, flip_aug, cache_only=False, async_cache=False, empty_cache=False):
+def cache_batch_latents(image_infos: List[ImageInfo], vae, cache_to_disk, flip_aug, cache_only=False, async_cache=False, empty_cache=False, vae_tiling_kwargs=None):
     images = []
     for info in image_infos:
         image = load_image(info.image_path)
@@ -973,14 +1059,15 @@ def cache_batch_latents(image_infos: List[ImageInfo], vae, cache_to_disk, flip_a
 
     img_tensors = torch.stack(images, dim=0)
     img_tensors = img_tensors.to(device=vae.device, dtype=vae.dtype)
+    vae_tiling_kwargs = vae_tiling_kwargs or {}
 
     with torch.no_grad():
-        latents = vae.encode(img_tensors).latent_dist.sample().to('cpu')
+        latents = vae_utils.encode(vae, img_tensors, **vae_tiling_kwargs).sample().to('cpu')
 
     if flip_aug:
         img_tensors = torch.flip(img_tensors, dims=[3])
         with torch.no_grad():
-            flipped_latents = vae.encode(img_tensors).latent_dist.sample().to("cpu")
+            flipped_latents = vae_utils.encode(vae, img_tensors, **vae_tiling_kwargs).sample().to("cpu")
     else:
         flipped_latents = [None] * len(latents)
 
@@ -1,6 +1,5 @@
 import torch
 import os
-import re
 import time
 from accelerate import Accelerator
 from . import log_utils
@@ -142,6 +141,469 @@ def prepare_param(param):
     return param
 
 
+def get_group_key(param, sampler):
+    r"""
+    Sample params with the same key are denoised in one batch: everything but the prompts and seeds must be the same.
+    """
+    return (
+        param["width"], param["height"], param["steps"], param["scale"], sampler,
+        param["original_width"], param["original_height"], param["original_scale_factor"], param["save_latents"],
+    )
+
+
+def group_params(params, sampler, max_batch_size=None, max_batch_pixels=None):
+    r"""
+    Group prepared sample params by `get_group_key` into batches of (index, param), in the order of their first params.
+    Every param makes `batch_size` x `batch_count` images. Groups are split so that a batch has at most `max_batch_size` images
+    and `max_batch_pixels` pixels in total, but the images of a param are never split.
+    """
+    groups = {}
+    for i, param in enumerate(params):
+        groups.setdefault(get_group_key(param, sampler), []).append((i, param))
+
+    batches = []
+    for group in groups.values():
+        batch, num_images = [], 0
+        for i, param in group:
+            n = param["batch_size"] * param["batch_count"]
+            over_size = max_batch_size and num_images + n > max_batch_size
+            over_pixels = max_batch_pixels and (num_images + n) * param["width"] * param["height"] > max_batch_pixels
+            if batch and (over_size or over_pixels):
+                batches.append(batch)
+                batch, num_images = [], 0
+            batch.append((i, param))
+            num_images += n
+        batches.append(batch)
+    return batches
+
+
+def sample_batch(pipe, accelerator, batch, callback=None):
+    r"""
+    Denoise the params of `batch`, a list of (index, param) with the same group key, in one batched loop.
+    Every param has its own generator seeded by its seed: the initial noise is drawn from it, and the step noise of ancestral samplers
+    continues its stream, so that images do not depend on how params are grouped or sharded. On out of memory, the batch is halved and retried.
+    `callback` is called with the (possibly halved) batch, the step, the timestep and the latents. Returns the latents of every param.
+    """
+    param = batch[0][1]
+    device = pipe.device
+    latents, generators = [], []
+    for _, p in batch:
+        generator = torch.Generator(device).manual_seed(p["seed"])
+        shape = (p["batch_size"] * p["batch_count"], pipe.unet.in_channels, p["height"] // pipe.vae_scale_factor, p["width"] // pipe.vae_scale_factor)
+        latents.append(torch.randn(shape, generator=generator, device=device, dtype=pipe.unet.dtype))
+        # schedulers draw the step noise of every image from its generator, a param of one image gets the same noise as sampled alone
+        generators.extend([generator] * shape[0])
+    torch.manual_seed(param["seed"])
+    torch.cuda.manual_seed(param["seed"])
+
+    try:
+        with accelerator.autocast():
+            latents = pipe(
+                prompt=[p["prompt"] for _, p in batch for _ in range(p["batch_size"] * p["batch_count"])],
+                negative_prompt=[p["negative_prompt"] for _, p in batch for _ in range(p["batch_size"] * p["batch_count"])],
+                num_inference_steps=param["steps"],
+                guidance_scale=param["scale"],
+                width=param["width"],
+                height=param["height"],
+                original_width=param["original_width"],
+                original_height=param["original_height"],
+                original_scale_factor=param["original_scale_factor"],
+                num_images_per_prompt=1,
+                latents=torch.cat(latents),
+                generator=generators,
+                callback=(lambda step, t, latents: callback(batch, step, t, latents)) if callback is not None else None,
+            )
+    except torch.cuda.OutOfMemoryError:
+        if len(batch) == 1:
+            raise
+        logger.print(log_utils.yellow(f"out of memory when sampling a batch of {len(batch)} params, split it into halves"))
+        latents = None
+        torch.cuda.empty_cache()
+        half = len(batch) // 2
+        return sample_batch(pipe, accelerator, batch[:half], callback) + sample_batch(pipe, accelerator, batch[half:], callback)
+
+    return list(torch.split(latents, [p["batch_size"] * p["batch_count"] for _, p in batch]))
+
+
+def resolve_seeds(params, accelerator):
+    r"""
+    Draw the missing seeds of prepared sample params on the main process and share them, so that every process has the same params.
+    """
+    seeds = [param["seed"] for param in params]
+    if accelerator.num_processes > 1:
+        from accelerate.utils import broadcast_object_list
+        seeds = broadcast_object_list(seeds if accelerator.is_main_process else [None] * len(seeds), from_process=0)
+    for param, seed in zip(params, seeds):
+        param["seed"] = seed
+    return params
+
+
+def shard_batches(batches, process_index, num_processes):
+    r"""
+    Deterministic share of the sample batches of process `process_index`. Batches are assigned largest first to the least loaded process,
+    where the load of a batch is its number of pixels times steps.
+    """
+    def get_cost(batch):
+        return sum(p["batch_size"] * p["batch_count"] * p["width"] * p["height"] * p["steps"] for _, p in batch)
+
+    loads = [0] * num_processes
+    shards = [[] for _ in range(num_processes)]
+    for batch in sorted(batches, key=get_cost, reverse=True):
+        rank = loads.index(min(loads))
+        shards[rank].append(batch)
+        loads[rank] += get_cost(batch)
+    return sorted(shards[process_index], key=lambda batch: batch[0][0])  # in the order of the benchmark
+
+
+IMAGE_EXTENSIONS = {"png": ".png", "webp": ".webp"}
+
+
+def array_to_pil(array):
+    r"""
+    Convert a decoded image, a float array of shape (H, W, C) in [0, 1], to a PIL image.
+    """
+    from PIL import Image
+    array = (array * 255).round().astype("uint8")
+    return Image.fromarray(array.squeeze(-1), mode="L") if array.shape[-1] == 1 else Image.fromarray(array)
+
+
+def encode_image(image, image_format="png", quality=95, metadata=None) -> bytes:
+    r"""
+    Encode a PIL image to PNG or WebP bytes with the generation `metadata` embedded as JSON:
+    in the `parameters` text chunk of PNG, or in the image description of the EXIF of WebP.
+    """
+    import io
+    import json
+    from PIL import Image, PngImagePlugin
+    buffer = io.BytesIO()
+    text = json.dumps(metadata, ensure_ascii=False) if metadata else None
+    if image_format == "webp":
+        exif = Image.Exif()
+        if text:
+            exif[0x010E] = json.dumps(metadata)  # ImageDescription is ASCII only
+        image.save(buffer, format="WEBP", quality=quality, exif=exif.tobytes())
+    else:
+        pnginfo = PngImagePlugin.PngInfo()
+        if text:
+            pnginfo.add_itxt("parameters", text)
+        image.save(buffer, format="PNG", pnginfo=pnginfo)
+    return buffer.getvalue()
+
+
+class SampleSink:
+    r"""
+    Background sink of generated samples. Decoded images are converted to PIL, encoded with their metadata and written in a thread pool,
+    and trackers are uploaded to in the same pool, so that the next batch can be denoised right away.
+    """
+
+    def __init__(self, num_workers=2, image_format="png", quality=95):
+        from concurrent.futures import ThreadPoolExecutor
+        assert image_format in IMAGE_EXTENSIONS, f"unknown image format: {image_format}, must be one of {list(IMAGE_EXTENSIONS)} / 不明な画像形式です: {image_format}"
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="sample_sink")
+        self.image_format = image_format
+        self.extension = IMAGE_EXTENSIONS[image_format]
+        self.quality = quality
+        self.writes = []
+        self.tasks = []
+
+    def _write(self, sample_dir, array, sample, filename):
+        image = encode_image(array_to_pil(array), self.image_format, self.quality, sample["metadata"])
+        os.makedirs(sample_dir, exist_ok=True)
+        with open(os.path.join(sample_dir, filename), "wb") as f:
+            f.write(image)
+        return dict(sample, file_name=filename)
+
+    def write(self, sample_dir, arrays, samples, get_filename):
+        r"""
+        Encode the decoded images `arrays` and write them to `sample_dir` in background, with the file name `get_filename(sample)`
+        and the extension of the format. `samples` are dicts of `index`, `image_index` and `metadata` of every image.
+        The records of the written samples, without the images, are returned by `results`.
+        """
+        for array, sample in zip(arrays, samples):
+            self.writes.append(self.executor.submit(self._write, sample_dir, array, sample, get_filename(sample) + self.extension))
+
+    def results(self):
+        r"""
+        Wait for the pending writes and return the records of the written samples in the order they were submitted.
+        """
+        writes, self.writes = self.writes, []
+        return [future.result() for future in writes]
+
+    def _run(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.print(log_utils.red(f"exception in sample sink: {e}"))
+
+    def submit(self, fn, *args):
+        r"""
+        Run `fn(*args)` in background, e.g. writing files or uploading to trackers. Exceptions are logged and not raised.
+        """
+        self.tasks = [task for task in self.tasks if not task.done()]
+        self.tasks.append(self.executor.submit(self._run, fn, *args))
+
+    def save(self, arrays, paths):
+        r"""
+        Convert the decoded images `arrays` to PIL and save them to `paths` in background.
+        """
+        def save():
+            for array, path in zip(arrays, paths):
+                array_to_pil(array).save(path)
+        self.submit(save)
+
+    def wait(self):
+        r"""
+        Wait for all pending writes and uploads.
+        """
+        self.results()
+        tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def gather_samples(accelerator, samples):
+    r"""
+    Gather the records of the samples written by all processes, dicts of `index`, `image_index`, `file_name` and `metadata`.
+    Only the records are gathered, every process writes its own images. Returns all records sorted by index, on every process.
+    """
+    if accelerator.num_processes > 1:
+        from accelerate.utils import gather_object
+        samples = gather_object(samples)
+    return sorted(samples, key=lambda sample: (sample["index"], sample["image_index"]))
+
+
+def save_sample_metadata(sample_dir, samples):
+    r"""
+    Write the metadata of the gathered samples to `metadata.json` in `sample_dir`.
+    """
+    import json
+    os.makedirs(sample_dir, exist_ok=True)
+    records = [dict(file_name=sample["file_name"], **sample["metadata"]) for sample in samples]
+    with open(os.path.join(sample_dir, "metadata.json"), "w", encoding="utf-8") as f:
+        json.dump(records, f, indent=2, ensure_ascii=False)
+
+
+def log_samples_to_wandb(accelerator, sample_dir, samples):
+    r"""
+    Upload the written samples to wandb. Samples of other processes are only uploaded if `sample_dir` is on a shared filesystem.
+    """
+    try:
+        wandb_tracker = accelerator.get_tracker("wandb")
+        try:
+            import wandb
+            from PIL import Image
+        except ImportError:
+            raise ImportError("No wandb installed. Please install wandb to use this feature.")
+        paths = {sample["index"]: os.path.join(sample_dir, sample["file_name"]) for sample in samples}
+        wandb_tracker.log({f"sample_{index}": wandb.Image(Image.open(path)) for index, path in paths.items() if os.path.isfile(path)})
+    except:
+        pass
+
+
+def get_sample_metadata(param, sampler):
+    return {
+        'prompt': param["prompt"],
+        'negative_prompt': param["negative_prompt"],
+        'sample_steps': param["steps"],
+        'width': param["width"],
+        'height': param["height"],
+        'scale': param["scale"],
+        'seed': param["seed"],
+        'sampler': sampler,
+        'original_width': param["original_width"],
+        'original_height': param["original_height"],
+        'original_scale_factor': param["original_scale_factor"],
+    }
+
+
+VAE_PLACEMENTS = ("resident", "offload", "pinned")
+
+
+class TrainSampler:
+    r"""
+    Long-lived sampler of the benchmark during training. The scheduler and the pipeline are built once, and reused by every sampling event
+    together with the sample sink and the prompt embedding cache. `vae_placement` decides where the VAE stays between the events:
+    `resident` keeps it on the device, `offload` moves it back to its original device, and `pinned` keeps its weights in pinned host memory,
+    so that it is copied to the device asynchronously and offloaded without any copy. VAE weights are never trained, so the host copy stays valid.
+    """
+
+    def __init__(
+        self,
+        pipe_class,
+        accelerator,
+        config,
+        unet,
+        text_encoder,
+        vae,
+        tokenizer,
+        device,
+        vae_placement="offload",
+        empty_cache=True,
+        sink=None,
+        embedding_cache=None,
+    ):
+        assert vae_placement in VAE_PLACEMENTS, f"unknown vae placement: {vae_placement}, must be one of {VAE_PLACEMENTS} / 不明なVAEの配置です: {vae_placement}"
+        t0 = time.perf_counter()
+        self.accelerator = accelerator
+        self.config = config
+        self.device = torch.device(device)
+        self.vae = vae
+        self.host_device = vae.device  # CPUにいるはず
+        if self.host_device == self.device:
+            vae_placement = "resident"  # already on the device
+        elif vae_placement == "pinned" and self.device.type != "cuda":
+            vae_placement = "offload"  # pinned memory only helps copies to CUDA devices
+        self.vae_placement = vae_placement
+        self.empty_cache = empty_cache
+        self.own_sink = sink is None
+        self.sink = sink if sink is not None else SampleSink(**config.sample_sink_kwargs)
+
+        self.host_tensors = None
+        if vae_placement == "pinned":
+            self.host_tensors = [(t, t.data.pin_memory()) for t in list(vae.parameters()) + list(vae.buffers())]
+            for t, host in self.host_tensors:
+                t.data = host
+        elif vae_placement == "resident":
+            vae.to(self.device)
+
+        self.scheduler = prepare_sampler(config.sample_sampler)
+        self.pipe = pipe_class(
+            text_encoder=text_encoder,
+            vae=vae,
+            unet=unet,
+            tokenizer=tokenizer,
+            scheduler=self.scheduler,
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False,
+            clip_skip=config.clip_skip,
+            vae_tiling_kwargs=config.vae_tiling_kwargs,
+            embedding_cache=embedding_cache,
+        )
+        self.pipe.to(self.device)
+        self.setup_time = time.perf_counter() - t0
+        self.num_events = 0
+
+    def _synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _onload_vae(self):
+        if self.vae_placement == "pinned":
+            for t, host in self.host_tensors:
+                t.data = host.to(self.device, non_blocking=True)
+        elif self.vae_placement == "offload":
+            self.vae.to(self.device)
+
+    def _offload_vae(self):
+        if self.vae_placement == "pinned":
+            for t, host in self.host_tensors:
+                t.data = host  # the weights are unchanged, drop the device copy
+        elif self.vae_placement == "offload":
+            self.vae.to(self.host_device)
+
+    def sample(self, epoch, steps):
+        r"""
+        Sample the benchmark with all processes. The writes and uploads of the samples may still be pending in the sink when this returns.
+        """
+        accelerator, config, pipe, sink = self.accelerator, self.config, self.pipe, self.sink
+        logger.print(f"\ngenerating sample images at step: {steps}")
+
+        t0 = time.perf_counter()
+        self._onload_vae()
+        self._synchronize()
+        onload_time = time.perf_counter() - t0
+
+        # read prompts
+        gen_params = load_params(config.sample_benchmark)
+
+        sample_dir = os.path.join(config.output_dir, config.output_subdir.samples, f"epoch_{epoch}" if epoch is not None else f"step_{steps}")
+        os.makedirs(sample_dir, exist_ok=True)
+        ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
+        num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
+
+        def get_filename(sample):
+            return f"sample_{ts_str}_{num_suffix}_{sample['index']:02d}"
+
+        rng_state = torch.get_rng_state()
+        cuda_rng_state = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
+
+        gen_params = [prepare_param(patch_default_param(param, config.sample_params)) for param in gen_params]
+        gen_params = resolve_seeds(gen_params, accelerator)
+        batch_kwargs = config.sample_batch_kwargs
+        if batch_kwargs.enable:
+            batches = group_params(gen_params, config.sample_sampler, batch_kwargs.max_batch_size, batch_kwargs.max_batch_pixels)
+        else:
+            batches = [[(i, param)] for i, param in enumerate(gen_params)]
+        # every process samples its share of the benchmark
+        batches = shard_batches(batches, accelerator.process_index, accelerator.num_processes)
+
+        with torch.no_grad():
+            for batch in batches:
+                param = batch[0][1]
+                if len(batch) > 1:
+                    logger.print(f"sampling a batch of {len(batch)} params | {param['width']}x{param['height']} | steps: {param['steps']} | scale: {param['scale']}")
+                for i, p in batch:
+                    logger.print(f"sample_{i}:")
+                    logger.print(f"  prompt: {p['prompt']}", no_prefix=True)
+                    logger.print(f"  negative_prompt: {p['negative_prompt']}", no_prefix=True)
+                    logger.print(f"  seed: {p['seed']}", no_prefix=True)
+
+                def save_latents_callback(batch, step, t, latents):
+                    rows = [(i, b) for i, p in batch for b in range(p["batch_size"] * p["batch_count"])]
+                    sink.save(pipe.decode_latents(latents), [os.path.join(sample_dir, f"{i:04d}-{b}-t={t:.0f}-i={step}.png") for i, b in rows])
+
+                latents_list = sample_batch(pipe, accelerator, batch, callback=save_latents_callback if param["save_latents"] else None)
+
+                # only decode on the main thread, the sink converts, encodes and writes the images while the next batch is denoised
+                for (i, p), latents in zip(batch, latents_list):
+                    samples = [dict(index=i, image_index=0, metadata=get_sample_metadata(p, config.sample_sampler))]
+                    sink.write(sample_dir, pipe.decode_latents(latents[:1]), samples, get_filename)
+
+        # every process has written its own images, only their records are gathered
+        samples = gather_samples(accelerator, sink.results())
+        if accelerator.is_main_process:
+            sink.submit(save_sample_metadata, sample_dir, samples)
+            sink.submit(log_samples_to_wandb, accelerator, sample_dir, samples)
+
+        torch.set_rng_state(rng_state)
+        if cuda_rng_state is not None:
+            torch.cuda.set_rng_state(cuda_rng_state)
+
+        t0 = time.perf_counter()
+        self._offload_vae()
+        if self.empty_cache:
+            torch.cuda.empty_cache()
+        self._synchronize()
+        offload_time = time.perf_counter() - t0
+
+        self.num_events += 1
+        if self.num_events > 1:
+            saved = f"saved {self.setup_time * 1000:.0f} ms of pipeline setup"
+        else:
+            saved = f"pipeline setup {self.setup_time * 1000:.0f} ms"
+        logger.print(
+            f"sampling overhead: {saved} | vae ({self.vae_placement}) onload {onload_time * 1000:.0f} ms, offload {offload_time * 1000:.0f} ms",
+            no_prefix=True,
+        )
+
+    def close(self):
+        r"""
+        Wait for the pending writes and uploads of the sink if it is owned, and move the VAE back to its original device.
+        """
+        if self.own_sink:
+            self.sink.close()
+        if self.vae_placement == "pinned":
+            for t, host in self.host_tensors:
+                t.data = host
+        elif self.vae_placement == "resident" and self.host_device != self.device:
+            self.vae.to(self.host_device)
+
+
 def sample_during_train(
     pipe_class,
     accelerator,
@@ -153,92 +615,27 @@ def sample_during_train(
     vae,
     tokenizer,
     device,
+    sink=None,
+    embedding_cache=None,
 ):
-    logger.print(f"\ngenerating sample images at step: {steps}")
-
-    orig_vae_device = vae.device  # CPUにいるはず
-    vae.to(device)
-
-    # read prompts
-    gen_params = load_params(config.sample_benchmark)
-    sample_sampler = prepare_sampler(config.sample_sampler)
-
-    pipe = pipe_class(
+    r"""
+    Sample the benchmark with all processes with a temporary `TrainSampler`. Images are encoded, written and uploaded by `sink`, a `SampleSink`;
+    a temporary one is created and waited for if not given, otherwise the writes and uploads may still be pending when this returns.
+    Text embeddings of the prompts are reused from `embedding_cache`, a `PromptEmbeddingCache`, if given.
+    """
+    sampler = TrainSampler(
+        pipe_class,
+        accelerator,
+        config,
+        unet=unet,
         text_encoder=text_encoder,
         vae=vae,
-        unet=unet,
         tokenizer=tokenizer,
-        scheduler=sample_sampler,
-        safety_checker=None,
-        feature_extractor=None,
-        requires_safety_checker=False,
-        clip_skip=config.clip_skip,
+        device=device,
+        vae_placement="offload",
+        empty_cache=True,
+        sink=sink,
+        embedding_cache=embedding_cache,
     )
-    pipe.to(device)
-
-    sample_dir = os.path.join(config.output_dir, config.output_subdir.samples, f"epoch_{epoch}" if epoch is not None else f"step_{steps}")
-    os.makedirs(sample_dir, exist_ok=True)
-
-    rng_state = torch.get_rng_state()
-    cuda_rng_state = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
-
-    with torch.no_grad():
-        for i, param in enumerate(gen_params):
-            if not accelerator.is_main_process:
-                continue
-
-            param = patch_default_param(param, config.sample_params)
-            param = prepare_param(param)
-
-            logger.print(f"sample_{i}:")
-            logger.print(f"  prompt: {param['prompt']}", no_prefix=True)
-            logger.print(f"  negative_prompt: {param['negative_prompt']}", no_prefix=True)
-            logger.print(f"  seed: {param['seed']}", no_prefix=True)
-
-            def save_latents_callback(i, t, latents):
-                images = pipe.latents_to_image(latents)
-                for b, image in enumerate(images):
-                    sample_path = sample_dir / f"{idx:04d}-{b}-t={t:.0f}-i={i}.png"
-                    sample_path.parent.mkdir(parents=True, exist_ok=True)
-                    image.save(sample_path)
-
-            with accelerator.autocast():
-                latents = pipe(
-                    prompt=[param["prompt"]]*param["batch_size"],
-                    negative_prompt=[param["negative_prompt"]]*param["batch_size"],
-                    num_inference_steps=param["steps"],
-                    guidance_scale=param["scale"],
-                    width=param["width"],
-                    height=param["height"],
-                    original_width=param["original_width"],
-                    original_height=param["original_height"],
-                    original_scale_factor=param["original_scale_factor"],
-                    num_images_per_prompt=param["batch_count"],
-                    callback=save_latents_callback if param["save_latents"] else None,
-                )
-
-            # save image
-            image = pipe.latents_to_image(latents)[0]
-            ts_str = time.strftime("%Y%m%d%H%M%S", time.localtime())
-            num_suffix = f"e{epoch:06d}" if epoch is not None else f"{steps:06d}"
-            img_filename = f"sample_{ts_str}_{num_suffix}_{i:02d}.png"
-            image.save(os.path.join(sample_dir, img_filename))
-
-            try:
-                wandb_tracker = accelerator.get_tracker("wandb")
-                try:
-                    import wandb
-                except ImportError:
-                    raise ImportError("No wandb installed. Please install wandb to use this feature.")
-                wandb_tracker.log({f"sample_{i}": wandb.Image(image)})
-            except:
-                pass
-
-    # clear pipeline and cache to reduce vram usage
-    del pipe
-    torch.cuda.empty_cache()
-
-    torch.set_rng_state(rng_state)
-    if cuda_rng_state is not None:
-        torch.cuda.set_rng_state(cuda_rng_state)
-    vae.to(orig_vae_device)
+    sampler.sample(epoch, steps)
+    sampler.close()
@@ -18,7 +18,7 @@ from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput,
 from diffusers.utils import logging
 from PIL import Image
 
-from . import sdxl_model_utils, sdxl_train_utils, log_utils
+from . import sdxl_model_utils, sdxl_train_utils, vae_utils, log_utils
 
 
 try:
@@ -295,6 +295,7 @@ def get_weighted_text_embeddings(
     skip_weighting: Optional[bool] = False,
     clip_skip=None,
     is_sdxl_text_encoder2=False,
+    embeddings_multiples: Optional[int] = None,
 ):
     r"""
     Prompts can be assigned with local weights using brackets. For example,
@@ -320,6 +321,9 @@ def get_weighted_text_embeddings(
             Skip the parsing of brackets.
         skip_weighting (`bool`, *optional*, defaults to `False`):
             Skip the weighting. When the parsing is skipped, it is forced True.
+        embeddings_multiples (`int`, *optional*):
+            Pad the embeddings to this multiple of the max output length of text encoder, instead of the multiple which fits the
+            longest prompt. Used to compute embeddings of a part of a batch.
     """
     max_length = (pipe.tokenizer.model_max_length - 2) * max_embeddings_multiples + 2
     if isinstance(prompt, str):
@@ -352,6 +356,8 @@ def get_weighted_text_embeddings(
         (max_length - 1) // (pipe.tokenizer.model_max_length - 2) + 1,
     )
     max_embeddings_multiples = max(1, max_embeddings_multiples)
+    if embeddings_multiples is not None:
+        max_embeddings_multiples = embeddings_multiples
     max_length = (pipe.tokenizer.model_max_length - 2) * max_embeddings_multiples + 2
 
     # pad the length of tokens and weights
@@ -426,6 +432,93 @@ def get_weighted_text_embeddings(
     return text_embeddings, text_pool, None, None
 
 
+class PromptEmbeddingCache:
+    r"""
+    Memoized weighted text embeddings of prompts, reused across sampling rounds and between prompts shared by many entries, e.g. negative prompts.
+    An entry is keyed by (prompt, clip skip, max embeddings multiples, padded multiples, text encoder, text encoder version),
+    where the padded multiples depend on the longest prompt of the batch, and the version is a fingerprint of the weights of the text encoder.
+    The fingerprint of a frozen text encoder is computed once, and entries of outdated versions are dropped.
+    The rows of a batch are encoded independently, so that a cached row equals the row computed with the whole batch.
+    """
+
+    def __init__(self, max_entries=1024):
+        from collections import OrderedDict
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.token_lengths = {}
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_version(self, text_encoder):
+        params = list(text_encoder.parameters())
+        if id(text_encoder) in self.versions and not any(p.requires_grad for p in params):
+            return self.versions[id(text_encoder)]
+        import hashlib
+        with torch.no_grad():
+            sums = torch.stack([torch.stack([p.detach().float().sum(), p.detach().float().abs().sum()]) for p in params])
+        version = hashlib.sha1(sums.cpu().numpy().tobytes()).hexdigest()[:16]
+        old_version = self.versions.get(id(text_encoder))
+        if old_version is not None and old_version != version:
+            for key in [key for key in self.entries if key[-2:] == (id(text_encoder), old_version)]:
+                del self.entries[key]
+        self.versions[id(text_encoder)] = version
+        return version
+
+    def get_token_length(self, pipe, prompt, max_length):
+        key = (id(pipe.tokenizer), prompt, max_length)
+        if key not in self.token_lengths:
+            tokens, _ = get_prompts_with_weights(pipe, [prompt], max_length - 2)
+            self.token_lengths[key] = len(tokens[0])
+        return self.token_lengths[key]
+
+    def get_weighted_text_embeddings(self, pipe, prompt, uncond_prompt, max_embeddings_multiples, clip_skip, is_sdxl_text_encoder2):
+        r"""
+        Same as `get_weighted_text_embeddings` with the default parsing and weighting, but only the prompts which are not cached are encoded.
+        """
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+        uncond_prompts = ([uncond_prompt] if isinstance(uncond_prompt, str) else list(uncond_prompt)) if uncond_prompt is not None else []
+        version = self.get_version(pipe.text_encoder)
+
+        # the embeddings are padded to the multiple which fits the longest prompt of the batch
+        chunk_length = pipe.tokenizer.model_max_length
+        max_length = (chunk_length - 2) * max_embeddings_multiples + 2
+        longest = max(self.get_token_length(pipe, p, max_length) for p in prompts + uncond_prompts)
+        multiples = max(1, min(max_embeddings_multiples, (longest - 1) // (chunk_length - 2) + 1))
+
+        def get_key(p):
+            return (p, clip_skip, max_embeddings_multiples, multiples, is_sdxl_text_encoder2, id(pipe.text_encoder), version)
+
+        missing = list(dict.fromkeys(p for p in prompts + uncond_prompts if get_key(p) not in self.entries))
+        self.hits += len(set(prompts + uncond_prompts)) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            embeddings, pool, _, _ = get_weighted_text_embeddings(
+                pipe,
+                missing,
+                max_embeddings_multiples=max_embeddings_multiples,
+                clip_skip=clip_skip,
+                is_sdxl_text_encoder2=is_sdxl_text_encoder2,
+                embeddings_multiples=multiples,
+            )
+            for i, p in enumerate(missing):
+                self.entries[get_key(p)] = (embeddings[i:i + 1].cpu(), pool[i:i + 1].cpu() if pool is not None else None)
+        for p in prompts + uncond_prompts:
+            self.entries.move_to_end(get_key(p))
+
+        def stack(ps):
+            entries = [self.entries[get_key(p)] for p in ps]
+            embeddings = torch.cat([e for e, _ in entries]).to(pipe.device)
+            pool = torch.cat([p for _, p in entries]).to(pipe.device) if entries[0][1] is not None else None
+            return embeddings, pool
+
+        text_embeddings, text_pool = stack(prompts)
+        uncond_embeddings, uncond_pool = stack(uncond_prompts) if uncond_prompts else (None, None)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return text_embeddings, text_pool, uncond_embeddings, uncond_pool
+
+
 def preprocess_image(image):
     w, h = image.size
     w, h = map(lambda x: x - x % 32, (w, h))  # resize to integer multiple of 32
@@ -528,6 +621,8 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
             Please, refer to the [model card](https://huggingface.co/CompVis/stable-diffusion-v1-4) for details.
         feature_extractor ([`CLIPFeatureExtractor`]):
             Model that extracts features from generated images to be used as inputs for the `safety_checker`.
+        vae_tiling_kwargs (`dict`, *optional*):
+            Batch slicing and spatial tiling of the VAE encode/decode, see `vae_utils.encode` and `vae_utils.decode`.
     """
 
     # if version.parse(version.parse(diffusers.__version__).base_version) >= version.parse("0.9.0"):
@@ -544,6 +639,8 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
         feature_extractor: CLIPFeatureExtractor,
         requires_safety_checker: bool = True,
         clip_skip: int = 1,
+        vae_tiling_kwargs: Optional[dict] = None,
+        embedding_cache: Optional[PromptEmbeddingCache] = None,
     ):
         # clip skip is ignored currently
         self.tokenizer = tokenizer[0]
@@ -555,6 +652,8 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
         self.requires_safety_checker = requires_safety_checker
         self.vae = vae
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+        self.vae_tiling_kwargs = vae_tiling_kwargs or {}
+        self.embedding_cache = embedding_cache
         self.progress_bar = lambda x: logger.tqdm(x, leave=False, desc='inference')
 
         self.clip_skip = clip_skip
@@ -635,14 +734,24 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
                 " the batch size of `prompt`."
             )
 
-        text_embeddings, text_pool, uncond_embeddings, uncond_pool = get_weighted_text_embeddings(
-            pipe=self,
-            prompt=prompt,
-            uncond_prompt=negative_prompt if do_classifier_free_guidance else None,
-            max_embeddings_multiples=max_embeddings_multiples,
-            clip_skip=self.clip_skip,
-            is_sdxl_text_encoder2=is_sdxl_text_encoder2,
-        )
+        if self.embedding_cache is not None:
+            text_embeddings, text_pool, uncond_embeddings, uncond_pool = self.embedding_cache.get_weighted_text_embeddings(
+                self,
+                prompt,
+                negative_prompt if do_classifier_free_guidance else None,
+                max_embeddings_multiples,
+                self.clip_skip,
+                is_sdxl_text_encoder2,
+            )
+        else:
+            text_embeddings, text_pool, uncond_embeddings, uncond_pool = get_weighted_text_embeddings(
+                pipe=self,
+                prompt=prompt,
+                uncond_prompt=negative_prompt if do_classifier_free_guidance else None,
+                max_embeddings_multiples=max_embeddings_multiples,
+                clip_skip=self.clip_skip,
+                is_sdxl_text_encoder2=is_sdxl_text_encoder2,
+            )
         bs_embed, seq_len, _ = text_embeddings.shape
         text_embeddings = text_embeddings.repeat(1, num_images_per_prompt, 1)  # ??
         text_embeddings = text_embeddings.view(bs_embed * num_images_per_prompt, seq_len, -1)
@@ -711,7 +820,7 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
             # self.vae.set_use_memory_efficient_attention_xformers(False)
             # image = self.vae.decode(latents.to("cpu")).sample
 
-            image = self.vae.decode(latents.to(self.vae.dtype)).sample
+            image = vae_utils.decode(self.vae, latents.to(self.vae.dtype), **self.vae_tiling_kwargs)
             image = (image / 2 + 0.5).clamp(0, 1)
             # we always cast to float32 as this does not cause significant overhead and is compatible with bfloat16
             image = image.cpu().permute(0, 2, 3, 1).float().numpy()
@@ -758,7 +867,7 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
             latents = latents * self.scheduler.init_noise_sigma
             return latents, None, None
         else:
-            init_latent_dist = self.vae.encode(image).latent_dist
+            init_latent_dist = vae_utils.encode(self.vae, image, **self.vae_tiling_kwargs)
             init_latents = init_latent_dist.sample(generator=generator)
             init_latents = sdxl_model_utils.VAE_SCALE_FACTOR * init_latents
             init_latents = torch.cat([init_latents] * batch_size, dim=0)
@@ -800,6 +909,7 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         is_cancelled_callback: Optional[Callable[[], bool]] = None,
         callback_steps: int = 1,
+        cache_context_kv: bool = True,
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -871,6 +981,9 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
             callback_steps (`int`, *optional*, defaults to 1):
                 The frequency at which the `callback` function will be called. If not specified, the callback will be
                 called at every step.
+            cache_context_kv (`bool`, *optional*, defaults to `True`):
+                Whether or not to compute the key and value of the text embeddings in cross-attentions once and reuse
+                them across all denoising steps. Only works with the original SDXL U-Net.
 
         Returns:
             `None` if cancelled by `is_cancelled_callback`,
@@ -993,48 +1106,55 @@ class SdxlStableDiffusionLongPromptWeightingPipeline:
             vector_embedding = torch.cat([text_pool, embs], dim=1).to(dtype)
 
         # 8. Denoising loop
-        for i, t in enumerate(self.progress_bar(timesteps)):
-            # expand the latents if we are doing classifier free guidance
-            latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
-            latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-            unet_additional_args = {}
-            if controlnet is not None:
-                down_block_res_samples, mid_block_res_sample = controlnet(
-                    latent_model_input,
-                    t,
-                    encoder_hidden_states=text_embeddings,
-                    controlnet_cond=controlnet_image,
-                    conditioning_scale=1.0,
-                    guess_mode=False,
-                    return_dict=False,
-                )
-                unet_additional_args["down_block_additional_residuals"] = down_block_res_samples
-                unet_additional_args["mid_block_additional_residual"] = mid_block_res_sample
-
-            # predict the noise residual
-            noise_pred = self.unet(latent_model_input, t, text_embedding, vector_embedding)
-            noise_pred = noise_pred.to(dtype)  # U-Net changes dtype in LoRA training
-
-            # perform guidance
-            if do_classifier_free_guidance:
-                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-            # compute the previous noisy sample x_t -> x_t-1
-            latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
-
-            if mask is not None:
-                # masking
-                init_latents_proper = self.scheduler.add_noise(init_latents_orig, noise, torch.tensor([t]))
-                latents = (init_latents_proper * mask) + (latents * (1 - mask))
-
-            # call the callback, if provided
-            if i % callback_steps == 0:
-                if callback is not None:
-                    callback(i, t, latents)
-                if is_cancelled_callback is not None and is_cancelled_callback():
-                    return None
+        cache_context_kv = cache_context_kv and hasattr(self.unet, "set_context_kv_cache")
+        if cache_context_kv:
+            self.unet.set_context_kv_cache(True)
+        try:
+            for i, t in enumerate(self.progress_bar(timesteps)):
+                # expand the latents if we are doing classifier free guidance
+                latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
+
+                unet_additional_args = {}
+                if controlnet is not None:
+                    down_block_res_samples, mid_block_res_sample = controlnet(
+                        latent_model_input,
+                        t,
+                        encoder_hidden_states=text_embeddings,
+                        controlnet_cond=controlnet_image,
+                        conditioning_scale=1.0,
+                        guess_mode=False,
+                        return_dict=False,
+                    )
+                    unet_additional_args["down_block_additional_residuals"] = down_block_res_samples
+                    unet_additional_args["mid_block_additional_residual"] = mid_block_res_sample
+
+                # predict the noise residual
+                noise_pred = self.unet(latent_model_input, t, text_embedding, vector_embedding)
+                noise_pred = noise_pred.to(dtype)  # U-Net changes dtype in LoRA training
+
+                # perform guidance
+                if do_classifier_free_guidance:
+                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+                # compute the previous noisy sample x_t -> x_t-1
+                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+
+                if mask is not None:
+                    # masking
+                    init_latents_proper = self.scheduler.add_noise(init_latents_orig, noise, torch.tensor([t]))
+                    latents = (init_latents_proper * mask) + (latents * (1 - mask))
+
+                # call the callback, if provided
+                if i % callback_steps == 0:
+                    if callback is not None:
+                        callback(i, t, latents)
+                    if is_cancelled_callback is not None and is_cancelled_callback():
+                        return None
+        finally:
+            if cache_context_kv:
+                self.unet.set_context_kv_cache(False)
 
         return latents
 
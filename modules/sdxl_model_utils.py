@@ -1,12 +1,15 @@
 import torch
 import os
+import json
+import mmap
+import struct
 from accelerate import init_empty_weights
 from accelerate.utils.modeling import set_module_tensor_to_device
 from safetensors.torch import load_file, save_file
 from transformers import CLIPTextModel, CLIPTextConfig, CLIPTextModelWithProjection, CLIPTokenizer
 from typing import List
 from diffusers import AutoencoderKL, EulerDiscreteScheduler, UNet2DConditionModel
-from . import model_utils, sdxl_original_unet, log_utils
+from . import model_utils, sdxl_original_unet, checkpoint_utils, convert_utils, log_utils
 
 VAE_SCALE_FACTOR = 0.13025
 MODEL_VERSION_SDXL_BASE_V1_0 = "sdxl_base_v1-0"
@@ -62,6 +65,23 @@ DIFFUSERS_SDXL_UNET_CONFIG = {
     "use_linear_projection": True,
 }
 
+DIFFUSERS_SDXL_SCHEDULER_CONFIG = {
+    "beta_end": 0.012,
+    "beta_schedule": "scaled_linear",
+    "beta_start": 0.00085,
+    "clip_sample": False,
+    "interpolation_type": "linear",
+    "num_train_timesteps": 1000,
+    "prediction_type": "epsilon",
+    "sample_max_value": 1.0,
+    "set_alpha_to_one": False,
+    "skip_prk_steps": True,
+    "steps_offset": 1,
+    "timestep_spacing": "leading",
+    "trained_betas": None,
+    "use_karras_sigmas": False,
+}
+
 VAE_PARAMS_Z_CHANNELS = 4
 VAE_PARAMS_RESOLUTION = 256
 VAE_PARAMS_IN_CHANNELS = 3
@@ -73,6 +93,7 @@ VAE_PARAMS_NUM_RES_BLOCKS = 2
 logger = log_utils.get_logger("model")
 
 
+@convert_utils.planned
 def convert_sdxl_text_encoder_2_checkpoint(checkpoint, max_length):
     SDXL_KEY_PREFIX = "conditioner.embedders.1.model."
 
@@ -145,17 +166,11 @@ def convert_sdxl_text_encoder_2_checkpoint(checkpoint, max_length):
     return new_sd, logit_scale
 
 
-# load state_dict without allocating new tensors
-def _load_state_dict_on_device(model, state_dict, device, dtype=None):
-    # dtype will use fp32 as default
+def _check_state_dict_keys(model, state_dict):
     missing_keys = list(model.state_dict().keys() - state_dict.keys())
     unexpected_keys = list(state_dict.keys() - model.state_dict().keys())
-
-    # similar to model.load_state_dict()
     if not missing_keys and not unexpected_keys:
-        for k in list(state_dict.keys()):
-            set_module_tensor_to_device(model, k, device, value=state_dict.pop(k), dtype=dtype)
-        return "<All keys matched successfully>"
+        return
 
     # error_msgs
     error_msgs: List[str] = []
@@ -167,44 +182,223 @@ def _load_state_dict_on_device(model, state_dict, device, dtype=None):
     raise RuntimeError("Error(s) in loading state_dict for {}:\n\t{}".format(model.__class__.__name__, "\n\t".join(error_msgs)))
 
 
-def load_models_from_sdxl_checkpoint(model_version, ckpt_path, map_location, dtype=None):
-    # model_version is reserved for future use
-    # dtype is used for full_fp16/bf16 integration. Text Encoder will remain fp32, because it runs on CPU when caching
+# load state_dict without allocating new tensors
+def _load_state_dict_on_device(model, state_dict, device, dtype=None):
+    # dtype will use fp32 as default
+    # similar to model.load_state_dict()
+    _check_state_dict_keys(model, state_dict)
+    for k in list(state_dict.keys()):
+        set_module_tensor_to_device(model, k, device, value=state_dict.pop(k), dtype=dtype)
+    return "<All keys matched successfully>"
+
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
 
-    # Load the state dict
-    if model_utils.is_safetensors(ckpt_path):
-        checkpoint = None
-        try:
-            state_dict = load_file(ckpt_path, device=map_location)
-        except:
-            state_dict = load_file(ckpt_path)  # prevent device invalid Error
-        epoch = None
-        global_step = None
-    else:
-        checkpoint = torch.load(ckpt_path, map_location=map_location)
-        if "state_dict" in checkpoint:
-            state_dict = checkpoint["state_dict"]
-            epoch = checkpoint.get("epoch", 0)
-            global_step = checkpoint.get("global_step", 0)
+SAFETENSORS_DTYPE_NAMES = {dtype: name for name, dtype in SAFETENSORS_DTYPES.items()}
+
+
+def read_safetensors_header(path) -> dict:
+    r"""
+    Read the tensor entries (`dtype`, `shape` and `data_offsets`) of a safetensors file without reading any tensor data.
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    return header
+
+
+def read_safetensors_metadata(path) -> dict:
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    return header.get("__metadata__") or {}
+
+
+def is_delta_checkpoint(path):
+    return model_utils.is_safetensors(path) and os.path.isfile(path) and read_safetensors_metadata(path).get("format") == checkpoint_utils.DELTA_FORMAT
+
+
+def make_meta_state_dict(path) -> dict:
+    r"""
+    State dict of meta tensors with the shapes and dtypes of a safetensors file, in the order of the data in the file.
+    """
+    header = read_safetensors_header(path)
+    keys = sorted(header.keys(), key=lambda k: header[k]["data_offsets"][0])
+    return {k: torch.empty(header[k]["shape"], dtype=SAFETENSORS_DTYPES[header[k]["dtype"]], device="meta") for k in keys}
+
+
+class MmapSafetensors:
+    r"""
+    Zero-copy reader of a safetensors file. Tensors are views of a private (copy-on-write) memory map,
+    so that processes on the same node share the pages of the page cache until they write to them.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            self.data_start = 8 + header_size
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)  # the mapping stays valid after the file is closed
+        self.header = read_safetensors_header(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False  # do not close the mapping: loaded tensors are views of it
+
+    def keys(self):
+        return self.header.keys()
+
+    def get_tensor(self, key):
+        info = self.header[key]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if end == start:
+            return torch.empty(info["shape"], dtype=dtype)
+        offset = self.data_start + start
+        itemsize = torch.empty(0, dtype=dtype).element_size()
+        if offset % itemsize != 0:  # unaligned data can not be viewed
+            return torch.frombuffer(bytearray(self.mmap[offset:self.data_start + end]), dtype=dtype).reshape(info["shape"])
+        return torch.frombuffer(self.mmap, dtype=dtype, count=(end - start) // itemsize, offset=offset).reshape(info["shape"])
+
+
+class DeltaSafetensors:
+    r"""
+    Reader of a delta checkpoint written by `checkpoint_utils.DeltaCheckpointWriter`. Tensors are read from the base model
+    with the deltas applied on the fly, so that it reads like the full checkpoint. `base_path` overrides the base model recorded in the delta.
+    """
+
+    def __init__(self, path, base_path=None):
+        from safetensors import safe_open
+        metadata = read_safetensors_metadata(path)
+        assert metadata.get("format") == checkpoint_utils.DELTA_FORMAT, f"not a delta checkpoint: {path} / 差分チェックポイントではありません"
+        self.base_path = base_path or metadata["base"]
+        assert os.path.isfile(self.base_path), f"base model of the delta checkpoint not found: {self.base_path} / 差分チェックポイントのベースモデルが見つかりません"
+        if checkpoint_utils.get_file_fingerprint(self.base_path) != metadata.get("base_fingerprint"):
+            logger.print(log_utils.yellow(f"base model `{self.base_path}` differs from the one the delta checkpoint was saved against"))
+        self.dtype = getattr(torch, metadata["dtype"]) if metadata.get("dtype") else None
+        self.delta_header = read_safetensors_header(path)
+        self.base_header = read_safetensors_header(self.base_path)
+        dropped_keys = set(json.loads(metadata.get("dropped_keys", "[]")))
+        self.delta_source_keys = checkpoint_utils.get_delta_source_keys(self.delta_header.keys())
+        self._keys = [k for k in self.base_header if k not in dropped_keys] + [k for k in self.delta_header if k not in self.base_header and "::" not in k]
+        self.delta = safe_open(path, framework="pt", device="cpu")
+        self.base = safe_open(self.base_path, framework="pt", device="cpu")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def keys(self):
+        return self._keys
+
+    def make_meta_state_dict(self) -> dict:
+        r"""
+        Like `make_meta_state_dict`, in the order of the data in the base model.
+        """
+        def meta(info):
+            return torch.empty(info["shape"], dtype=SAFETENSORS_DTYPES[info["dtype"]], device="meta")
+
+        keys = sorted(self._keys, key=lambda k: self.base_header[k]["data_offsets"][0] if k in self.base_header else float("inf"))
+        return {k: meta(self.base_header[k] if k in self.base_header else self.delta_header[k]) for k in keys}
+
+    def get_tensor(self, key):
+        if key not in self.delta_source_keys:
+            tensor = self.base.get_tensor(key)
+            return tensor.to(self.dtype) if self.dtype is not None else tensor
+        delta_tensors = {k: self.delta.get_tensor(k) for k in (key, key + checkpoint_utils.LORA_UP_SUFFIX, key + checkpoint_utils.LORA_DOWN_SUFFIX,
+                                                               key + checkpoint_utils.DELTA_Q_SUFFIX, key + checkpoint_utils.DELTA_SCALE_SUFFIX) if k in self.delta_header}
+        base = self.base.get_tensor(key) if key in self.base_header and key not in delta_tensors else None
+        return checkpoint_utils.apply_delta(base, delta_tensors, key, dtype=self.dtype)
+
+
+class SafetensorsStreamWriter:
+    r"""
+    Writer of a safetensors file one tensor at a time. The header is written first from the shapes and dtypes of `entries`,
+    a dict of key -> (shape, dtype), then the tensors must be written in the order of `entries`. Tensors are cast to the dtype of their entry.
+    The file is written to a temporary path and renamed when all tensors are written.
+    """
+
+    def __init__(self, path, entries, metadata=None):
+        self.path = path
+        self.keys = list(entries.keys())
+        self.sizes = {}
+        header = {"__metadata__": metadata} if metadata else {}
+        offset = 0
+        for key, (shape, dtype) in entries.items():
+            size = torch.Size(shape).numel() * torch.empty(0, dtype=dtype).element_size()
+            header[key] = {"dtype": SAFETENSORS_DTYPE_NAMES[dtype], "shape": list(shape), "data_offsets": [offset, offset + size]}
+            self.sizes[key] = (tuple(shape), dtype, size)
+            offset += size
+        header = json.dumps(header, separators=(",", ":")).encode()
+        self.header = header + b" " * (-len(header) % 8)  # align the data to 8 bytes
+        self.num_written = 0
+        self.f = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.f = open(self.path + ".tmp", "wb")
+        self.f.write(struct.pack("<Q", len(self.header)))
+        self.f.write(self.header)
+        return self
+
+    def write(self, key, tensor):
+        assert key == self.keys[self.num_written], f"tensors must be written in the order of the header: {key} / テンソルはヘッダーの順に書き込む必要があります"
+        shape, dtype, size = self.sizes[key]
+        assert tuple(tensor.shape) == shape, f"unexpected shape of {key}: {tuple(tensor.shape)}, expected {shape}"
+        data = tensor.detach().to("cpu", dtype).contiguous().reshape(-1).view(torch.uint8).numpy()
+        assert data.nbytes == size
+        self.f.write(data.tobytes())
+        self.num_written += 1
+
+    def __exit__(self, exc_type, *exc):
+        self.f.close()
+        if exc_type is None and self.num_written == len(self.keys):
+            os.replace(self.path + ".tmp", self.path)
         else:
-            state_dict = checkpoint
-            epoch = 0
-            global_step = 0
-        checkpoint = None
-
+            os.remove(self.path + ".tmp")
+            if exc_type is None:
+                raise RuntimeError(f"{len(self.keys) - self.num_written} tensors of {self.path} were not written")
+        return False
+
+
+def materialize_delta_checkpoint(delta_path, output_path, base_path=None):
+    r"""
+    Write the full checkpoint of a delta checkpoint, as `save_stable_diffusion_checkpoint` would have saved it.
+    """
+    with DeltaSafetensors(delta_path, base_path=base_path) as f:
+        state_dict = {key: f.get_tensor(key).contiguous() for key in logger.tqdm(f.keys(), desc="materializing", leave=False)}
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    save_file(state_dict, output_path + ".tmp")
+    os.replace(output_path + ".tmp", output_path)
+    return len(state_dict)
+
+
+def build_sdxl_models():
+    r"""
+    SDXL U-Net, text encoders and VAE with empty weights.
+    """
     # U-Net
     logger.print("building U-Net")
     with init_empty_weights():
         unet = sdxl_original_unet.SdxlUNet2DConditionModel()
 
-    logger.print("loading U-Net from checkpoint")
-    unet_sd = {}
-    for k in list(state_dict.keys()):
-        if k.startswith("model.diffusion_model."):
-            unet_sd[k.replace("model.diffusion_model.", "")] = state_dict.pop(k)
-    info = _load_state_dict_on_device(unet, unet_sd, device=map_location, dtype=dtype)
-    logger.print("U-Net: ", info)
-
     # Text Encoders
     logger.print("building text encoders")
 
@@ -259,7 +453,25 @@ def load_models_from_sdxl_checkpoint(model_version, ckpt_path, map_location, dty
     with init_empty_weights():
         text_model2 = CLIPTextModelWithProjection(text_model2_cfg)
 
-    logger.print("loading text encoders from checkpoint")
+    # prepare vae
+    logger.print("building VAE")
+    vae_config = model_utils.create_vae_diffusers_config()
+    with init_empty_weights():
+        vae = AutoencoderKL(**vae_config)
+
+    return unet, text_model1, text_model2, vae
+
+
+def split_sdxl_state_dict(state_dict):
+    r"""
+    Split an SDXL checkpoint into the converted state dicts of U-Net, text encoder 1, text encoder 2 and VAE. Consumes `state_dict`.
+    Also works on meta tensors: then the values are the source tensors or views of them, which tell how to slice each source tensor.
+    """
+    unet_sd = {}
+    for k in list(state_dict.keys()):
+        if k.startswith("model.diffusion_model."):
+            unet_sd[k.replace("model.diffusion_model.", "")] = state_dict.pop(k)
+
     te1_sd = {}
     te2_sd = {}
     for k in list(state_dict.keys()):
@@ -272,22 +484,137 @@ def load_models_from_sdxl_checkpoint(model_version, ckpt_path, map_location, dty
     if "text_model.embeddings.position_ids" not in te1_sd:
         te1_sd["text_model.embeddings.position_ids"] = torch.arange(77).unsqueeze(0)
 
+    te2_sd, logit_scale = convert_sdxl_text_encoder_2_checkpoint(te2_sd, 77)
+    vae_sd = model_utils.convert_ldm_vae_checkpoint(state_dict, model_utils.create_vae_diffusers_config())
+    return unet_sd, te1_sd, te2_sd, vae_sd, logit_scale
+
+
+def _make_streaming_plan(meta_sd, converted_sds):
+    r"""
+    Map the source keys of `meta_sd` to the destinations of their tensors in `converted_sds`, a list of (model, converted meta state dict, dtype).
+    A destination is (model, key, dtype, view), where view is the (size, stride, storage offset) of a view into the source tensor, or None for the whole tensor.
+    Converted values which are not from the checkpoint, e.g. generated position ids, are returned as constants.
+    """
+    source_keys = {id(value): key for key, value in meta_sd.items()}
+    plan = {}
+    constants = []
+    for model, sd, dtype in converted_sds:
+        _check_state_dict_keys(model, sd)
+        for key, value in sd.items():
+            if value.device.type != "meta":
+                constants.append((model, key, dtype, value))
+                continue
+            base = value if id(value) in source_keys else value._base
+            if base is None or id(base) not in source_keys:
+                raise ValueError(f"converted tensor is not a view of a checkpoint tensor: {key}")
+            view = None if value is base else (tuple(value.size()), value.stride(), value.storage_offset())
+            plan.setdefault(source_keys[id(base)], []).append((model, key, dtype, view))
+    return plan, constants
+
+
+def _open_sdxl_checkpoint(ckpt_path, use_mmap=False):
+    r"""
+    Meta state dict of a safetensors checkpoint in the order of the data in the file, and a reader of its tensors.
+    """
+    from safetensors import safe_open
+
+    if is_delta_checkpoint(ckpt_path):
+        reader = DeltaSafetensors(ckpt_path)  # deltas are applied to the base tensors on the fly
+        return reader.make_meta_state_dict(), reader
+    if use_mmap:
+        return make_meta_state_dict(ckpt_path), MmapSafetensors(ckpt_path)
+    return make_meta_state_dict(ckpt_path), safe_open(ckpt_path, framework="pt", device="cpu")
+
+
+def load_models_from_sdxl_checkpoint_streaming(ckpt_path, map_location, dtype=None, use_mmap=False):
+    r"""
+    Load SDXL models from a safetensors checkpoint one tensor at a time. The key conversion is planned on meta tensors first,
+    then every tensor is read from the file and copied straight into its destination parameters, so that peak host memory is about one tensor.
+    With `use_mmap`, tensors are views of a memory map of the file instead of copies, see `MmapSafetensors`.
+    """
+    unet, text_model1, text_model2, vae = build_sdxl_models()
+
+    meta_sd, reader = _open_sdxl_checkpoint(ckpt_path, use_mmap=use_mmap)
+    unet_sd, te1_sd, te2_sd, vae_sd, logit_scale = split_sdxl_state_dict(dict(meta_sd))
+    converted_sds = [
+        (unet, unet_sd, dtype),
+        (text_model1, te1_sd, None),  # remain fp32
+        (text_model2, te2_sd, None),  # remain fp32
+        (vae, vae_sd, dtype),
+    ]
+    plan, constants = _make_streaming_plan(meta_sd, converted_sds)
+    logit_scale_key = next((key for key, value in meta_sd.items() if value is logit_scale), None)
+
+    logger.print("loading models from checkpoint")
+    with reader as f:
+        if logit_scale_key is not None:
+            logit_scale = f.get_tensor(logit_scale_key)
+        for source_key in logger.tqdm(meta_sd.keys(), desc="loading tensors", leave=False):
+            destinations = plan.get(source_key)
+            if not destinations:
+                continue
+            tensor = f.get_tensor(source_key)
+            for model, key, model_dtype, view in destinations:
+                value = tensor if view is None else tensor.as_strided(*view).contiguous()
+                set_module_tensor_to_device(model, key, map_location, value=value, dtype=model_dtype)
+            del tensor
+    for model, key, model_dtype, value in constants:
+        set_module_tensor_to_device(model, key, map_location, value=value, dtype=model_dtype)
+
+    for name in ("U-Net", "text encoder 1", "text encoder 2", "VAE"):
+        logger.print(f"{name}: <All keys matched successfully>")
+    return text_model1, text_model2, vae, unet, logit_scale, None
+
+
+def load_models_from_sdxl_checkpoint(model_version, ckpt_path, map_location, dtype=None, streaming=True, use_mmap=False):
+    # model_version is reserved for future use
+    # dtype is used for full_fp16/bf16 integration. Text Encoder will remain fp32, because it runs on CPU when caching
+
+    if streaming and model_utils.is_safetensors(ckpt_path):
+        try:
+            return load_models_from_sdxl_checkpoint_streaming(ckpt_path, map_location, dtype=dtype, use_mmap=use_mmap)
+        except ValueError as e:  # the conversion can not be planned as views, load the whole state dict instead
+            logger.print(log_utils.yellow(f"streaming load is not available, fall back to loading the whole checkpoint: {e}"))
+
+    # Load the state dict
+    if is_delta_checkpoint(ckpt_path):
+        with DeltaSafetensors(ckpt_path) as f:
+            state_dict = {key: f.get_tensor(key) for key in f.keys()}
+        epoch = None
+        global_step = None
+    elif model_utils.is_safetensors(ckpt_path):
+        checkpoint = None
+        try:
+            state_dict = load_file(ckpt_path, device=map_location)
+        except:
+            state_dict = load_file(ckpt_path)  # prevent device invalid Error
+        epoch = None
+        global_step = None
+    else:
+        checkpoint = torch.load(ckpt_path, map_location=map_location)
+        if "state_dict" in checkpoint:
+            state_dict = checkpoint["state_dict"]
+            epoch = checkpoint.get("epoch", 0)
+            global_step = checkpoint.get("global_step", 0)
+        else:
+            state_dict = checkpoint
+            epoch = 0
+            global_step = 0
+        checkpoint = None
+
+    unet, text_model1, text_model2, vae = build_sdxl_models()
+
+    logger.print("loading models from checkpoint")
+    unet_sd, te1_sd, te2_sd, vae_sd, logit_scale = split_sdxl_state_dict(state_dict)
+    info = _load_state_dict_on_device(unet, unet_sd, device=map_location, dtype=dtype)
+    logger.print("U-Net: ", info)
+
     info1 = _load_state_dict_on_device(text_model1, te1_sd, device=map_location)  # remain fp32
     logger.print("text encoder 1:", info1)
-
-    converted_sd, logit_scale = convert_sdxl_text_encoder_2_checkpoint(te2_sd, max_length=77)
-    info2 = _load_state_dict_on_device(text_model2, converted_sd, device=map_location)  # remain fp32
+    info2 = _load_state_dict_on_device(text_model2, te2_sd, device=map_location)  # remain fp32
     logger.print("text encoder 2:", info2)
 
-    # prepare vae
-    logger.print("building VAE")
-    vae_config = model_utils.create_vae_diffusers_config()
-    with init_empty_weights():
-        vae = AutoencoderKL(**vae_config)
-
-    logger.print("loading VAE from checkpoint")
-    converted_vae_checkpoint = model_utils.convert_ldm_vae_checkpoint(state_dict, vae_config)
-    info = _load_state_dict_on_device(vae, converted_vae_checkpoint, device=map_location, dtype=dtype)
+    info = _load_state_dict_on_device(vae, vae_sd, device=map_location, dtype=dtype)
     logger.print("VAE:", info)
 
     ckpt_info = (epoch, global_step) if epoch is not None else None
@@ -378,6 +705,7 @@ def make_unet_conversion_map():
     return unet_conversion_map
 
 
+@convert_utils.planned
 def convert_diffusers_unet_state_dict_to_sdxl(du_sd):
     unet_conversion_map = make_unet_conversion_map()
 
@@ -403,6 +731,7 @@ def convert_unet_state_dict(src_sd, conversion_map):
     return converted_sd
 
 
+@convert_utils.planned
 def convert_sdxl_unet_state_dict_to_diffusers(sd):
     unet_conversion_map = make_unet_conversion_map()
 
@@ -410,6 +739,7 @@ def convert_sdxl_unet_state_dict_to_diffusers(sd):
     return convert_unet_state_dict(sd, conversion_dict)
 
 
+@convert_utils.planned
 def convert_text_encoder_2_state_dict_to_sdxl(checkpoint, logit_scale):
     def convert_key(key):
         # position_idsの除去
@@ -486,28 +816,37 @@ def save_stable_diffusion_checkpoint(
     logit_scale,
     save_dtype=None,
 ):
-    os.makedirs(os.path.dirname(fp), exist_ok=True)
-    state_dict = {}
-
-    def update_sd(prefix, sd):
-        for k, v in sd.items():
-            key = prefix + k
-            if save_dtype is not None:
-                v = v.detach().clone().to("cpu").to(save_dtype)
-            state_dict[key] = v
-
-    # Convert the UNet model
-    update_sd("model.diffusion_model.", unet.state_dict())
-
-    # Convert the text encoders
-    update_sd("conditioner.embedders.0.transformer.", text_encoder1.state_dict())
+    return save_stable_diffusion_state_dicts(
+        fp,
+        text_encoder1_sd=text_encoder1.state_dict(),
+        text_encoder2_sd=text_encoder2.state_dict(),
+        unet_sd=unet.state_dict(),
+        epochs=epochs,
+        steps=steps,
+        ckpt_info=ckpt_info,
+        vae_sd=vae.state_dict(),
+        logit_scale=logit_scale,
+        save_dtype=save_dtype,
+    )
 
-    text_enc2_dict = convert_text_encoder_2_state_dict_to_sdxl(text_encoder2.state_dict(), logit_scale)
-    update_sd("conditioner.embedders.1.model.", text_enc2_dict)
 
-    # Convert the VAE
-    vae_dict = model_utils.convert_vae_state_dict(vae.state_dict())
-    update_sd("first_stage_model.", vae_dict)
+def save_stable_diffusion_state_dicts(
+    fp,
+    text_encoder1_sd,
+    text_encoder2_sd,
+    unet_sd,
+    epochs,
+    steps,
+    ckpt_info,
+    vae_sd,
+    logit_scale,
+    save_dtype=None,
+):
+    r"""
+    Convert the state dicts of the models into a SDXL checkpoint and write it to `fp` atomically: to a temporary file first, then renamed.
+    """
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    state_dict = make_stable_diffusion_state_dict(text_encoder1_sd, text_encoder2_sd, unet_sd, vae_sd, logit_scale, save_dtype)
 
     # Put together new checkpoint
     key_count = len(state_dict.keys())
@@ -521,14 +860,45 @@ def save_stable_diffusion_checkpoint(
     new_ckpt["epoch"] = epochs
     new_ckpt["global_step"] = steps
 
+    tmp_fp = fp + ".tmp"
     if model_utils.is_safetensors(fp):
-        save_file(state_dict, fp)
+        save_file(state_dict, tmp_fp)
     else:
-        torch.save(new_ckpt, fp)
+        torch.save(new_ckpt, tmp_fp)
+    os.replace(tmp_fp, fp)
 
     return key_count
 
 
+def make_stable_diffusion_state_dict(text_encoder1_sd, text_encoder2_sd, unet_sd, vae_sd, logit_scale, save_dtype=None):
+    r"""
+    State dict of a SDXL checkpoint from the state dicts of the models. Tensors are cast to `save_dtype` on CPU if given, otherwise kept as is.
+    """
+    state_dict = {}
+
+    def update_sd(prefix, sd):
+        for k, v in sd.items():
+            key = prefix + k
+            if save_dtype is not None:
+                v = v.detach().clone().to("cpu").to(save_dtype)
+            state_dict[key] = v
+
+    # Convert the UNet model
+    update_sd("model.diffusion_model.", unet_sd)
+
+    # Convert the text encoders
+    update_sd("conditioner.embedders.0.transformer.", text_encoder1_sd)
+
+    text_enc2_dict = convert_text_encoder_2_state_dict_to_sdxl(text_encoder2_sd, logit_scale)
+    update_sd("conditioner.embedders.1.model.", text_enc2_dict)
+
+    # Convert the VAE
+    vae_dict = model_utils.convert_vae_state_dict(vae_sd)
+    update_sd("first_stage_model.", vae_dict)
+
+    return state_dict
+
+
 def save_train_state(
     fp: str,
     optimizer,
@@ -607,3 +977,87 @@ def save_diffusers_checkpoint(
     if save_dtype is not None:
         pipeline.to(None, save_dtype)
     pipeline.save_pretrained(output_dir, safe_serialization=use_safetensors)
+
+
+def export_diffusers_checkpoint(ckpt_path, output_dir, save_dtype=None, tokenizer_paths=(None, None), use_mmap=False):
+    r"""
+    Export an SDXL safetensors checkpoint to the Diffusers directory layout without instantiating the pipeline or any model weights.
+    Configs are written from models with empty weights, and every tensor is read once from the checkpoint, converted and streamed
+    straight into the safetensors file of its component, so that peak host memory is about one tensor and no network access is needed.
+    Tokenizers are copied from `tokenizer_paths` (local directories of `CLIPTokenizer`), or left out of the pipeline if not given.
+    """
+    import diffusers
+
+    # models with empty weights only provide the configs and the expected keys
+    _, text_model1, text_model2, vae = build_sdxl_models()
+    with init_empty_weights():
+        unet = UNet2DConditionModel(**DIFFUSERS_SDXL_UNET_CONFIG)
+        vae = AutoencoderKL(**model_utils.create_vae_diffusers_config(), scaling_factor=VAE_SCALE_FACTOR)
+
+    meta_sd, reader = _open_sdxl_checkpoint(ckpt_path, use_mmap=use_mmap)
+    unet_sd, te1_sd, te2_sd, vae_sd, _ = split_sdxl_state_dict(dict(meta_sd))
+    unet_sd = convert_sdxl_unet_state_dict_to_diffusers(unet_sd)
+    components = [
+        ("unet", unet, unet_sd, "diffusion_pytorch_model.safetensors"),
+        ("text_encoder", text_model1, te1_sd, "model.safetensors"),
+        ("text_encoder_2", text_model2, te2_sd, "model.safetensors"),
+        ("vae", vae, vae_sd, "diffusion_pytorch_model.safetensors"),
+    ]
+    plan, constants = _make_streaming_plan(meta_sd, [(model, sd, save_dtype) for _, model, sd, _ in components])
+
+    # write the configs
+    os.makedirs(output_dir, exist_ok=True)
+    unet.save_config(os.path.join(output_dir, "unet"))
+    vae.save_config(os.path.join(output_dir, "vae"))
+    for name, text_model in (("text_encoder", text_model1), ("text_encoder_2", text_model2)):
+        text_model.config.architectures = [text_model.__class__.__name__]
+        text_model.config.save_pretrained(os.path.join(output_dir, name))
+    EulerDiscreteScheduler.from_config(DIFFUSERS_SDXL_SCHEDULER_CONFIG).save_config(os.path.join(output_dir, "scheduler"))
+    tokenizer_classes = []
+    for name, tokenizer_path in zip(("tokenizer", "tokenizer_2"), tokenizer_paths):
+        if tokenizer_path is not None and os.path.isdir(tokenizer_path):
+            CLIPTokenizer.from_pretrained(tokenizer_path).save_pretrained(os.path.join(output_dir, name))
+            tokenizer_classes.append(["transformers", "CLIPTokenizer"])
+        else:
+            logger.print(log_utils.yellow(f"no local tokenizer for `{name}`, the pipeline is exported without it"))
+            tokenizer_classes.append([None, None])
+    model_index = {
+        "_class_name": "StableDiffusionXLPipeline",
+        "_diffusers_version": diffusers.__version__,
+        "force_zeros_for_empty_prompt": True,
+        "scheduler": ["diffusers", "EulerDiscreteScheduler"],
+        "text_encoder": ["transformers", "CLIPTextModel"],
+        "text_encoder_2": ["transformers", "CLIPTextModelWithProjection"],
+        "tokenizer": tokenizer_classes[0],
+        "tokenizer_2": tokenizer_classes[1],
+        "unet": ["diffusers", "UNet2DConditionModel"],
+        "vae": ["diffusers", "AutoencoderKL"],
+    }
+    with open(os.path.join(output_dir, "model_index.json"), "w") as f:
+        json.dump(model_index, f, indent=2, sort_keys=True)
+
+    # the tensors of every component in the order they are read from the checkpoint. only floating point tensors are cast, not position ids
+    def get_dtype(dtype, source_dtype):
+        return dtype if dtype is not None and source_dtype.is_floating_point else source_dtype
+
+    entries = {model: {} for _, model, _, _ in components}
+    for source_key, source in meta_sd.items():
+        for model, key, dtype, view in plan.get(source_key, []):
+            entries[model][key] = (source.shape if view is None else view[0], get_dtype(dtype, source.dtype))
+    for model, key, dtype, value in constants:
+        entries[model][key] = (value.shape, get_dtype(dtype, value.dtype))
+
+    logger.print(f"exporting to Diffusers format: {output_dir}")
+    writers = {model: SafetensorsStreamWriter(os.path.join(output_dir, name, file_name), entries[model], {"format": "pt"}) for name, model, _, file_name in components}
+    with reader as f, writers[unet], writers[text_model1], writers[text_model2], writers[vae]:
+        for source_key in logger.tqdm(meta_sd.keys(), desc="exporting tensors", leave=False):
+            destinations = plan.get(source_key)
+            if not destinations:
+                continue
+            tensor = f.get_tensor(source_key)
+            for model, key, _, view in destinations:
+                writers[model].write(key, tensor if view is None else tensor.as_strided(*view))
+            del tensor
+        for model, key, _, value in constants:
+            writers[model].write(key, value)
+    return {name: len(entries[model]) for name, model, _, _ in components}
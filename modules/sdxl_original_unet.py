@@ -25,7 +25,7 @@
 import logging
 import math
 from types import SimpleNamespace
-from typing import Any, Optional
+from typing import Any, Dict, Optional
 import torch
 import torch.utils.checkpoint
 from torch import nn
@@ -46,6 +46,9 @@ TIME_EMBED_DIM = 320 * 4
 
 USE_REENTRANT = True
 
+# module types which support gradient checkpointing
+CHECKPOINT_MODULE_TYPES = ("ResnetBlock2D", "Downsample2D", "Upsample2D", "BasicTransformerBlock")
+
 # region memory efficient attention
 
 # FlashAttentionを使うCrossAttention
@@ -271,6 +274,21 @@ def get_timestep_embedding(
     return emb
 
 
+def is_compiling() -> bool:
+    if hasattr(torch, "compiler") and hasattr(torch.compiler, "is_compiling"):
+        return torch.compiler.is_compiling()
+    return torch._dynamo.is_compiling()
+
+
+def mark_spatial_dynamic(x) -> None:
+    r"""
+    Mark the height and width of `x` dynamic for `torch.compile`, so that all buckets share one graph instead of recompiling per bucket.
+    """
+    mark = getattr(torch._dynamo, "maybe_mark_dynamic", torch._dynamo.mark_dynamic)
+    mark(x, 2)
+    mark(x, 3)
+
+
 # Deep Shrink: We do not common this function, because minimize dependencies.
 def resize_like(x, target, mode="bicubic", align_corners=False):
     org_dtype = x.dtype
@@ -288,18 +306,61 @@ def resize_like(x, target, mode="bicubic", align_corners=False):
     return x
 
 
+class MemoryLeanOptions:
+    r"""
+    Options of the memory-lean execution shared by `FeedForward` and `GroupNorm32` modules of a U-Net.
+    They are active only for inputs of at least `min_resolution`^2 pixels, which is updated by the U-Net at every forward.
+    """
+
+    def __init__(self, ff_chunk_size=None, group_norm_chunks=None, min_resolution=None):
+        self.ff_chunk_size = ff_chunk_size
+        self.group_norm_chunks = group_norm_chunks
+        self.min_resolution = min_resolution
+        self.active = min_resolution is None
+
+    def update(self, x):
+        if self.min_resolution is not None:
+            self.active = x.shape[-2] * x.shape[-1] * 64 >= self.min_resolution ** 2  # latents are 1/8 of pixels
+
+
 class GroupNorm32(nn.GroupNorm):
+    memory_lean: Optional[MemoryLeanOptions] = None
+
     def forward(self, x):
         if self.weight.dtype != torch.float32:
             return super().forward(x)
+        lean = self.memory_lean
+        if lean is not None and lean.active and lean.group_norm_chunks and x.dtype != torch.float32:
+            return self.forward_chunked(x, lean.group_norm_chunks)
         return super().forward(x.float()).type(x.dtype)
 
+    def forward_chunked(self, x, num_chunks):
+        # groups are normalized independently, so upcast and normalize chunks of groups one by one instead of the whole tensor
+        # with autograd, every chunk is checkpointed, otherwise the float copies of all chunks would be kept for backward
+        groups_per_chunk = math.ceil(self.num_groups / num_chunks)
+        channels_per_group = self.num_channels // self.num_groups
+        outputs = []
+        for group in range(0, self.num_groups, groups_per_chunk):
+            num_groups = min(groups_per_chunk, self.num_groups - group)
+            start, end = group * channels_per_group, (group + num_groups) * channels_per_group
+
+            def normalize(x, weight, bias, num_groups=num_groups):
+                return F.group_norm(x.float(), num_groups, weight, bias, self.eps).type(x.dtype)
+
+            args = (x[:, start:end], self.weight[start:end], self.bias[start:end])
+            if torch.is_grad_enabled():
+                outputs.append(torch.utils.checkpoint.checkpoint(normalize, *args, use_reentrant=False))
+            else:
+                outputs.append(normalize(*args))
+        return torch.cat(outputs, dim=1)
+
 
 class ResnetBlock2D(nn.Module):
     def __init__(
         self,
         in_channels,
         out_channels,
+        time_embed_dim=TIME_EMBED_DIM,
     ):
         super().__init__()
         self.in_channels = in_channels
@@ -311,7 +372,7 @@ class ResnetBlock2D(nn.Module):
             nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=1, padding=1),
         )
 
-        self.emb_layers = nn.Sequential(nn.SiLU(), nn.Linear(TIME_EMBED_DIM, out_channels))
+        self.emb_layers = nn.Sequential(nn.SiLU(), nn.Linear(time_embed_dim, out_channels))
 
         self.out_layers = nn.Sequential(
             GroupNorm32(32, out_channels),
@@ -388,6 +449,45 @@ class Downsample2D(nn.Module):
         return hidden_states
 
 
+def fuse_linears(*linears) -> nn.Linear:
+    r"""
+    Concatenate the weights of bias-free linear layers with the same input into a single linear layer.
+    """
+    weight = torch.cat([linear.weight.data for linear in linears], dim=0)
+    fused = nn.Linear(linears[0].in_features, weight.shape[0], bias=False, device="meta")
+    fused.weight = nn.Parameter(weight, requires_grad=linears[0].weight.requires_grad)
+    return fused
+
+
+def split_linear(fused: nn.Linear, num_splits: int):
+    linears = []
+    for weight in fused.weight.data.chunk(num_splits, dim=0):
+        linear = nn.Linear(fused.in_features, weight.shape[0], bias=False, device="meta")
+        linear.weight = nn.Parameter(weight.clone(), requires_grad=fused.weight.requires_grad)
+        linears.append(linear)
+    return linears
+
+
+def _split_fused_projections_hook(module, state_dict, prefix, local_metadata):
+    # save fused projections as separate `to_q`, `to_k` and `to_v` to keep checkpoints compatible
+    if not module.fused_projections:
+        return
+    fused_name, names = module.fused_projection_names
+    weight = state_dict.pop(prefix + fused_name + ".weight")
+    for name, w in zip(names, weight.chunk(len(names), dim=0)):
+        state_dict[prefix + name + ".weight"] = w.clone()  # do not share memory, which safetensors refuses to save
+
+
+def _fuse_projections_pre_hook(module, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    # load separate `to_q`, `to_k` and `to_v` into fused projections
+    if not module.fused_projections:
+        return
+    fused_name, names = module.fused_projection_names
+    keys = [prefix + name + ".weight" for name in names]
+    if all(key in state_dict for key in keys):
+        state_dict[prefix + fused_name + ".weight"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
+
 class CrossAttention(nn.Module):
     def __init__(
         self,
@@ -399,7 +499,9 @@ class CrossAttention(nn.Module):
     ):
         super().__init__()
         inner_dim = dim_head * heads
+        self.is_cross_attention = cross_attention_dim is not None
         cross_attention_dim = cross_attention_dim if cross_attention_dim is not None else query_dim
+        self.cross_attention_dim = cross_attention_dim
         self.upcast_attention = upcast_attention
 
         self.scale = dim_head**-0.5
@@ -417,6 +519,12 @@ class CrossAttention(nn.Module):
         self.use_memory_efficient_attention_mem_eff = False
         self.use_sdpa = False
 
+        self.fused_projections = False
+        self.cache_context_kv = False
+        self.context_kv_cache = None
+        self._register_state_dict_hook(_split_fused_projections_hook)
+        self._register_load_state_dict_pre_hook(_fuse_projections_pre_hook, with_module=True)
+
     def set_use_memory_efficient_attention(self, xformers, mem_eff):
         self.use_memory_efficient_attention_xformers = xformers
         self.use_memory_efficient_attention_mem_eff = mem_eff
@@ -424,6 +532,64 @@ class CrossAttention(nn.Module):
     def set_use_sdpa(self, sdpa):
         self.use_sdpa = sdpa
 
+    @property
+    def fused_projection_names(self):
+        if self.is_cross_attention:
+            return "to_kv", ("to_k", "to_v")
+        return "to_qkv", ("to_q", "to_k", "to_v")
+
+    def set_fused_projections(self, fused: bool):
+        r"""
+        Fuse `to_q`, `to_k` and `to_v` into a single `to_qkv` for self-attention, or `to_k` and `to_v` into `to_kv` for cross-attention.
+        `state_dict` and `load_state_dict` still use the separate weights, so checkpoints stay compatible.
+        """
+        if fused == self.fused_projections:
+            return
+        fused_name, names = self.fused_projection_names
+        if fused:
+            setattr(self, fused_name, fuse_linears(*[getattr(self, name) for name in names]))
+            for name in names:
+                delattr(self, name)
+        else:
+            for name, linear in zip(names, split_linear(getattr(self, fused_name), len(names))):
+                setattr(self, name, linear)
+            delattr(self, fused_name)
+        self.fused_projections = fused
+
+    def project_qkv(self, x, context=None):
+        r"""
+        Project to query, key and value of shape `b n h d`. They are strided views of the output of the fused projection, without copies.
+        """
+        h = self.heads
+        if not self.is_cross_attention:
+            assert context is None, "self-attention does not take context / self-attentionにcontextは渡せません"
+            q, k, v = self.to_qkv(x).unflatten(-1, (3, h, -1)).unbind(2)
+        else:
+            q = self.to_q(x).unflatten(-1, (h, -1))
+            k, v = self.project_kv(context, x.dtype)
+        return q, k, v
+
+    def set_cache_context_kv(self, cache: bool):
+        self.cache_context_kv = cache
+        self.context_kv_cache = None
+
+    def project_kv(self, context, dtype=None):
+        r"""
+        Key and value projections of `context`: `b n (h d)` for separate projections, or `b n h d` views for fused projections.
+        While `cache_context_kv` is enabled, they are computed once and reused as long as the same unmodified context is passed, e.g. across denoising steps.
+        """
+        cache_key = (context._version, dtype)
+        if self.context_kv_cache is not None and self.context_kv_cache[0] is context and self.context_kv_cache[1] == cache_key:
+            return self.context_kv_cache[2]
+        context_in = context if dtype is None else context.to(dtype)
+        if self.fused_projections:
+            kv = tuple(self.to_kv(context_in).unflatten(-1, (2, self.heads, -1)).unbind(2))
+        else:
+            kv = (self.to_k(context_in), self.to_v(context_in))
+        if self.cache_context_kv:
+            self.context_kv_cache = (context, cache_key, kv)
+        return kv
+
     def reshape_heads_to_batch_dim(self, tensor):
         batch_size, seq_len, dim = tensor.shape
         head_size = self.heads
@@ -439,6 +605,8 @@ class CrossAttention(nn.Module):
         return tensor
 
     def forward(self, hidden_states, context=None, mask=None):
+        if self.fused_projections:
+            return self.forward_fused(hidden_states, context, mask)
         if self.use_memory_efficient_attention_xformers:
             return self.forward_memory_efficient_xformers(hidden_states, context, mask)
         if self.use_memory_efficient_attention_mem_eff:
@@ -448,8 +616,7 @@ class CrossAttention(nn.Module):
 
         query = self.to_q(hidden_states)
         context = context if context is not None else hidden_states
-        key = self.to_k(context)
-        value = self.to_v(context)
+        key, value = self.project_kv(context)
 
         query = self.reshape_heads_to_batch_dim(query)
         key = self.reshape_heads_to_batch_dim(key)
@@ -486,6 +653,30 @@ class CrossAttention(nn.Module):
         hidden_states = self.reshape_batch_dim_to_heads(hidden_states)
         return hidden_states
 
+    def forward_fused(self, x, context=None, mask=None):
+        q, k, v = self.project_qkv(x, context)  # b n h d
+
+        if self.use_memory_efficient_attention_xformers:
+            import xformers.ops
+
+            out = xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None)
+        else:
+            q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)  # b h n d, still views
+            if self.use_memory_efficient_attention_mem_eff:
+                out = FlashAttentionFunction.apply(q, k, v, mask, False, 512, 1024)
+            elif self.use_sdpa:
+                out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0, is_causal=False)
+            else:
+                if self.upcast_attention:
+                    q = q.float()
+                    k = k.float()
+                attention_probs = torch.matmul(q, k.transpose(-1, -2)).mul_(self.scale).softmax(dim=-1)
+                out = torch.matmul(attention_probs.to(v.dtype), v)
+            out = out.transpose(1, 2)
+
+        out = self.to_out[0](out.flatten(2))
+        return out
+
     # TODO support Hypernetworks
     def forward_memory_efficient_xformers(self, x, context=None, mask=None):
         import xformers.ops
@@ -493,9 +684,7 @@ class CrossAttention(nn.Module):
         h = self.heads
         q_in = self.to_q(x)
         context = context if context is not None else x
-        context = context.to(x.dtype)
-        k_in = self.to_k(context)
-        v_in = self.to_v(context)
+        k_in, v_in = self.project_kv(context, x.dtype)
 
         q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b n h d", h=h), (q_in, k_in, v_in))
         del q_in, k_in, v_in
@@ -520,9 +709,7 @@ class CrossAttention(nn.Module):
         h = self.heads
         q = self.to_q(x)
         context = context if context is not None else x
-        context = context.to(x.dtype)
-        k = self.to_k(context)
-        v = self.to_v(context)
+        k, v = self.project_kv(context, x.dtype)
         del context, x
 
         q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b h n d", h=h), (q, k, v))
@@ -538,9 +725,7 @@ class CrossAttention(nn.Module):
         h = self.heads
         q_in = self.to_q(x)
         context = context if context is not None else x
-        context = context.to(x.dtype)
-        k_in = self.to_k(context)
-        v_in = self.to_v(context)
+        k_in, v_in = self.project_kv(context, x.dtype)
 
         q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b h n d", h=h), (q_in, k_in, v_in))
         del q_in, k_in, v_in
@@ -594,11 +779,24 @@ class FeedForward(nn.Module):
         # project out
         self.net.append(nn.Linear(inner_dim, dim))
 
-    def forward(self, hidden_states):
+        self.memory_lean: Optional[MemoryLeanOptions] = None
+
+    def forward_body(self, hidden_states):
         for module in self.net:
             hidden_states = module(hidden_states)
         return hidden_states
 
+    def forward(self, hidden_states):
+        lean = self.memory_lean
+        if lean is not None and lean.active and lean.ff_chunk_size and hidden_states.shape[1] > lean.ff_chunk_size:
+            # tokens are independent in feed-forward, so only a chunk of the 8x wide intermediate is alive at a time.
+            # with autograd, every chunk is checkpointed, otherwise the intermediates of all chunks would be kept for backward
+            chunks = hidden_states.split(lean.ff_chunk_size, dim=1)
+            if torch.is_grad_enabled():
+                return torch.cat([torch.utils.checkpoint.checkpoint(self.forward_body, chunk, use_reentrant=False) for chunk in chunks], dim=1)
+            return torch.cat([self.forward_body(chunk) for chunk in chunks], dim=1)
+        return self.forward_body(hidden_states)
+
 
 class BasicTransformerBlock(nn.Module):
     def __init__(
@@ -823,17 +1021,31 @@ class SdxlUNet2DConditionModel(nn.Module):
 
     def __init__(
         self,
+        model_channels: int = MODEL_CHANNELS,
+        transformer_depth=(1, 2, 10),  # the first is unused
+        context_dim: int = CONTEXT_DIM,
+        adm_in_channels: int = ADM_IN_CHANNELS,
+        num_head_channels: int = 64,
         **kwargs,
     ):
+        r"""
+        Default arguments build the SDXL base U-Net. Smaller `model_channels` and `transformer_depth` build a reduced model with the same structure, e.g. for benchmarks.
+        """
         super().__init__()
 
         self.in_channels = IN_CHANNELS
         self.out_channels = OUT_CHANNELS
-        self.model_channels = MODEL_CHANNELS
-        self.time_embed_dim = TIME_EMBED_DIM
-        self.adm_in_channels = ADM_IN_CHANNELS
+        self.model_channels = model_channels
+        self.time_embed_dim = model_channels * 4
+        self.adm_in_channels = adm_in_channels
+        self.context_dim = context_dim
+        self.transformer_depth = tuple(transformer_depth)
+        self.num_head_channels = num_head_channels
 
         self.gradient_checkpointing = False
+        self.memory_lean: Optional[MemoryLeanOptions] = None
+        self.compiled_forward = None
+        self.compile_dynamic_spatial = False
         # self.sample_size = sample_size
 
         # time embedding
@@ -867,6 +1079,7 @@ class SdxlUNet2DConditionModel(nn.Module):
                 ResnetBlock2D(
                     in_channels=1 * self.model_channels,
                     out_channels=1 * self.model_channels,
+                    time_embed_dim=self.time_embed_dim,
                 ),
             ]
             self.input_blocks.append(nn.ModuleList(layers))
@@ -886,14 +1099,15 @@ class SdxlUNet2DConditionModel(nn.Module):
                 ResnetBlock2D(
                     in_channels=(1 if i == 0 else 2) * self.model_channels,
                     out_channels=2 * self.model_channels,
+                    time_embed_dim=self.time_embed_dim,
                 ),
                 Transformer2DModel(
-                    num_attention_heads=2 * self.model_channels // 64,
-                    attention_head_dim=64,
+                    num_attention_heads=2 * self.model_channels // self.num_head_channels,
+                    attention_head_dim=self.num_head_channels,
                     in_channels=2 * self.model_channels,
-                    num_transformer_layers=2,
+                    num_transformer_layers=self.transformer_depth[1],
                     use_linear_projection=True,
-                    cross_attention_dim=2048,
+                    cross_attention_dim=self.context_dim,
                 ),
             ]
             self.input_blocks.append(nn.ModuleList(layers))
@@ -913,14 +1127,15 @@ class SdxlUNet2DConditionModel(nn.Module):
                 ResnetBlock2D(
                     in_channels=(2 if i == 0 else 4) * self.model_channels,
                     out_channels=4 * self.model_channels,
+                    time_embed_dim=self.time_embed_dim,
                 ),
                 Transformer2DModel(
-                    num_attention_heads=4 * self.model_channels // 64,
-                    attention_head_dim=64,
+                    num_attention_heads=4 * self.model_channels // self.num_head_channels,
+                    attention_head_dim=self.num_head_channels,
                     in_channels=4 * self.model_channels,
-                    num_transformer_layers=10,
+                    num_transformer_layers=self.transformer_depth[2],
                     use_linear_projection=True,
-                    cross_attention_dim=2048,
+                    cross_attention_dim=self.context_dim,
                 ),
             ]
             self.input_blocks.append(nn.ModuleList(layers))
@@ -931,18 +1146,20 @@ class SdxlUNet2DConditionModel(nn.Module):
                 ResnetBlock2D(
                     in_channels=4 * self.model_channels,
                     out_channels=4 * self.model_channels,
+                    time_embed_dim=self.time_embed_dim,
                 ),
                 Transformer2DModel(
-                    num_attention_heads=4 * self.model_channels // 64,
-                    attention_head_dim=64,
+                    num_attention_heads=4 * self.model_channels // self.num_head_channels,
+                    attention_head_dim=self.num_head_channels,
                     in_channels=4 * self.model_channels,
-                    num_transformer_layers=10,
+                    num_transformer_layers=self.transformer_depth[2],
                     use_linear_projection=True,
-                    cross_attention_dim=2048,
+                    cross_attention_dim=self.context_dim,
                 ),
                 ResnetBlock2D(
                     in_channels=4 * self.model_channels,
                     out_channels=4 * self.model_channels,
+                    time_embed_dim=self.time_embed_dim,
                 ),
             ]
         )
@@ -956,14 +1173,15 @@ class SdxlUNet2DConditionModel(nn.Module):
                 ResnetBlock2D(
                     in_channels=4 * self.model_channels + (4 if i <= 1 else 2) * self.model_channels,
                     out_channels=4 * self.model_channels,
+                    time_embed_dim=self.time_embed_dim,
                 ),
                 Transformer2DModel(
-                    num_attention_heads=4 * self.model_channels // 64,
-                    attention_head_dim=64,
+                    num_attention_heads=4 * self.model_channels // self.num_head_channels,
+                    attention_head_dim=self.num_head_channels,
                     in_channels=4 * self.model_channels,
-                    num_transformer_layers=10,
+                    num_transformer_layers=self.transformer_depth[2],
                     use_linear_projection=True,
-                    cross_attention_dim=2048,
+                    cross_attention_dim=self.context_dim,
                 ),
             ]
             if i == 2:
@@ -982,14 +1200,15 @@ class SdxlUNet2DConditionModel(nn.Module):
                 ResnetBlock2D(
                     in_channels=2 * self.model_channels + (4 if i == 0 else (2 if i == 1 else 1)) * self.model_channels,
                     out_channels=2 * self.model_channels,
+                    time_embed_dim=self.time_embed_dim,
                 ),
                 Transformer2DModel(
-                    num_attention_heads=2 * self.model_channels // 64,
-                    attention_head_dim=64,
+                    num_attention_heads=2 * self.model_channels // self.num_head_channels,
+                    attention_head_dim=self.num_head_channels,
                     in_channels=2 * self.model_channels,
-                    num_transformer_layers=2,
+                    num_transformer_layers=self.transformer_depth[1],
                     use_linear_projection=True,
-                    cross_attention_dim=2048,
+                    cross_attention_dim=self.context_dim,
                 ),
             ]
             if i == 2:
@@ -1008,6 +1227,7 @@ class SdxlUNet2DConditionModel(nn.Module):
                 ResnetBlock2D(
                     in_channels=1 * self.model_channels + (2 if i == 0 else 1) * self.model_channels,
                     out_channels=1 * self.model_channels,
+                    time_embed_dim=self.time_embed_dim,
                 ),
             ]
 
@@ -1038,9 +1258,9 @@ class SdxlUNet2DConditionModel(nn.Module):
     def is_gradient_checkpointing(self) -> bool:
         return any(hasattr(m, "gradient_checkpointing") and m.gradient_checkpointing for m in self.modules())
 
-    def enable_gradient_checkpointing(self):
+    def enable_gradient_checkpointing(self, blocks=None, module_types=None):
         self.gradient_checkpointing = True
-        self.set_gradient_checkpointing(value=True)
+        self.set_gradient_checkpointing(value=True, blocks=blocks, module_types=module_types)
 
     def disable_gradient_checkpointing(self):
         self.gradient_checkpointing = False
@@ -1061,17 +1281,130 @@ class SdxlUNet2DConditionModel(nn.Module):
                 if hasattr(module, "set_use_sdpa"):
                     module.set_use_sdpa(sdpa)
 
-    def set_gradient_checkpointing(self, value=False):
-        blocks = self.input_blocks + [self.middle_block] + self.output_blocks
-        for block in blocks:
+    def set_context_kv_cache(self, cache: bool) -> None:
+        r"""
+        Cache the key and value projections of the text context in every cross-attention, so that they are computed once per prompt batch during sampling.
+        Only for inference: disable it to free the cache.
+        """
+        for module in self.modules():
+            if isinstance(module, CrossAttention) and module.is_cross_attention:
+                module.set_cache_context_kv(cache)
+
+    def set_memory_lean(self, ff_chunk_size=None, group_norm_chunks=None, min_resolution=None) -> None:
+        r"""
+        Run feed-forwards in chunks of `ff_chunk_size` tokens and upcast GroupNorm32 in `group_norm_chunks` chunks of groups,
+        for inputs of at least `min_resolution`^2 pixels (all inputs if None). Outputs are the same, only peak memory differs.
+        """
+        memory_lean = MemoryLeanOptions(ff_chunk_size, group_norm_chunks, min_resolution) if ff_chunk_size or group_norm_chunks else None
+        self.memory_lean = memory_lean
+        for module in self.modules():
+            if isinstance(module, (FeedForward, GroupNorm32)):
+                module.memory_lean = memory_lean
+
+    def set_fused_projections(self, fused: bool) -> None:
+        for module in self.modules():
+            if isinstance(module, CrossAttention):
+                module.set_fused_projections(fused)
+
+    def set_torch_compile(self, enable: bool, dynamic_spatial: bool = True, **compile_kwargs) -> None:
+        r"""
+        Run `forward` through `torch.compile(**compile_kwargs)`. With `dynamic_spatial`, the latent height and width are marked dynamic so that one graph serves all buckets.
+        Otherwise shapes are static and a graph is compiled per bucket, see `sdxl_train_utils.prewarm_compiled_unet`.
+        """
+        if not enable:
+            self.compiled_forward = None
+            return
+        compile_kwargs.setdefault("dynamic", None if dynamic_spatial else False)
+        self.compiled_forward = torch.compile(type(self).forward, **compile_kwargs)
+        self.compile_dynamic_spatial = dynamic_spatial
+
+    def set_gradient_checkpointing(self, value=False, blocks=None, module_types=None):
+        r"""
+        Set gradient checkpointing of the modules in `blocks` (block indices of `get_checkpoint_blocks`) whose class names are in `module_types`.
+        All blocks or module types are selected when None. Modules which are not selected are set to False.
+        """
+        if module_types is not None:
+            for module_type in module_types:
+                assert module_type in CHECKPOINT_MODULE_TYPES, f"module type must be one of {CHECKPOINT_MODULE_TYPES}: {module_type}"
+        for index, block in self.get_checkpoint_blocks().items():
+            block_value = value and (blocks is None or index in blocks)
             for module in block.modules():
                 if hasattr(module, "gradient_checkpointing"):
                     # logger.info(f{module.__class__.__name__} {module.gradient_checkpointing} -> {value}")
-                    module.gradient_checkpointing = value
+                    module.gradient_checkpointing = block_value and (module_types is None or module.__class__.__name__ in module_types)
 
     # endregion
 
+    def get_checkpoint_blocks(self) -> Dict[int, nn.Module]:
+        r"""
+        Blocks which can be checkpointed, indexed like `block_lr`: 1-9 for input blocks, 10-12 for middle block and 13-21 for output blocks.
+        """
+        blocks = {}
+        for i, block in enumerate(self.input_blocks):
+            blocks[1 + i] = block
+        for i, module in enumerate(self.middle_block):
+            blocks[10 + i] = module
+        for i, block in enumerate(self.output_blocks):
+            blocks[13 + i] = block
+        return blocks
+
+    def estimate_checkpoint_costs(self, batch_size, height, width, context_length=77, bytes_per_element=2, store_attention_scores=True) -> Dict[int, dict]:
+        r"""
+        Roughly estimate per block the activation memory kept for backward, the memory kept when the block is checkpointed and the forward FLOPs which are recomputed.
+        `height` and `width` are in pixels. Set `store_attention_scores=False` for memory efficient attention, xformers or sdpa, which do not keep the attention matrix.
+        """
+        n = (height // 8) * (width // 8)  # latent pixels at the current level
+        costs = {}
+        for index, block in self.get_checkpoint_blocks().items():
+            layers = [block] if not isinstance(block, (nn.Sequential, nn.ModuleList)) else list(block)
+            activation, retained, flops = 0, 0, 0
+            for layer in layers:
+                if isinstance(layer, ResnetBlock2D):
+                    ci, co = layer.in_channels, layer.out_channels
+                    activation += n * (3 * ci + 4 * co)
+                    retained += n * ci
+                    flops += 2 * n * 9 * (ci * co + co * co) + (2 * n * ci * co if ci != co else 0)
+                elif isinstance(layer, Transformer2DModel):
+                    c = layer.in_channels
+                    heads = layer.num_attention_heads
+                    activation += 3 * n * c  # norm, proj_in and proj_out are never checkpointed
+                    retained += 3 * n * c
+                    flops += 2 * n * 2 * c * c
+                    for transformer_block in layer.transformer_blocks:
+                        cd = transformer_block.attn2.cross_attention_dim
+                        block_activation = 29 * n * c + 2 * context_length * c
+                        if store_attention_scores:
+                            block_activation += heads * n * (n + context_length)
+                        activation += block_activation
+                        retained += n * c
+                        flops += 2 * n * 18 * c * c + 2 * 2 * context_length * cd * c + 2 * 2 * n * (n + context_length) * c
+                elif isinstance(layer, Downsample2D):
+                    activation += n * layer.channels
+                    retained += n * layer.channels
+                    n = n // 4
+                    flops += 2 * n * 9 * layer.channels * layer.out_channels
+                elif isinstance(layer, Upsample2D):
+                    activation += 4 * n * layer.channels
+                    retained += n * layer.channels
+                    n = n * 4
+                    flops += 2 * n * 9 * layer.channels * layer.out_channels
+                else:  # conv_in
+                    activation += n * self.in_channels
+                    retained += n * self.in_channels
+                    flops += 2 * n * 9 * self.in_channels * self.model_channels
+            costs[index] = dict(
+                activation=activation * batch_size * bytes_per_element,
+                retained=retained * batch_size * bytes_per_element,
+                flops=flops * batch_size,
+            )
+        return costs
+
     def forward(self, x, timesteps=None, context=None, y=None, **kwargs):
+        if self.compiled_forward is not None and not is_compiling():
+            if self.compile_dynamic_spatial:
+                mark_spatial_dynamic(x)
+            return self.compiled_forward(self, x, timesteps, context, y, **kwargs)
+
         # broadcast timesteps to batch dimension
         timesteps = timesteps.expand(x.shape[0])
 
@@ -1085,6 +1418,9 @@ class SdxlUNet2DConditionModel(nn.Module):
         # assert x.dtype == self.dtype
         emb = emb + self.label_emb(y)
 
+        if self.memory_lean is not None:
+            self.memory_lean.update(x)
+
         def call_module(module, h, emb, context):
             x = h
             for layer in module:
@@ -1162,6 +1498,10 @@ class InferSdxlUNet2DConditionModel:
         """
         _self = self.delegate
 
+        # the compiled graph has no Deep Shrink: it resizes inside the network depending on the timestep, so run it eagerly
+        if _self.compiled_forward is not None and self.ds_depth_1 is None:
+            return type(_self).forward(_self, x, timesteps, context, y, **kwargs)
+
         # broadcast timesteps to batch dimension
         timesteps = timesteps.expand(x.shape[0])
 
@@ -1175,6 +1515,9 @@ class InferSdxlUNet2DConditionModel:
         # assert x.dtype == _self.dtype
         emb = emb + _self.label_emb(y)
 
+        if _self.memory_lean is not None:
+            _self.memory_lean.update(x)
+
         def call_module(module, h, emb, context):
             x = h
             for layer in module:
@@ -12,7 +12,7 @@ from torch.optim import Optimizer
 from torch.nn.parallel import DistributedDataParallel as DDP
 from typing import Optional, List
 from diffusers.optimization import SchedulerType, TYPE_TO_SCHEDULER_FUNCTION
-from . import advanced_train_utils, sdxl_original_unet, sdxl_model_utils, model_utils, log_utils
+from . import advanced_train_utils, sdxl_original_unet, sdxl_model_utils, model_utils, profile_utils, vae_utils, checkpoint_utils, log_utils
 
 logger = log_utils.get_logger("train")
 
@@ -127,6 +127,13 @@ def collate_fn(batch):
     return batch[0]
 
 
+def get_latents_shape(batch) -> tuple:
+    if batch.get("latents") is not None:
+        return tuple(batch["latents"].shape)
+    batch_size, _, height, width = batch["images"].shape
+    return (batch_size, 4, height // 8, width // 8)
+
+
 def prepare_accelerator(config):
     log_dir = os.path.join(config.output_dir, config.output_subdir.logs)
     log_dir = log_dir + "/" + time.strftime("%Y%m%d%H%M%S", time.localtime())
@@ -175,46 +182,94 @@ def match_mixed_precision(config, weight_dtype):
         return None
 
 
+def get_staged_checkpoint_path(path, shm_dir) -> str:
+    import hashlib
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8]
+    return os.path.join(shm_dir, f"{digest}_{os.path.basename(path)}")
+
+
+def stage_checkpoint(path, shm_dir=None) -> str:
+    r"""
+    Bring a checkpoint into node-local memory once per node: copy it to `shm_dir` (e.g. `/dev/shm`) if given, otherwise read it through so that it is in the page cache.
+    Returns the path to load from.
+    """
+    if shm_dir:
+        staged_path = get_staged_checkpoint_path(path, shm_dir)
+        stat = os.stat(path)
+        if not os.path.isfile(staged_path) or os.path.getsize(staged_path) != stat.st_size or os.path.getmtime(staged_path) < stat.st_mtime:
+            import shutil
+            logger.print(f"stage checkpoint to: `{log_utils.yellow(staged_path)}`")
+            os.makedirs(shm_dir, exist_ok=True)
+            shutil.copyfile(path, staged_path + ".tmp")
+            os.replace(staged_path + ".tmp", staged_path)
+        return staged_path
+    buffer = bytearray(64 * 1024 * 1024)
+    with open(path, "rb") as f:
+        while f.readinto(buffer):
+            pass
+    return path
+
+
 def load_target_model(config, accelerator, model_version: str, weight_dtype):
-    # load models for each process
     model_dtype = match_mixed_precision(config, weight_dtype)  # prepare fp16/bf16
+    name_or_path = config.pretrained_model_name_or_path
+
+    def load(path, use_mmap=False):
+        logger.print(f"loading model for process {accelerator.state.local_process_index}/{accelerator.state.num_processes}", disable=False)
+        models = _load_target_model(
+            path,
+            config.vae,
+            model_version,
+            weight_dtype,
+            accelerator.device,
+            model_dtype,
+            use_mmap=use_mmap,
+        )
+        _, text_encoder1, text_encoder2, vae, unet, _, _ = models
+
+        if config.fused_projections:
+            unet.set_fused_projections(True)
+        unet.set_memory_lean(**config.memory_lean_kwargs)
+
+        # work on low-ram device
+        if config.cpu:
+            text_encoder1.to(accelerator.device)
+            text_encoder2.to(accelerator.device)
+            unet.to(accelerator.device)
+            vae.to(accelerator.device)
+
+        gc.collect()
+        torch.cuda.empty_cache()
+        return models
+
+    if config.shared_load_kwargs.enable and os.path.isfile(name_or_path) and model_utils.is_safetensors(name_or_path):
+        # one process per node stages the checkpoint in node-local memory, then all local processes load views of it at the same time
+        shm_dir = config.shared_load_kwargs.shm_dir
+        if accelerator.is_local_main_process:
+            t0 = time.perf_counter()
+            stage_checkpoint(name_or_path, shm_dir)
+            logger.print(f"checkpoint staged in {time.perf_counter() - t0:.1f}s", disable=False)
+        accelerator.wait_for_everyone()
+        path = get_staged_checkpoint_path(name_or_path, shm_dir) if shm_dir else name_or_path
+        models = load(path, use_mmap=True)
+        accelerator.wait_for_everyone()
+        if shm_dir and not config.shared_load_kwargs.keep_staged and accelerator.is_local_main_process:
+            # all local processes have loaded it, free the memory of the copy. mapped pages stay valid until they are unmapped
+            os.remove(path)
+            logger.print(f"removed staged checkpoint: `{log_utils.yellow(path)}`", disable=False)
+        return models
+
+    # load models for each process
     for pi in range(accelerator.state.num_processes):
         if pi == accelerator.state.local_process_index:
-            logger.print(f"loading model for process {accelerator.state.local_process_index}/{accelerator.state.num_processes}", disable=False)
-
-            (
-                load_stable_diffusion_format,
-                text_encoder1,
-                text_encoder2,
-                vae,
-                unet,
-                logit_scale,
-                ckpt_info,
-            ) = _load_target_model(
-                config.pretrained_model_name_or_path,
-                config.vae,
-                model_version,
-                weight_dtype,
-                accelerator.device,
-                model_dtype,
-            )
-
-            # work on low-ram device
-            if config.cpu:
-                text_encoder1.to(accelerator.device)
-                text_encoder2.to(accelerator.device)
-                unet.to(accelerator.device)
-                vae.to(accelerator.device)
-
-            gc.collect()
-            torch.cuda.empty_cache()
+            models = load(name_or_path)
         accelerator.wait_for_everyone()
 
-    return load_stable_diffusion_format, text_encoder1, text_encoder2, vae, unet, logit_scale, ckpt_info
+    return models
 
 
 def _load_target_model(
-    name_or_path: str, vae_path: str, model_version: str, weight_dtype, device="cpu", model_dtype=None
+    name_or_path: str, vae_path: str, model_version: str, weight_dtype, device="cpu", model_dtype=None, use_mmap=False
 ):
     # model_dtype only work with full fp16/bf16
     name_or_path = os.readlink(name_or_path) if os.path.islink(name_or_path) else name_or_path
@@ -229,7 +284,7 @@ def _load_target_model(
             unet,
             logit_scale,
             ckpt_info,
-        ) = sdxl_model_utils.load_models_from_sdxl_checkpoint(model_version, name_or_path, device, model_dtype)
+        ) = sdxl_model_utils.load_models_from_sdxl_checkpoint(model_version, name_or_path, device, model_dtype, use_mmap=use_mmap)
     else:
         # Diffusers model is loaded to CPU
         from diffusers import StableDiffusionXLPipeline
@@ -312,6 +367,150 @@ def replace_unet_modules(unet, mem_eff_attn, xformers, sdpa):
         unet.set_use_sdpa(True)
 
 
+def parse_block_indices(blocks):
+    r"""
+    Parse block indices from `"1-9,13-21"` or `[1, 2, 3]` into a set. Returns None for all blocks.
+    """
+    if blocks is None:
+        return None
+    if isinstance(blocks, str):
+        return {i for start, end in profile_utils.parse_step_ranges(blocks) for i in range(start, end + 1)}
+    return {int(i) for i in blocks}
+
+
+def select_checkpoint_blocks(costs, memory_budget):
+    r"""
+    Select the blocks with the most activation memory saved per recomputed FLOP until the estimated activation memory fits into `memory_budget` bytes.
+    """
+    activation = sum(cost["activation"] for cost in costs.values())
+    excess = activation - memory_budget
+    blocks = set()
+    candidates = [i for i, cost in costs.items() if cost["activation"] > cost["retained"]]
+    candidates.sort(key=lambda i: (costs[i]["activation"] - costs[i]["retained"]) / max(costs[i]["flops"], 1), reverse=True)
+    for i in candidates:
+        if excess <= 0:
+            break
+        blocks.add(i)
+        excess -= costs[i]["activation"] - costs[i]["retained"]
+    return blocks
+
+
+def apply_gradient_checkpointing(config, unet):
+    r"""
+    Enable gradient checkpointing of the U-Net following `config.gradient_checkpointing_kwargs`.
+    Checkpoint all blocks by default, the given `blocks` and `module_types`, or the cheapest blocks under `memory_budget`.
+    """
+    kwargs = config.gradient_checkpointing_kwargs
+    blocks = parse_block_indices(kwargs.blocks)
+    module_types = kwargs.module_types
+    if isinstance(module_types, str):
+        module_types = [module_type.strip() for module_type in module_types.split(",")]
+
+    if kwargs.memory_budget is not None:
+        assert blocks is None and module_types is None, "memory_budget cannot be used with blocks or module_types / memory_budgetはblocksやmodule_typesと同時に指定できません"
+        resolution = kwargs.budget_resolution or config.resolution
+        width, height = (resolution, resolution) if isinstance(resolution, int) else resolution
+        batch_size = kwargs.budget_batch_size or config.batch_size
+        costs = unet.estimate_checkpoint_costs(
+            batch_size,
+            height,
+            width,
+            context_length=get_context_length(config),
+            bytes_per_element=2 if config.mixed_precision in ("fp16", "bf16") else 4,
+            store_attention_scores=not (config.mem_eff_attn or config.xformers or config.sdpa),
+        )
+        blocks = select_checkpoint_blocks(costs, kwargs.memory_budget * 1024 ** 3)
+
+        activation = sum(cost["activation"] for cost in costs.values())
+        checkpointed = activation - sum(costs[i]["activation"] - costs[i]["retained"] for i in blocks)
+        recompute = sum(costs[i]["flops"] for i in blocks) / max(sum(cost["flops"] for cost in costs.values()), 1)
+        logger.print(f"gradient checkpointing for {width}x{height} x {batch_size}: blocks {sorted(blocks)}")
+        logger.print(
+            f"  estimated activations: {activation / 1024 ** 3:.2f}GB -> {log_utils.yellow(checkpointed / 1024 ** 3, format_spec='.2f')}GB"
+            f" | budget: {kwargs.memory_budget:.2f}GB | recomputed forward: {log_utils.yellow(recompute, format_spec='.1%')}",
+            no_prefix=True,
+        )
+        if checkpointed > kwargs.memory_budget * 1024 ** 3:
+            logger.print(log_utils.red(f"memory budget can not be met even if all blocks are checkpointed"))
+
+    unet.enable_gradient_checkpointing(blocks=blocks, module_types=module_types)
+
+
+def set_compile_cache_dir(cache_dir):
+    r"""
+    Persist the compiled artifacts of inductor in `cache_dir`, so that restarts reuse them instead of compiling again.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+    os.environ["TORCHINDUCTOR_AUTOGRAD_CACHE"] = "1"
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except ImportError:
+        pass
+
+
+def apply_torch_compile(config, unet, num_shapes=None):
+    r"""
+    Compile the U-Net forward following `config.torch_compile_kwargs`. `num_shapes` is the number of static shapes expected with `shape_mode='prewarm'`.
+    """
+    kwargs = config.torch_compile_kwargs
+    if not kwargs.enable:
+        return
+    assert kwargs.shape_mode in ("dynamic", "prewarm"), f"unknown shape_mode: {kwargs.shape_mode} / 不明なshape_modeです: {kwargs.shape_mode}"
+    assert hasattr(torch, "compile"), "torch.compile requires PyTorch 2.0 or later / torch.compileにはPyTorch 2.0以降が必要です"
+    if kwargs.cache_dir:
+        set_compile_cache_dir(kwargs.cache_dir)
+    if kwargs.shape_mode == "prewarm" and num_shapes:
+        import torch._dynamo
+        # every bucket is a separate graph, keep them all instead of falling back to eager
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * num_shapes)
+    compile_kwargs = dict(backend=kwargs.backend, fullgraph=kwargs.fullgraph)
+    if kwargs.mode is not None:
+        compile_kwargs["mode"] = kwargs.mode
+    logger.print(f"compile U-Net: backend: {log_utils.yellow(kwargs.backend)} | mode: {kwargs.mode} | shapes: {log_utils.yellow(kwargs.shape_mode)}")
+    unet.set_torch_compile(True, dynamic_spatial=kwargs.shape_mode == "dynamic", **compile_kwargs)
+
+
+def get_context_length(config) -> int:
+    r"""
+    Length of the text embeddings fed to the U-Net, 77 tokens per chunk of `max_token_length`, or one chunk if it is None.
+    """
+    return 77 * max(1, config.max_token_length // 75) if config.max_token_length else 77
+
+
+def prewarm_compiled_unet(config, accelerator, unet, bucket_sizes, weight_dtype, backward=True, batch_sizes=None) -> dict:
+    r"""
+    Compile the graph of every bucket in `bucket_sizes` ahead of training by running the U-Net on dummy inputs, with backward if `backward`.
+    `batch_sizes` maps buckets to their batch sizes, `config.batch_size` by default.
+    Call it before `accelerator.prepare` so that no gradients are synchronized. Returns the seconds spent per bucket.
+    """
+    context_length = get_context_length(config)
+    times = {}
+    pbar = logger.tqdm(total=len(bucket_sizes), desc="prewarm compiled U-Net")
+    for width, height in bucket_sizes:
+        t0 = time.perf_counter()
+        batch_size = batch_sizes[(width, height)] if batch_sizes else config.batch_size
+        x = torch.zeros(batch_size, unet.in_channels, height // 8, width // 8, device=accelerator.device, dtype=weight_dtype)
+        timesteps = torch.zeros(batch_size, device=accelerator.device, dtype=torch.long)
+        context = torch.zeros(batch_size, context_length, unet.context_dim, device=accelerator.device, dtype=weight_dtype)
+        y = torch.zeros(batch_size, unet.adm_in_channels, device=accelerator.device, dtype=weight_dtype)
+        with torch.set_grad_enabled(backward), accelerator.autocast():
+            output = unet(x, timesteps, context, y)
+        if backward:
+            output.float().mean().backward()
+            unet.zero_grad(set_to_none=True)
+        del x, context, y, output
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times[(width, height)] = time.perf_counter() - t0
+        pbar.update(1)
+    pbar.close()
+    logger.print(f"prewarmed {len(times)} buckets in {sum(times.values()):.1f}s")
+    return times
+
+
 def transform_models_if_DDP(models):
     # Transform text_encoder, unet and network from DistributedDataParallel
     return [model.module if type(model) == DDP else model for model in models if model is not None]
@@ -818,6 +1017,137 @@ def apply_weighted_noise(noise, mask, weight, normalize=True):
     return noise
 
 
+def prepare_noise_scheduler(config, device):
+    from diffusers import DDPMScheduler
+    noise_scheduler = DDPMScheduler(
+        beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", num_train_timesteps=1000, clip_sample=False
+    )
+
+    if config.prediction_type is not None:  # set prediction_type of scheduler if defined
+        noise_scheduler.register_to_config(prediction_type=config.prediction_type)
+    prepare_scheduler_for_custom_training(noise_scheduler, device)
+    if config.zero_terminal_snr:
+        advanced_train_utils.fix_noise_scheduler_betas_for_zero_terminal_snr(noise_scheduler)
+    return noise_scheduler
+
+
+def train_step(
+    config,
+    accelerator,
+    batch,
+    noise_scheduler,
+    unet,
+    text_encoder1,
+    text_encoder2,
+    tokenizer1,
+    tokenizer2,
+    vae,
+    optimizer,
+    lr_scheduler,
+    training_models,
+    weight_dtype,
+    vae_dtype,
+    profiler=None,
+):
+    r"""
+    Run one training micro-step on `batch`: encode latents and prompts, predict noise, compute loss, backward and step the optimizer.
+    Returns the loss tensor.
+    """
+    profiler = profiler or profile_utils.PhaseProfiler(enable=False)
+    with accelerator.accumulate(*training_models):
+        with profiler.phase("latents"):
+            if batch.get("latents") is not None:
+                latents = batch["latents"].to(accelerator.device)
+            else:
+                with torch.no_grad():
+                    latents = vae_utils.encode(vae, batch["images"].to(vae_dtype), **config.vae_tiling_kwargs).sample().to(weight_dtype)
+                    if torch.any(torch.isnan(latents)):
+                        logger.print("NaN found in latents, replacing with zeros")
+                        latents = torch.where(torch.isnan(latents), torch.zeros_like(latents), latents)
+            latents *= VAE_SCALE_FACTOR
+
+        with profiler.phase("text_encode"):
+            if batch.get("text_encoder_outputs1_list") is None:  # TODO: Implement text encoder cache
+                input_ids1 = batch["input_ids_1"]
+                input_ids2 = batch["input_ids_2"]
+                with torch.set_grad_enabled(config.train_text_encoder):
+                    input_ids1 = input_ids1.to(accelerator.device)
+                    input_ids2 = input_ids2.to(accelerator.device)
+                    encoder_hidden_states1, encoder_hidden_states2, pool2 = get_hidden_states_sdxl(
+                        config.max_token_length,
+                        input_ids1,
+                        input_ids2,
+                        tokenizer1,
+                        tokenizer2,
+                        text_encoder1,
+                        text_encoder2,
+                        None if not config.full_fp16 else weight_dtype,
+                    )
+            else:
+                encoder_hidden_states1 = batch["text_encoder_outputs1_list"].to(accelerator.device).to(weight_dtype)
+                encoder_hidden_states2 = batch["text_encoder_outputs2_list"].to(accelerator.device).to(weight_dtype)
+                pool2 = batch["text_encoder_pool2_list"].to(accelerator.device).to(weight_dtype)
+
+        with profiler.phase("unet_forward"):
+            target_size = batch["target_size_hw"]
+            orig_size = batch["original_size_hw"]
+            crop_size = batch["crop_top_lefts"]
+            embs = get_size_embeddings(orig_size, crop_size, target_size, accelerator.device).to(weight_dtype)
+
+            vector_embedding = torch.cat([pool2, embs], dim=1).to(weight_dtype)
+            text_embedding = torch.cat([encoder_hidden_states1, encoder_hidden_states2], dim=2).to(weight_dtype)
+
+            noise, noisy_latents, timesteps = get_noise_noisy_latents_and_timesteps(config, noise_scheduler, latents)
+
+            noisy_latents = noisy_latents.to(weight_dtype)
+
+            with accelerator.autocast():
+                noise_pred = unet(noisy_latents, timesteps, text_embedding, vector_embedding)
+
+            if noise_scheduler.config.prediction_type == "epsilon":
+                target = noise
+            elif noise_scheduler.config.prediction_type == "v_prediction":
+                target = noise_scheduler.get_velocity(latents, noise, timesteps)
+            else:
+                raise ValueError(f"Unknown prediction type {noise_scheduler.config.prediction_type}")
+
+            if (
+                config.min_snr_gamma
+                or config.debiased_estimation_loss
+            ):
+                # do not mean over batch dimension for snr weight or scale v-pred loss
+                loss = torch.nn.functional.mse_loss(noise_pred.float(), target.float(), reduction="none")
+                loss = loss.mean([1, 2, 3])
+
+                if config.min_snr_gamma:
+                    loss = advanced_train_utils.apply_snr_weight(loss, timesteps, noise_scheduler, config.min_snr_gamma, config.prediction_type)
+                if config.debiased_estimation_loss:
+                    loss = advanced_train_utils.apply_debiased_estimation(loss, timesteps, noise_scheduler)
+
+                loss = loss.mean()  # mean over batch dimension
+            else:
+                loss = torch.nn.functional.mse_loss(noise_pred.float(), target.float(), reduction="mean")
+
+            if torch.isnan(loss):
+                loss = torch.where(torch.isnan(loss), torch.zeros_like(loss), loss)
+
+        with profiler.phase("backward"):
+            loss_scale = batch.get("loss_scale")
+            accelerator.backward(loss * loss_scale if loss_scale is not None else loss)
+        with profiler.phase("optimizer"):
+            if accelerator.sync_gradients and config.max_grad_norm != 0.0:
+                params_to_clip = []
+                for m in training_models:
+                    params_to_clip.extend(m.parameters())
+                accelerator.clip_grad_norm_(params_to_clip, config.max_grad_norm)
+
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad(set_to_none=True)
+
+    return loss
+
+
 def save_sdxl_model_during_train(
     config,
     save_dtype: torch.dtype,
@@ -902,6 +1232,136 @@ class LossRecorder:
         return sum(self.losses[-window:]) / window
 
 
+class LogScheduler:
+    r"""
+    Class to throttle training logs per sink and write them from a background thread.
+    """
+
+    def __init__(
+        self,
+        accelerator,
+        pbar=None,
+        console_every_n_steps=1,
+        tracker_every_n_steps=1,
+        console_mode='step',
+        tracker_mode='step',
+        async_log=True,
+        max_queue_size=64,
+    ):
+        assert console_mode in ('step', 'mean'), f"console_mode must be `step` or `mean`, got {console_mode}"
+        assert tracker_mode in ('step', 'mean'), f"tracker_mode must be `step` or `mean`, got {tracker_mode}"
+        self.accelerator = accelerator
+        self.pbar = pbar
+        self.console_every_n_steps = console_every_n_steps
+        self.tracker_every_n_steps = tracker_every_n_steps
+        self.console_mode = console_mode
+        self.tracker_mode = tracker_mode
+        self.disable = not accelerator.is_main_process
+
+        # scalars batched since the last write of each sink
+        self._console_buffer = {}
+        self._tracker_buffer = {}
+        self._last_step = None
+
+        self._queue = None
+        self._thread = None
+        if async_log and not self.disable:
+            import queue
+            import threading
+            self._queue = queue.Queue(maxsize=max_queue_size)
+            self._thread = threading.Thread(target=self._worker, name="log_scheduler", daemon=True)
+            self._thread.start()
+
+    def is_console_step(self, step):
+        return bool(not self.disable and self.console_every_n_steps and step % self.console_every_n_steps == 0)
+
+    def is_tracker_step(self, step):
+        return bool(not self.disable and self.tracker_every_n_steps and step % self.tracker_every_n_steps == 0)
+
+    @staticmethod
+    def _accumulate(buffer, logs):
+        for k, v in logs.items():
+            total, count, _ = buffer.get(k, (0.0, 0, None))
+            buffer[k] = (total + v, count + 1, v)
+
+    @staticmethod
+    def _reduce(buffer, mode):
+        if mode == 'mean':
+            return {k: total / count for k, (total, count, _) in buffer.items()}
+        return {k: last for k, (_, _, last) in buffer.items()}
+
+    def log(self, logs: dict, step: int, pbar_logs: Optional[dict] = None):
+        r"""
+        Buffer scalars of one optimization step and dispatch the sinks which are due at `step`.
+        """
+        if self.disable:
+            return
+        self._last_step = step
+        if self.tracker_every_n_steps:
+            self._accumulate(self._tracker_buffer, logs)
+        if pbar_logs is not None and self.pbar is not None and self.console_every_n_steps:
+            self._accumulate(self._console_buffer, {k: v for k, v in pbar_logs.items() if isinstance(v, (int, float))})
+
+        tracker_logs = None
+        console_logs = None
+        if self._tracker_buffer and self.is_tracker_step(step):
+            tracker_logs = self._reduce(self._tracker_buffer, self.tracker_mode)
+            self._tracker_buffer = {}
+        if self._console_buffer and self.is_console_step(step):
+            console_logs = self._reduce(self._console_buffer, self.console_mode)
+            # step counters are always shown as is
+            console_logs.update({k: v for k, v in pbar_logs.items() if isinstance(v, int)})
+            self._console_buffer = {}
+        if tracker_logs is not None or console_logs is not None:
+            self._submit(tracker_logs, console_logs, step)
+
+    def log_now(self, logs: dict, step: int):
+        r"""
+        Write `logs` to the trackers immediately, bypassing the throttling, e.g. for epoch-level logs.
+        """
+        if self.disable:
+            return
+        self._submit(logs, None, step)
+
+    def _submit(self, tracker_logs, console_logs, step):
+        if self._queue is not None:
+            self._queue.put((tracker_logs, console_logs, step))
+        else:
+            self._write(tracker_logs, console_logs, step)
+
+    def _write(self, tracker_logs, console_logs, step):
+        if tracker_logs:
+            self.accelerator.log(tracker_logs, step=step)
+        if console_logs and self.pbar is not None:
+            self.pbar.set_postfix(console_logs, refresh=False)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                logger.print(log_utils.red(f"exception when writing logs: {e}"))
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        if self._queue is not None:
+            self._queue.join()
+
+    def close(self):
+        if self._tracker_buffer and self._last_step is not None:  # write the remaining scalars
+            self._submit(self._reduce(self._tracker_buffer, self.tracker_mode), None, self._last_step)
+            self._tracker_buffer = {}
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+
+
 class TrainState:
     r"""
     Class to manage training state.
@@ -958,17 +1418,80 @@ class TrainState:
         )
 
         self.global_step = 0
+        self.skip_steps = 0  # steps of the current epoch trained before resuming
+
+        self.async_saver = None
+        if self.config.async_save_kwargs.enable and self.accelerator.is_main_process:
+            # the model and the train state saved at the same step are two saves in flight
+            saves_per_step = 2 if self.config.save_model and self.config.save_train_state else 1
+            self.async_saver = checkpoint_utils.AsyncCheckpointSaver(
+                max_in_flight=self.config.async_save_kwargs.max_in_flight * saves_per_step,
+                pin_memory=self.config.async_save_kwargs.pin_memory,
+            )
+
+        self.metrics = {}
+        self.retention_manager = None
+        if self.config.retention_kwargs.enable and self.accelerator.is_main_process:
+            self.retention_manager = checkpoint_utils.CheckpointRetentionManager(
+                keep_last_n=self.config.retention_kwargs.keep_last_n,
+                keep_every_n_steps=self.config.retention_kwargs.keep_every_n_steps,
+                keep_best_n=self.config.retention_kwargs.keep_best_n,
+                metric_mode=self.config.retention_kwargs.metric_mode,
+                verify=self.config.retention_kwargs.verify,
+            )
+
+        self.delta_writer = None
+        if self.config.delta_save_kwargs.enable and self.accelerator.is_main_process:
+            base_path = self.config.pretrained_model_name_or_path
+            if os.path.isfile(base_path) and model_utils.is_safetensors(base_path) and not sdxl_model_utils.is_delta_checkpoint(base_path):
+                trained_prefixes = dict(unet="model.diffusion_model.", text_encoder1="conditioner.embedders.0.", text_encoder2="conditioner.embedders.1.")
+                training_models = self._get_training_models()
+                self.delta_writer = checkpoint_utils.DeltaCheckpointWriter(
+                    base_path,
+                    mode=self.config.delta_save_kwargs.mode,
+                    rank=self.config.delta_save_kwargs.rank,
+                    static_prefixes=["first_stage_model."] + [prefix for name, prefix in trained_prefixes.items() if name not in training_models],
+                )
+            else:
+                logger.print(log_utils.yellow(f"delta checkpoints need a safetensors base model, save full checkpoints instead: {base_path}"))
+
+        self.sampler = None  # created on the first sampling
 
     def step(self):
         self.global_step += 1
 
+    def update_metrics(self, metrics: dict):
+        r"""
+        Latest training metrics, e.g. the losses, for keeping the best checkpoints by `retention_kwargs.metric`.
+        """
+        self.metrics.update(metrics)
+
+    def _register_checkpoint(self, kind, path, step, metric):
+        if self.retention_manager is not None:
+            self.retention_manager.register(kind, path, step, metric)
+
     @property
     def epoch(self):
         return self.global_step // self.num_steps_per_epoch
 
     def _save_model(self):
         logger.print(f"saving model at epoch {self.epoch}, step {self.global_step}...")
-        save_path = os.path.join(self.output_model_dir, f"{self.output_name['models']}_ep{self.epoch}_step{self.global_step}.safetensors")
+        ext = ".delta.safetensors" if self.delta_writer is not None else ".safetensors"
+        save_path = os.path.join(self.output_model_dir, f"{self.output_name['models']}_ep{self.epoch}_step{self.global_step}{ext}")
+        if self.async_saver is not None:
+            self._save_model_async(save_path)
+            return
+        if self.delta_writer is not None:
+            state_dict = sdxl_model_utils.make_stable_diffusion_state_dict(
+                text_encoder1_sd=self.accelerator.unwrap_model(self.text_encoder1).state_dict(),
+                text_encoder2_sd=self.accelerator.unwrap_model(self.text_encoder2).state_dict(),
+                unet_sd=self.accelerator.unwrap_model(self.unet).state_dict(),
+                vae_sd=self.vae.state_dict(),
+                logit_scale=self.logit_scale,
+            )
+            self._save_delta(save_path, state_dict, self.epoch, self.global_step, self.ckpt_info)
+            self._register_checkpoint("models", save_path, self.global_step, self.metrics.get(self.config.retention_kwargs.metric))
+            return
         sdxl_model_utils.save_stable_diffusion_checkpoint(
             fp=save_path,
             unet=self.accelerator.unwrap_model(self.unet),
@@ -982,12 +1505,152 @@ class TrainState:
             save_dtype=self.save_dtype,
         )
         logger.print(f"model saved to: `{log_utils.yellow(save_path)}`")
+        self._register_checkpoint("models", save_path, self.global_step, self.metrics.get(self.config.retention_kwargs.metric))
+
+    def _save_model_async(self, save_path):
+        state_dicts = dict(
+            unet=self.accelerator.unwrap_model(self.unet).state_dict(),
+            text_encoder1=self.accelerator.unwrap_model(self.text_encoder1).state_dict(),
+            text_encoder2=self.accelerator.unwrap_model(self.text_encoder2).state_dict(),
+            vae=self.vae.state_dict(),
+        )
+        if self.logit_scale is not None:
+            state_dicts["logit_scale"] = {"logit_scale": self.logit_scale}
+        epochs, steps, ckpt_info = self.epoch, self.global_step, self.ckpt_info
+        metric = self.metrics.get(self.config.retention_kwargs.metric)
+
+        def write(path, host_state_dicts):
+            write_model(path, host_state_dicts)
+            self._register_checkpoint("models", path, steps, metric)  # registered once completely written
+
+        def write_model(path, host_state_dicts):
+            logit_scale = host_state_dicts["logit_scale"]["logit_scale"] if "logit_scale" in host_state_dicts else None
+            if self.delta_writer is not None:
+                state_dict = sdxl_model_utils.make_stable_diffusion_state_dict(
+                    text_encoder1_sd=host_state_dicts["text_encoder1"],
+                    text_encoder2_sd=host_state_dicts["text_encoder2"],
+                    unet_sd=host_state_dicts["unet"],
+                    vae_sd=host_state_dicts["vae"],
+                    logit_scale=logit_scale,
+                )
+                self._save_delta(path, state_dict, epochs, steps, ckpt_info)
+                return
+            sdxl_model_utils.save_stable_diffusion_state_dicts(
+                fp=path,
+                text_encoder1_sd=host_state_dicts["text_encoder1"],
+                text_encoder2_sd=host_state_dicts["text_encoder2"],
+                unet_sd=host_state_dicts["unet"],
+                epochs=epochs,
+                steps=steps,
+                ckpt_info=ckpt_info,
+                vae_sd=host_state_dicts["vae"],
+                logit_scale=logit_scale,
+                save_dtype=None,  # already cast by the snapshot
+            )
+
+        self.async_saver.submit(save_path, state_dicts, write, dtype=self.save_dtype)
+
+    def _save_delta(self, save_path, state_dict, epochs, steps, ckpt_info):
+        if ckpt_info is not None:
+            epochs += ckpt_info[0]
+            steps += ckpt_info[1]
+        num_stored, num_skipped = self.delta_writer.save(save_path, state_dict, save_dtype=self.save_dtype, metadata=dict(epoch=epochs, global_step=steps))
+        logger.print(f"delta model saved to: `{log_utils.yellow(save_path)}` | stored tensors: {num_stored} | skipped tensors: {num_skipped}")
+
+    def _get_training_models(self):
+        models = dict(unet=self.unet, text_encoder1=self.text_encoder1, text_encoder2=self.text_encoder2)
+        return {name: self.accelerator.unwrap_model(model) for name, model in models.items() if any(p.requires_grad for p in model.parameters())}
+
+    def _save_sharded(self):
+        r"""
+        Every rank writes a disjoint shard of the model and the train state in parallel. Must be called on all ranks.
+        """
+        rank, num_shards = self.accelerator.process_index, self.accelerator.num_processes
+        if self.config.save_model:
+            logger.print(f"saving sharded model at epoch {self.epoch}, step {self.global_step}...")
+            save_dir = os.path.join(self.output_model_dir, f"{self.output_name['models']}_ep{self.epoch}_step{self.global_step}")
+            state_dict = sdxl_model_utils.make_stable_diffusion_state_dict(
+                text_encoder1_sd=self.accelerator.unwrap_model(self.text_encoder1).state_dict(),
+                text_encoder2_sd=self.accelerator.unwrap_model(self.text_encoder2).state_dict(),
+                unet_sd=self.accelerator.unwrap_model(self.unet).state_dict(),
+                vae_sd=self.vae.state_dict(),
+                logit_scale=self.logit_scale,
+            )
+            epochs, steps = self.epoch, self.global_step
+            if self.ckpt_info is not None:
+                epochs += self.ckpt_info[0]
+                steps += self.ckpt_info[1]
+            checkpoint_utils.save_sharded_model(
+                save_dir,
+                state_dict,
+                rank,
+                num_shards,
+                barrier=self.accelerator.wait_for_everyone,
+                dtype=self.save_dtype,
+                metadata=dict(epoch=epochs, global_step=steps),
+            )
+            del state_dict
+            logger.print(f"sharded model saved to: `{log_utils.yellow(save_dir)}`")
+            self._register_checkpoint("models", save_dir, self.global_step, self.metrics.get(self.config.retention_kwargs.metric))
+        if self.config.save_train_state:
+            logger.print(f"saving sharded train state at epoch {self.epoch}, step {self.global_step}...")
+            save_dir = os.path.join(self.output_train_state_dir, f"{self.output_name['train_state']}_train-state_ep{self.epoch}_step{self.global_step}")
+            checkpoint_utils.save_sharded_train_state(
+                save_dir,
+                rank,
+                num_shards,
+                barrier=self.accelerator.wait_for_everyone,
+                models=self._get_training_models(),
+                optimizer=self.optimizer,
+                lr_scheduler=self.lr_scheduler,
+                scaler=self.accelerator.scaler,
+                metadata=dict(epoch=self.epoch, global_step=self.global_step),
+            )
+            logger.print(f"sharded train state saved to: `{log_utils.yellow(save_dir)}`")
+            self._register_checkpoint("train_state", save_dir, self.global_step, self.metrics.get(self.config.retention_kwargs.metric))
+
+    def wait_for_saves(self):
+        r"""
+        Block until the models being saved in background are written, e.g. before exiting.
+        """
+        if self.async_saver is not None:
+            self.async_saver.close()
+        if self.retention_manager is not None:
+            self.retention_manager.close()  # finish the pending verifications and deletions
+        if self.sampler is not None:
+            self.sampler.close()  # finish the pending writes and uploads of samples
+            self.sampler = None
 
     def _save_train_state(self):
         logger.print(f"saving train state at epoch {self.epoch}, step {self.global_step}...")
         save_path = os.path.join(self.output_train_state_dir, f"{self.output_name['train_state']}_train-state_ep{self.epoch}_step{self.global_step}")
+        if self.async_saver is not None:
+            self._save_train_state_async(save_path)
+            return
         self.accelerator.save_state(save_path)
+        # `accelerator.step` counts micro-steps, keep the optimizer step for resuming
+        checkpoint_utils.write_train_state_metadata(save_path, dict(epoch=self.epoch, global_step=self.global_step))
         logger.print(f"train state saved to: `{log_utils.yellow(save_path)}`")
+        self._register_checkpoint("train_state", save_path, self.global_step, self.metrics.get(self.config.retention_kwargs.metric))
+
+    def _save_train_state_async(self, save_path):
+        r"""
+        Snapshot the weights, the optimizer, the scheduler and the random states, and write them in background as a single-shard train state.
+        """
+        state_dicts, others = checkpoint_utils.snapshot_train_state(
+            self._get_training_models(),
+            self.optimizer,
+            self.lr_scheduler,
+            scaler=self.accelerator.scaler,
+        )
+        metadata = dict(epoch=self.epoch, global_step=self.global_step)
+        metric = self.metrics.get(self.config.retention_kwargs.metric)
+
+        def write(path, host_state_dicts):
+            checkpoint_utils.write_train_state_snapshot(path, host_state_dicts, others, metadata=metadata)
+            self._register_checkpoint("train_state", path, metadata["global_step"], metric)  # registered once completely written
+
+        self.async_saver.submit(save_path, state_dicts, write)
 
     def save(self, on_step_end=False, on_epoch_end=False, on_train_end=False):
         do_save = False
@@ -997,16 +1660,40 @@ class TrainState:
         do_save &= bool(self.config.save_model or self.config.save_train_state)
         if do_save:
             self.accelerator.wait_for_everyone()
-            if self.accelerator.is_main_process:
+            if self.config.sharded_save_kwargs.enable:
+                self._save_sharded()
+            elif self.accelerator.is_main_process:
                 if self.config.save_model:
                     self._save_model()
                 if self.config.save_train_state:
                     self._save_train_state()
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-                    gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+                gc.collect()
             self.accelerator.wait_for_everyone()
 
+    def _make_sampler(self):
+        from .sdxl_eval_utils import TrainSampler
+        from .sdxl_lpw_stable_diffusion import SdxlStableDiffusionLongPromptWeightingPipeline, PromptEmbeddingCache
+        embedding_cache = None
+        if self.config.sample_embedding_cache_kwargs.enable:
+            # text embeddings of the benchmark are reused until the text encoders are updated
+            embedding_cache = PromptEmbeddingCache(max_entries=self.config.sample_embedding_cache_kwargs.max_entries)
+        # every process samples its share of the benchmark. the U-Net is unwrapped because the processes run different numbers of forwards
+        return TrainSampler(
+            pipe_class=SdxlStableDiffusionLongPromptWeightingPipeline,
+            accelerator=self.accelerator,
+            config=self.config,
+            unet=self.accelerator.unwrap_model(self.unet),
+            text_encoder=[self.accelerator.unwrap_model(self.text_encoder1), self.accelerator.unwrap_model(self.text_encoder2)],
+            vae=self.vae,
+            tokenizer=[self.tokenizer1, self.tokenizer2],
+            device=self.accelerator.device,
+            vae_placement=self.config.sample_pipeline_kwargs.vae_placement,
+            empty_cache=self.config.sample_pipeline_kwargs.empty_cache,
+            embedding_cache=embedding_cache,
+        )
+
     def sample(self, on_step_end=False, on_epoch_end=False, on_train_end=False):
         do_sample = False
         do_sample |= bool(on_step_end and self.global_step and self.config.sample_every_n_steps and self.global_step % self.config.sample_every_n_steps == 0)
@@ -1014,35 +1701,49 @@ class TrainState:
         do_sample |= bool(on_train_end)
         if do_sample:
             self.accelerator.wait_for_everyone()
-            if self.accelerator.is_main_process:
-                from .sdxl_eval_utils import sample_during_train
-                from .sdxl_lpw_stable_diffusion import SdxlStableDiffusionLongPromptWeightingPipeline
-                try:
-                    sample_during_train(
-                        pipe_class=SdxlStableDiffusionLongPromptWeightingPipeline,
-                        accelerator=self.accelerator,
-                        config=self.config,
-                        epoch=self.epoch if on_epoch_end else None,
-                        steps=self.global_step,
-                        unet=self.unet,
-                        text_encoder=[self.text_encoder1, self.text_encoder2],
-                        vae=self.vae,
-                        tokenizer=[self.tokenizer1, self.tokenizer2],
-                        device=self.accelerator.device,
-                    )
-
-                except Exception as e:
-                    import traceback
-                    logger.print(log_utils.red("exception when sample images:", e))
-                    traceback.print_exc()
-                    pass
+            try:
+                if self.sampler is None:
+                    self.sampler = self._make_sampler()
+                self.sampler.sample(epoch=self.epoch if on_epoch_end else None, steps=self.global_step)
+            except Exception as e:
+                import traceback
+                logger.print(log_utils.red("exception when sample images:", e))
+                traceback.print_exc()
+                pass
             self.accelerator.wait_for_everyone()
 
     def resume(self):
-        if self.config.resume_from:
+        if self.config.resume_from and checkpoint_utils.is_sharded_checkpoint(self.config.resume_from, checkpoint_utils.TRAIN_STATE_INDEX_NAME):
+            metadata = checkpoint_utils.load_sharded_train_state(
+                self.config.resume_from,
+                self.accelerator.process_index,
+                models=self._get_training_models(),
+                optimizer=self.optimizer,
+                lr_scheduler=self.lr_scheduler,
+                scaler=self.accelerator.scaler,
+            )
+            self.global_step = metadata["global_step"]
+            logger.print(f"sharded train state loaded from: `{log_utils.yellow(self.config.resume_from)}`")
+        elif self.config.resume_from:
             self.accelerator.load_state(self.config.resume_from)
-            self.global_step = self.accelerator.step
+            metadata = checkpoint_utils.read_train_state_metadata(self.config.resume_from)
+            if metadata is not None:
+                self.global_step = metadata["global_step"]
+            else:
+                # saved without the progress: `accelerator.step` counts every micro-step of gradient accumulation
+                self.global_step = self.accelerator.step // self.config.gradient_accumulation_steps
             logger.print(f"train state loaded from: `{log_utils.yellow(self.config.resume_from)}`")
+        self.skip_steps = self.global_step % self.num_steps_per_epoch
+
+    def epoch_dataloader(self):
+        r"""
+        Dataloader of the current epoch. The first epoch after resuming skips the batches of the steps already trained in it.
+        """
+        if not self.skip_steps:
+            return self.train_dataloader
+        num_batches, self.skip_steps = self.skip_steps * self.config.gradient_accumulation_steps, 0
+        logger.print(f"skip {num_batches} batches trained before resuming")
+        return self.accelerator.skip_first_batches(self.train_dataloader, num_batches)
 
     def pbar(self):
         from tqdm import tqdm
@@ -0,0 +1,139 @@
+import torch
+from typing import List, Optional
+from . import log_utils
+
+logger = log_utils.get_logger("vae")
+
+VAE_DOWNSCALE = 8
+
+
+def _tile_starts(size, tile_size, overlap) -> List[int]:
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, size - tile_size, stride))
+    starts.append(size - tile_size)  # align the last tile to the end
+    return starts
+
+
+def _tile_weights(starts, size, tile_size, scale, device) -> List[torch.Tensor]:
+    r"""
+    1D blending weights of each tile in the output space: linear ramps over the overlaps with the neighbouring tiles.
+    """
+    weights = []
+    for i, start in enumerate(starts):
+        length = min(tile_size, size) * scale
+        weight = torch.ones(length, device=device)
+        if i > 0:
+            overlap = (starts[i - 1] + tile_size - start) * scale
+            weight[:overlap] = torch.arange(1, overlap + 1, device=device) / (overlap + 1)
+        if i < len(starts) - 1:
+            overlap = (start + tile_size - starts[i + 1]) * scale
+            weight[length - overlap:] = torch.arange(overlap, 0, -1, device=device) / (overlap + 1)
+        weights.append(weight)
+    return weights
+
+
+def _tiled_apply(x, fn, tile_size, overlap, scale, inv_scale=1):
+    r"""
+    Apply `fn` to overlapping spatial tiles of `x` and blend the outputs. `fn` scales the spatial size by `scale / inv_scale`.
+    """
+    _, _, height, width = x.shape
+    ys = _tile_starts(height, tile_size, overlap)
+    xs = _tile_starts(width, tile_size, overlap)
+    if len(ys) == 1 and len(xs) == 1:
+        return fn(x)
+
+    def out(v):
+        return v * scale // inv_scale
+
+    weights_y = _tile_weights(ys, height, tile_size, scale, x.device)
+    weights_x = _tile_weights(xs, width, tile_size, scale, x.device)
+    if inv_scale > 1:  # weights are computed in the upscaled space, downsample them to the output space
+        weights_y = [w[::inv_scale] for w in weights_y]
+        weights_x = [w[::inv_scale] for w in weights_x]
+
+    output, total_weight = None, None
+    for y, weight_y in zip(ys, weights_y):
+        for x0, weight_x in zip(xs, weights_x):
+            tile = fn(x[:, :, y:y + tile_size, x0:x0 + tile_size])
+            if output is None:
+                output = torch.zeros(tile.shape[0], tile.shape[1], out(height), out(width), device=tile.device, dtype=torch.float32)
+                total_weight = torch.zeros(out(height), out(width), device=tile.device, dtype=torch.float32)
+                output_dtype = tile.dtype
+            weight = weight_y[:, None] * weight_x[None, :]
+            oy, ox = out(y), out(x0)
+            output[:, :, oy:oy + tile.shape[2], ox:ox + tile.shape[3]] += tile.float() * weight
+            total_weight[oy:oy + tile.shape[2], ox:ox + tile.shape[3]] += weight
+            del tile
+    return (output / total_weight).to(output_dtype)
+
+
+def _check_tiling_args(tile_size, tile_overlap):
+    assert tile_size % VAE_DOWNSCALE == 0, f"tile_size must be divisible by {VAE_DOWNSCALE}: {tile_size} / tile_sizeは{VAE_DOWNSCALE}の倍数である必要があります"
+    assert tile_overlap % VAE_DOWNSCALE == 0 and 0 <= tile_overlap < tile_size, \
+        f"tile_overlap must be divisible by {VAE_DOWNSCALE} and smaller than tile_size: {tile_overlap} / tile_overlapは{VAE_DOWNSCALE}の倍数かつtile_size未満である必要があります"
+
+
+def encode(vae, images, batch_slice_size: Optional[int] = None, tile_size: Optional[int] = None, tile_overlap: int = 64):
+    r"""
+    Encode `images` into the latent distribution like `vae.encode(images).latent_dist`, optionally in batch slices of `batch_slice_size`
+    and spatial tiles of `tile_size` pixels overlapping by `tile_overlap` pixels. The moments of the tiles are blended linearly in the overlaps.
+    """
+    if not batch_slice_size and tile_size is None:
+        return vae.encode(images).latent_dist
+    if tile_size is not None:
+        _check_tiling_args(tile_size, tile_overlap)
+
+    dist_class = None
+
+    def encode_moments(x):
+        nonlocal dist_class
+        dist = vae.encode(x).latent_dist
+        dist_class = type(dist)
+        return dist.parameters
+
+    moments = []
+    for x in (images.split(batch_slice_size) if batch_slice_size else [images]):
+        if tile_size is None:
+            moments.append(encode_moments(x))
+        else:
+            moments.append(_tiled_apply(x, encode_moments, tile_size, tile_overlap, scale=1, inv_scale=VAE_DOWNSCALE))
+    moments = torch.cat(moments, dim=0) if len(moments) > 1 else moments[0]
+    return dist_class(moments)
+
+
+def decode(vae, latents, batch_slice_size: Optional[int] = None, tile_size: Optional[int] = None, tile_overlap: int = 64):
+    r"""
+    Decode `latents` into images like `vae.decode(latents).sample`, optionally in batch slices of `batch_slice_size`
+    and spatial tiles of `tile_size` pixels overlapping by `tile_overlap` pixels. The decoded tiles are blended linearly in the overlaps.
+    """
+    if not batch_slice_size and tile_size is None:
+        return vae.decode(latents).sample
+    if tile_size is not None:
+        _check_tiling_args(tile_size, tile_overlap)
+
+    def decode_sample(z):
+        return vae.decode(z).sample
+
+    images = []
+    for z in (latents.split(batch_slice_size) if batch_slice_size else [latents]):
+        if tile_size is None:
+            images.append(decode_sample(z))
+        else:
+            images.append(_tiled_apply(z, decode_sample, tile_size // VAE_DOWNSCALE, tile_overlap // VAE_DOWNSCALE, scale=VAE_DOWNSCALE))
+    return torch.cat(images, dim=0) if len(images) > 1 else images[0]
+
+
+def diff_report(reference, output, value_range=1.0) -> dict:
+    r"""
+    Numerical difference of `output` versus `reference`, e.g. the tiled versus the un-tiled path.
+    """
+    diff = (output.float() - reference.float()).abs()
+    mse = diff.pow(2).mean().item()
+    return dict(
+        max_abs=diff.max().item(),
+        mean_abs=diff.mean().item(),
+        rmse=mse ** 0.5,
+        psnr=10 * torch.log10(torch.tensor(value_range ** 2 / mse)).item() if mse > 0 else float("inf"),
+    )
@@ -5,7 +5,7 @@ from absl import app
 from ml_collections import config_flags
 from pathlib import Path
 from modules import sdxl_eval_utils, sdxl_train_utils, log_utils
-from modules.sdxl_lpw_stable_diffusion import SdxlStableDiffusionLongPromptWeightingPipeline
+from modules.sdxl_lpw_stable_diffusion import SdxlStableDiffusionLongPromptWeightingPipeline, PromptEmbeddingCache
 
 
 @torch.no_grad()
@@ -65,6 +65,10 @@ def eval(argv):
 
     gen_params = sdxl_eval_utils.load_params(config.sample_benchmark)
     sample_sampler = sdxl_eval_utils.prepare_sampler(config.sample_sampler)
+    embedding_cache = None
+    if config.sample_embedding_cache_kwargs.enable:
+        embedding_cache = PromptEmbeddingCache(max_entries=config.sample_embedding_cache_kwargs.max_entries)
+    sdxl_train_utils.apply_torch_compile(config, unet, num_shapes=len(gen_params))
 
     pipe = SdxlStableDiffusionLongPromptWeightingPipeline(
         unet=unet,
@@ -76,58 +80,49 @@ def eval(argv):
         feature_extractor=None,
         requires_safety_checker=False,
         clip_skip=config.clip_skip,
+        vae_tiling_kwargs=config.vae_tiling_kwargs,
+        embedding_cache=embedding_cache,
     )
     pipe.to(accelerator.device)
 
-    pbar = logger.tqdm(total=len(gen_params), desc='total')
-    for idx, param in enumerate(gen_params):
-
-        param = sdxl_eval_utils.patch_default_param(param, config.sample_params)
-        param = sdxl_eval_utils.prepare_param(param)
-
-        def save_latents_callback(i, t, latents):
-            images = pipe.latents_to_image(latents)
-            for b, image in enumerate(images):
-                sample_path = sample_dir / f"{idx:04d}-{b}-t={t:.0f}-i={i}.png"
-                sample_path.parent.mkdir(parents=True, exist_ok=True)
-                image.save(sample_path)
-
-        with accelerator.autocast():
-            latents = pipe(
-                prompt=[param["prompt"]]*param["batch_size"],
-                negative_prompt=[param["negative_prompt"]]*param["batch_size"],
-                num_inference_steps=param["steps"],
-                guidance_scale=param["scale"],
-                width=param["width"],
-                height=param["height"],
-                original_width=param["original_width"],
-                original_height=param["original_height"],
-                original_scale_factor=param["original_scale_factor"],
-                num_images_per_prompt=param["batch_count"],
-                callback=save_latents_callback if param["save_latents"] else None,
-            )
-        images = pipe.latents_to_image(latents)
-
-        sample_dir.mkdir(parents=True, exist_ok=True)
-        for b, image in enumerate(images):
-            info_dict = {
-                'prompt': param["prompt"],
-                'negative_prompt': param["negative_prompt"],
-                'sample_steps': param["steps"],
-                'width': param["width"],
-                'height': param["height"],
-                'scale': param["scale"],
-                'seed': param["seed"],
-                'sampler': config.sample_sampler,
-                'original_width': param["original_width"],
-                'original_height': param["original_height"],
-                'original_scale_factor': param["original_scale_factor"],
-            }
-            output_path = sample_dir / f"{idx:04d}-{b}.png"
-            image.save(output_path, save_all=True, append_images=[image], **info_dict)
-        pbar.update(1)
+    gen_params = [sdxl_eval_utils.prepare_param(sdxl_eval_utils.patch_default_param(param, config.sample_params)) for param in gen_params]
+    gen_params = sdxl_eval_utils.resolve_seeds(gen_params, accelerator)
+    batch_kwargs = config.sample_batch_kwargs
+    if batch_kwargs.enable:
+        batches = sdxl_eval_utils.group_params(gen_params, config.sample_sampler, batch_kwargs.max_batch_size, batch_kwargs.max_batch_pixels)
+    else:
+        batches = [[(idx, param)] for idx, param in enumerate(gen_params)]
+    # every process samples its share of the benchmark
+    batches = sdxl_eval_utils.shard_batches(batches, accelerator.process_index, num_processes)
+
+    sink = sdxl_eval_utils.SampleSink(**config.sample_sink_kwargs)
+    pbar = logger.tqdm(total=sum(len(batch) for batch in batches), desc='total')
+    for batch in batches:
+
+        def save_latents_callback(batch, i, t, latents):
+            rows = [(idx, b) for idx, param in batch for b in range(param["batch_size"] * param["batch_count"])]
+            sample_dir.mkdir(parents=True, exist_ok=True)
+            sink.save(pipe.decode_latents(latents), [sample_dir / f"{idx:04d}-{b}-t={t:.0f}-i={i}.png" for idx, b in rows])
+
+        latents_list = sdxl_eval_utils.sample_batch(pipe, accelerator, batch, callback=save_latents_callback if batch[0][1]["save_latents"] else None)
+
+        # only decode on the main thread, the sink converts, encodes and writes the images with their metadata while the next batch is denoised
+        for (idx, param), latents in zip(batch, latents_list):
+            images = pipe.decode_latents(latents)
+            info_dict = sdxl_eval_utils.get_sample_metadata(param, config.sample_sampler)
+            samples = [dict(index=idx, image_index=b, metadata=info_dict) for b in range(len(images))]
+            sink.write(sample_dir, images, samples, lambda sample: f"{sample['index']:04d}-{sample['image_index']}")
+            pbar.update(1)
+
+    # every process has written its own images, only their records are gathered
+    samples = sdxl_eval_utils.gather_samples(accelerator, sink.results())
+    if is_main_process:
+        sink.submit(sdxl_eval_utils.save_sample_metadata, sample_dir, samples)
+    sink.close()
 
     pbar.close()
+    if embedding_cache is not None:
+        logger.print(f"prompt embedding cache: {embedding_cache.hits} hits, {embedding_cache.misses} misses")
     del pipe
     torch.cuda.empty_cache()
     accelerator.wait_for_everyone()
@@ -8,9 +8,8 @@ from absl import flags
 from absl import app
 from ml_collections import config_flags
 from torch.utils.data import DataLoader
-from diffusers import DDPMScheduler
 from tqdm import tqdm
-from modules import advanced_train_utils, sdxl_train_utils, sdxl_dataset_utils, log_utils
+from modules import sdxl_train_utils, sdxl_dataset_utils, profile_utils, log_utils
 
 
 def train(argv):
@@ -60,7 +59,10 @@ def train(argv):
 
     if config.cache_latents:
         with torch.no_grad():
-            dataset.cache_latents(vae, accelerator, config.vae_batch_size, config.cache_latents_to_disk, check_validity=config.check_cache_validity, async_cache=config.async_cache)
+            dataset.cache_latents(
+                vae, accelerator, config.vae_batch_size, config.cache_latents_to_disk, check_validity=config.check_cache_validity, async_cache=config.async_cache,
+                vae_tiling_kwargs=config.vae_tiling_kwargs,
+            )
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         gc.collect()
@@ -103,7 +105,7 @@ def train(argv):
 
     if train_unet:
         if config.gradient_checkpointing:
-            unet.enable_gradient_checkpointing()
+            sdxl_train_utils.apply_gradient_checkpointing(config, unet)
         unet.requires_grad_(True)
         training_models.append(unet)
         if config.block_lr is None:
@@ -147,7 +149,8 @@ def train(argv):
         text_encoder1.eval()
         text_encoder2.eval()
 
-    total_batch_size = config.batch_size * config.gradient_accumulation_steps * num_processes
+    batch_size = round(dataset.mean_batch_size, 2) if config.token_budget_kwargs.enable else config.batch_size
+    total_batch_size = batch_size * config.gradient_accumulation_steps * num_processes
     num_train_epochs = config.num_train_epochs
     num_steps_per_epoch = math.ceil(len(train_dataloader) / config.gradient_accumulation_steps / num_processes)
     num_train_steps = num_train_epochs * num_steps_per_epoch
@@ -170,6 +173,17 @@ def train(argv):
         text_encoder1.to(weight_dtype)
         text_encoder2.to(weight_dtype)
 
+    if config.torch_compile_kwargs.enable:
+        bucket_sizes = sorted({tuple(img_info.bucket_size) for img_info in dataset.image_data.values()})
+        sdxl_train_utils.apply_torch_compile(config, unet, num_shapes=len(bucket_sizes))
+        if config.torch_compile_kwargs.shape_mode == "prewarm":
+            unet.train(train_unet)
+            unet.to(accelerator.device)
+            prewarm_times = sdxl_train_utils.prewarm_compiled_unet(
+                config, accelerator, unet, bucket_sizes, weight_dtype, backward=train_unet,
+                batch_sizes={bucket_size: dataset.get_bucket_batch_size(bucket_size) for bucket_size in bucket_sizes},
+            )
+
     if train_unet:
         unet = accelerator.prepare(unet)
         (unet,) = sdxl_train_utils.transform_models_if_DDP([unet])
@@ -214,16 +228,9 @@ def train(argv):
         ckpt_info=ckpt_info,
         save_dtype=save_dtype,
     )
+    train_state.resume()
 
-    noise_scheduler = DDPMScheduler(
-        beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", num_train_timesteps=1000, clip_sample=False
-    )
-
-    if config.prediction_type is not None:  # set prediction_type of scheduler if defined
-        noise_scheduler.register_to_config(prediction_type=config.prediction_type)
-    sdxl_train_utils.prepare_scheduler_for_custom_training(noise_scheduler, accelerator.device)
-    if config.zero_terminal_snr:
-        advanced_train_utils.fix_noise_scheduler_betas_for_zero_terminal_snr(noise_scheduler)
+    noise_scheduler = sdxl_train_utils.prepare_noise_scheduler(config, accelerator.device)
 
     if is_main_process:
         accelerator.init_trackers("finetuning", init_kwargs={})
@@ -236,138 +243,117 @@ def train(argv):
     logger.print(f"  train text encoder 2: {train_text_encoder2} | learning rate: {config.learning_rate_te2 if train_text_encoder2 else 0}")
     logger.print(f"  number of trainable parameters: {n_params} = {n_params / 1e9:.1f}B")
     logger.print(
-        f"  total batch size: {log_utils.yellow(total_batch_size)} = {config.batch_size} (batch size) x {config.gradient_accumulation_steps} (gradient accumulation steps) x {num_processes} (num processes)")
+        f"  total batch size: {log_utils.yellow(total_batch_size)} = {batch_size} (batch size) x {config.gradient_accumulation_steps} (gradient accumulation steps) x {num_processes} (num processes)")
     logger.print(f"  mixed precision: {config.mixed_precision} | weight-dtype: {weight_dtype} | save-dtype: {save_dtype}")
     logger.print(f"  optimizer: {config.optimizer_type} | timestep sampler: {config.timestep_sampler_type}")
     logger.print(f"  device: {log_utils.yellow(accelerator.device)}")
 
     pbar = train_state.pbar()
+    log_scheduler = sdxl_train_utils.LogScheduler(accelerator, pbar, **config.logging_kwargs)
+    accum_loss, accum_count = 0.0, 0
+    profiler = profile_utils.PhaseProfiler(
+        enable=config.profiler_kwargs.enable and is_main_process,
+        use_cuda_events=config.profiler_kwargs.use_cuda_events,
+        report_every_n_steps=config.profiler_kwargs.report_every_n_steps,
+        trace_steps=config.profiler_kwargs.trace_steps,
+        trace_path=config.profiler_kwargs.trace_path or os.path.join(config.output_dir, config.output_subdir.logs, "trace.json"),
+    )
+    compile_monitor = profile_utils.CompileWarmupMonitor(
+        enable=config.torch_compile_kwargs.enable and is_main_process,
+        report_after_n_steps=config.torch_compile_kwargs.report_after_n_steps,
+        eager_step_time=config.torch_compile_kwargs.eager_step_time,
+    )
+    if config.torch_compile_kwargs.enable and config.torch_compile_kwargs.shape_mode == "prewarm":
+        for (width, height), duration in prewarm_times.items():
+            compile_monitor.add_compile_time((dataset.get_bucket_batch_size((width, height)), 4, height // 8, width // 8), duration)
+    data_monitor = profile_utils.DataloaderMonitor(
+        enable=config.data_monitor_kwargs.enable and is_main_process,
+        num_workers=dataloader_n_workers,
+        report_every_n_batches=config.data_monitor_kwargs.report_every_n_batches,
+        data_bound_threshold=config.data_monitor_kwargs.data_bound_threshold,
+    )
 
+    is_saving_process = is_main_process or config.sharded_save_kwargs.enable  # every rank writes its shard
     try:
         while train_state.epoch < num_train_epochs:
             if is_main_process:
                 pbar.write(f"epoch: {train_state.epoch}/{num_train_epochs}")
             for m in training_models:
                 m.train()
-            for step, batch in enumerate(train_dataloader):
-                with accelerator.accumulate(*training_models):
-                    if batch.get("latents") is not None:
-                        latents = batch["latents"].to(accelerator.device)
-                    else:
-                        with torch.no_grad():
-                            latents = vae.encode(batch["images"].to(vae_dtype)).latent_dist.sample().to(weight_dtype)
-                            if torch.any(torch.isnan(latents)):
-                                pbar.write("NaN found in latents, replacing with zeros")
-                                latents = torch.where(torch.isnan(latents), torch.zeros_like(latents), latents)
-                    latents *= sdxl_train_utils.VAE_SCALE_FACTOR
-
-                    if batch.get("text_encoder_outputs1_list") is None:  # TODO: Implement text encoder cache
-                        input_ids1 = batch["input_ids_1"]
-                        input_ids2 = batch["input_ids_2"]
-                        with torch.set_grad_enabled(config.train_text_encoder):
-                            input_ids1 = input_ids1.to(accelerator.device)
-                            input_ids2 = input_ids2.to(accelerator.device)
-                            encoder_hidden_states1, encoder_hidden_states2, pool2 = sdxl_train_utils.get_hidden_states_sdxl(
-                                config.max_token_length,
-                                input_ids1,
-                                input_ids2,
-                                tokenizer1,
-                                tokenizer2,
-                                text_encoder1,
-                                text_encoder2,
-                                None if not config.full_fp16 else weight_dtype,
-                            )
-                    else:
-                        encoder_hidden_states1 = batch["text_encoder_outputs1_list"].to(accelerator.device).to(weight_dtype)
-                        encoder_hidden_states2 = batch["text_encoder_outputs2_list"].to(accelerator.device).to(weight_dtype)
-                        pool2 = batch["text_encoder_pool2_list"].to(accelerator.device).to(weight_dtype)
-
-                    target_size = batch["target_size_hw"]
-                    orig_size = batch["original_size_hw"]
-                    crop_size = batch["crop_top_lefts"]
-                    embs = sdxl_train_utils.get_size_embeddings(orig_size, crop_size, target_size, accelerator.device).to(weight_dtype)
-
-                    vector_embedding = torch.cat([pool2, embs], dim=1).to(weight_dtype)
-                    text_embedding = torch.cat([encoder_hidden_states1, encoder_hidden_states2], dim=2).to(weight_dtype)
-
-                    noise, noisy_latents, timesteps = sdxl_train_utils.get_noise_noisy_latents_and_timesteps(config, noise_scheduler, latents)
-
-                    noisy_latents = noisy_latents.to(weight_dtype)
-
-                    with accelerator.autocast():
-                        noise_pred = unet(noisy_latents, timesteps, text_embedding, vector_embedding)
-
-                    if noise_scheduler.config.prediction_type == "epsilon":
-                        target = noise
-                    elif noise_scheduler.config.prediction_type == "v_prediction":
-                        target = noise_scheduler.get_velocity(latents, noise, timesteps)
-                    else:
-                        raise ValueError(f"Unknown prediction type {noise_scheduler.config.prediction_type}")
-
-                    if (
-                        config.min_snr_gamma
-                        or config.debiased_estimation_loss
-                    ):
-                        # do not mean over batch dimension for snr weight or scale v-pred loss
-                        loss = torch.nn.functional.mse_loss(noise_pred.float(), target.float(), reduction="none")
-                        loss = loss.mean([1, 2, 3])
-
-                        if config.min_snr_gamma:
-                            loss = advanced_train_utils.apply_snr_weight(loss, timesteps, noise_scheduler, config.min_snr_gamma, config.prediction_type)
-                        if config.debiased_estimation_loss:
-                            loss = advanced_train_utils.apply_debiased_estimation(loss, timesteps, noise_scheduler)
-
-                        loss = loss.mean()  # mean over batch dimension
-                    else:
-                        loss = torch.nn.functional.mse_loss(noise_pred.float(), target.float(), reduction="mean")
-
-                    if torch.isnan(loss):
-                        loss = torch.where(torch.isnan(loss), torch.zeros_like(loss), loss)
-
-                    accelerator.backward(loss)
-                    if accelerator.sync_gradients and config.max_grad_norm != 0.0:
-                        params_to_clip = []
-                        for m in training_models:
-                            params_to_clip.extend(m.parameters())
-                        accelerator.clip_grad_norm_(params_to_clip, config.max_grad_norm)
-
-                    optimizer.step()
-                    lr_scheduler.step()
-                    optimizer.zero_grad(set_to_none=True)
+            epoch_dataloader = train_state.epoch_dataloader()
+            for step, batch in enumerate(profiler.iter(data_monitor.iter(epoch_dataloader))):
+                latents_shape = sdxl_train_utils.get_latents_shape(batch)
+                with compile_monitor.track(latents_shape):
+                    loss = sdxl_train_utils.train_step(
+                        config,
+                        accelerator,
+                        batch,
+                        noise_scheduler=noise_scheduler,
+                        unet=unet,
+                        text_encoder1=text_encoder1,
+                        text_encoder2=text_encoder2,
+                        tokenizer1=tokenizer1,
+                        tokenizer2=tokenizer2,
+                        vae=vae,
+                        optimizer=optimizer,
+                        lr_scheduler=lr_scheduler,
+                        training_models=training_models,
+                        weight_dtype=weight_dtype,
+                        vae_dtype=vae_dtype,
+                        profiler=profiler,
+                    )
+
+                # accumulate loss on device to avoid syncing on every micro-step
+                if is_main_process:
+                    accum_loss = accum_loss + loss.detach().float()
+                    accum_count += 1
 
                 if accelerator.sync_gradients:
                     pbar.update(1)
                     train_state.step()
-                    train_state.save(on_step_end=True)
-                    train_state.sample(on_step_end=True)
-
-                # loggings
-                step_loss: float = loss.detach().item()
-                loss_recorder.add(loss=step_loss)
-                avr_loss: float = loss_recorder.moving_average(window=config.loss_recorder_kwargs.stride)
-                ema_loss: float = loss_recorder.ema
-
-                logs = {"loss/step": step_loss, 'loss_avr/step': avr_loss, 'loss_ema/step': ema_loss}
-                if block_lrs is None:
-                    sdxl_train_utils.append_lr_to_logs(logs, lr_scheduler, config.optimizer_type, including_unet=train_unet)
-                else:
-                    sdxl_train_utils.append_block_lr_to_logs(block_lrs, logs, lr_scheduler, config.optimizer_type)  # U-Net is included in block_lrs
-                accelerator.log(logs, step=train_state.global_step)
-
-                pbar_logs = {
-                    'lr': lr_scheduler.get_last_lr()[0],
-                    'epoch': train_state.epoch,
-                    'global_step': train_state.global_step,
-                    'next': len(train_dataloader) - step - 1,
-                    'step_loss': step_loss,
-                    'avr_loss': avr_loss,
-                    'ema_loss': ema_loss,
-                }
-                pbar.set_postfix(pbar_logs)
+                    with profiler.phase("save"):
+                        train_state.save(on_step_end=True)
+                    with profiler.phase("sample"):
+                        train_state.sample(on_step_end=True)
+
+                    # loggings
+                    if is_main_process:
+                        step_loss: float = accum_loss.item() / accum_count
+                        accum_loss, accum_count = 0.0, 0
+                        loss_recorder.add(loss=step_loss)
+                        avr_loss: float = loss_recorder.moving_average(window=config.loss_recorder_kwargs.stride)
+                        ema_loss: float = loss_recorder.ema
+
+                        logs = {"loss/step": step_loss, 'loss_avr/step': avr_loss, 'loss_ema/step': ema_loss}
+                        train_state.update_metrics(logs)
+                        if log_scheduler.is_tracker_step(train_state.global_step):
+                            if block_lrs is None:
+                                sdxl_train_utils.append_lr_to_logs(logs, lr_scheduler, config.optimizer_type, including_unet=train_unet)
+                            else:
+                                sdxl_train_utils.append_block_lr_to_logs(block_lrs, logs, lr_scheduler, config.optimizer_type)  # U-Net is included in block_lrs
+
+                        pbar_logs = {
+                            'lr': lr_scheduler.get_last_lr()[0],
+                            'epoch': train_state.epoch,
+                            'global_step': train_state.global_step,
+                            'next': len(epoch_dataloader) - step - 1,
+                            'step_loss': step_loss,
+                            'avr_loss': avr_loss,
+                            'ema_loss': ema_loss,
+                        }
+                        log_scheduler.log(logs, step=train_state.global_step, pbar_logs=pbar_logs)
+
+                profiler.step(train_state.global_step)
 
             # end of epoch
-            logs = {"loss/epoch": loss_recorder.moving_average(window=num_steps_per_epoch)}
-            accelerator.log(logs, step=train_state.epoch)
+            if is_main_process:
+                logs = {"loss/epoch": loss_recorder.moving_average(window=num_steps_per_epoch)}
+                if config.token_budget_kwargs.enable:
+                    batching_stats = dataset.batching_stats()
+                    logs.update({"batching/padding_waste": batching_stats["padding_waste"], "batching/mean_batch_size": batching_stats["mean_batch_size"]})
+                    dataset.report_batching()
+                log_scheduler.log_now(logs, step=train_state.epoch)
+                train_state.update_metrics(logs)
             accelerator.wait_for_everyone()
             train_state.save(on_epoch_end=True)
             train_state.sample(on_epoch_end=True)
@@ -375,20 +361,23 @@ def train(argv):
                 break
 
     except KeyboardInterrupt:
-        save_on_train_end = is_main_process and config.save_on_keyboard_interrupt
+        save_on_train_end = is_saving_process and config.save_on_keyboard_interrupt
         logger.print("KeyboardInterrupted.")
     except Exception as e:
-        save_on_train_end = is_main_process and config.save_on_exception
+        save_on_train_end = is_saving_process and config.save_on_exception
         logger.print("Exception:", e)
         traceback.print_exc()
     else:
-        save_on_train_end = is_main_process and config.save_on_train_end
+        save_on_train_end = is_saving_process and config.save_on_train_end
 
+    log_scheduler.close()
+    profiler.close()
     pbar.close()
     accelerator.wait_for_everyone()
     if save_on_train_end:
         logger.print(f"saving on train end...")
         train_state.save(on_train_end=True)
+    train_state.wait_for_saves()
     accelerator.end_training()
     logger.print(log_utils.green(f"training finished at process {local_process_index+1}/{num_processes}"), disable=False)
     del accelerator